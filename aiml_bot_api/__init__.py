@@ -53,5 +53,16 @@ A JSON endpoint for getting a particular message's associated data.
 
 
 from .data import DataManager
-from .endpoints import app
-from .graphql import schema
+
+
+def __getattr__(name):
+    # The app and schema are imported on first access, because importing the
+    # endpoints starts up the global data manager and its bots. This keeps
+    # command-line tools like `python -m aiml_bot_api.brain` from paying for
+    # a full server startup. (The graphql module registers the GraphQL
+    # endpoint with the app, so it must be imported either way.)
+    if name in ('app', 'schema'):
+        from .endpoints import app
+        from .graphql import schema
+        return app if name == 'app' else schema
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,181 @@
+"""
+Read-only, compressed archives of old messages. Messages moved out of a
+user's live message store by the retention policy (see the retention module)
+are written to the user's archive, in archive/<user_id>/, as a series of
+segments. Each segment holds a batch of messages, pickled and compressed
+with zlib, and is never modified once it is written. An index file,
+archive/<user_id>/index, maps each archived message ID to its segment, so a
+single message can be found without reading the other segments.
+
+Segments are written to a temporary file and then renamed into place, and
+index entries are only appended once their segment is complete. If the
+index lags behind the segments after a crash, it is caught up from the
+segments themselves when the archive is opened.
+"""
+
+import os
+import pickle
+import threading
+import zlib
+from collections import OrderedDict
+
+from .ids import get_sort_key
+
+
+SEGMENT_EXTENSION = '.seg'
+
+# The number of decompressed segments each archive keeps in memory.
+CACHED_SEGMENTS = 4
+
+
+class MessageArchive:
+    """A user's archived messages, as a read-only mapping from message IDs
+    to message data, plus the ability to append new segments. Reads may be
+    made concurrently from several threads; appends must be serialized by
+    the caller."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = os.path.join(path, 'index')
+        self._lock = threading.Lock()  # Protects the segment cache
+        self._segments = OrderedDict()  # Segment number -> {message ID: message data}, least recently used first
+        self.locations = {}  # Message ID -> segment number
+        self.times = {}  # Message ID -> message time
+        self.segment_count = 0
+        if os.path.isdir(path):
+            self._load_index()
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path, '%08d%s' % (number, SEGMENT_EXTENSION))
+
+    def _load_index(self) -> None:
+        # Each segment's entries are followed by a line with the segment's
+        # number, marking them complete. Entries without one are ignored,
+        # and read from the segment again.
+        indexed = set()
+        clean = True
+        if os.path.isfile(self.index_path):
+            pending = []
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    if not line.endswith('\n'):
+                        clean = False  # A partially written entry from a crash
+                        break
+                    if line.startswith('#'):
+                        for message_id, number, message_time in pending:
+                            self.locations[message_id] = number
+                            self.times[message_id] = message_time
+                        indexed.add(int(line[1:]))
+                        pending = []
+                    else:
+                        message_id, number, message_time = line[:-1].split('\t')
+                        pending.append((message_id, int(number), message_time))
+            clean = clean and not pending
+
+        # Catch up on segments written after the last complete index entry,
+        # and clean up after segments which were never finished.
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_EXTENSION + '.tmp'):
+                os.remove(os.path.join(self.path, name))
+            elif name.endswith(SEGMENT_EXTENSION):
+                numbers.append(int(name[:-len(SEGMENT_EXTENSION)]))
+        self.segment_count = max(numbers, default=-1) + 1
+        missing = [number for number in sorted(numbers) if number not in indexed]
+        if missing or not clean:
+            for number in missing:
+                for message_data in self._read_segment(number).values():
+                    self.locations[message_data['id']] = number
+                    self.times[message_data['id']] = message_data['time']
+            segments = {}
+            for message_id, number in self.locations.items():
+                segments.setdefault(number, []).append(message_id)
+            with open(self.index_path + '.tmp', 'w') as index_file:
+                for number in sorted(segments):
+                    index_file.write(self._index_entries(number, [(message_id, self.times[message_id])
+                                                                  for message_id in segments[number]]))
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+    @staticmethod
+    def _index_entries(number: int, entries: list) -> str:
+        lines = ['%s\t%d\t%s\n' % (message_id, number, message_time) for message_id, message_time in entries]
+        lines.append('#%d\n' % number)
+        return ''.join(lines)
+
+    def _read_segment(self, number: int) -> dict:
+        with open(self._segment_path(number), 'rb') as segment_file:
+            messages = pickle.loads(zlib.decompress(segment_file.read()))
+        return OrderedDict((message_data['id'], message_data) for message_data in messages)
+
+    def _get_segment(self, number: int) -> dict:
+        with self._lock:
+            if number in self._segments:
+                self._segments.move_to_end(number)
+                return self._segments[number]
+        segment = self._read_segment(number)
+        with self._lock:
+            self._segments[number] = segment
+            while len(self._segments) > CACHED_SEGMENTS:
+                self._segments.popitem(last=False)
+        return segment
+
+    def __contains__(self, message_id) -> bool:
+        return message_id in self.locations
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def __getitem__(self, message_id: str) -> dict:
+        return self._get_segment(self.locations[message_id])[message_id]
+
+    def get(self, message_id: str, default=None):
+        """Return the data of the archived message, or the default if it
+        isn't archived."""
+        if message_id not in self.locations:
+            return default
+        return self[message_id]
+
+    def ids(self) -> list:
+        """Return the IDs of the archived messages, in chronological
+        order."""
+        return sorted(self.locations, key=lambda message_id: get_sort_key(message_id, self.times[message_id]))
+
+    def values(self):
+        """Yield the data of each archived message, in chronological
+        order."""
+        for message_id in self.ids():
+            yield self[message_id]
+
+    def append(self, messages: list) -> None:
+        """Write the data of the given messages as a new segment. Messages
+        which are already archived are skipped."""
+        messages = [message_data for message_data in messages if message_data['id'] not in self.locations]
+        if not messages:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        number = self.segment_count
+        path = self._segment_path(number)
+        with open(path + '.tmp', 'wb') as segment_file:
+            segment_file.write(zlib.compress(pickle.dumps(messages, pickle.HIGHEST_PROTOCOL), 9))
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        os.replace(path + '.tmp', path)
+        self.segment_count += 1
+        with open(self.index_path, 'a') as index_file:
+            index_file.write(self._index_entries(number, [(message_data['id'], message_data['time'])
+                                                          for message_data in messages]))
+        for message_data in messages:
+            self.locations[message_data['id']] = number
+            self.times[message_data['id']] = message_data['time']
+
+    def get_size(self) -> int:
+        """Return the total size of the archive's files, in bytes."""
+        if not os.path.isdir(self.path):
+            return 0
+        return sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path))
+
+
+def open_message_archive(data_folder: str, user_id: str) -> MessageArchive:
+    """Open the message archive for the given user."""
+    return MessageArchive(os.path.join(data_folder, 'archive', user_id))
@@ -0,0 +1,533 @@
+"""
+An asyncio front-end for the API. The REST endpoints and the GraphQL schema
+are served by the same Flask application as the synchronous server, wrapped
+as an ASGI application: requests are read and responses are written by
+coroutines, and only the Flask request handlers themselves, which call into
+the data manager and the bots, run in a thread pool. An idle or slowly
+sending client therefore costs a coroutine instead of a thread. Streams of
+server-sent events and long polls for new messages are served natively, so
+an open stream or a waiting poll also costs only a coroutine; see the events
+module.
+
+The ASGI application is available as aiml_bot_api.asgi:application for use
+with any ASGI server, e.g.:
+
+    uvicorn aiml_bot_api.asgi:application
+
+This module also includes a small asyncio HTTP/1.1 server, so no ASGI
+server needs to be installed:
+
+    python -m aiml_bot_api.asgi [--host HOST] [--port PORT] [--threads N]
+"""
+
+import argparse
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote
+
+from werkzeug.http import parse_accept_header
+
+from . import encoding, events
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_THREADS = 32
+
+# The largest request body the built-in server accepts, in bytes, and the
+# most header lines it accepts in a request.
+MAX_BODY_SIZE = 16 * 1024 * 1024
+MAX_HEADERS = 100
+
+# How long the built-in server waits for the next request on an idle
+# connection, and for the head and then the body of a request once it has
+# begun, in seconds.
+IDLE_TIMEOUT = 75
+REQUEST_TIMEOUT = 30
+
+
+def _next_chunk(iterator):
+    # Return the next chunk of a WSGI response body, or None at the end.
+    for chunk in iterator:
+        return chunk
+    return None
+
+
+class ASGIApp:
+    """An ASGI application which serves a WSGI application, running each
+    request handler in a thread pool executor. If no executor is provided,
+    one with the given number of threads is created. If the data manager
+    behind the WSGI application is provided, event streams and long polls
+    of its users' new messages are served natively, without holding a
+    thread while they wait."""
+
+    def __init__(self, wsgi_app, executor: ThreadPoolExecutor = None, threads: int = DEFAULT_THREADS,
+                 data_manager=None):
+        self.wsgi_app = wsgi_app
+        self.executor = executor or ThreadPoolExecutor(threads, thread_name_prefix='aiml_bot_api')
+        self.data_manager = data_manager
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(scope['type'])
+
+    @staticmethod
+    async def _lifespan(receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def get_environ(scope: dict, body: bytes) -> dict:
+        """Return the WSGI environment for an ASGI HTTP request."""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': str(client[0]),
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = name
+            else:
+                key = 'HTTP_' + name
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+        return environ
+
+    async def _http(self, scope: dict, receive, send) -> None:
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        if self.data_manager is not None and scope['method'] == 'GET':
+            match = events.EVENTS_PATH_PATTERN.match(scope['path'])
+            if match and await self._message_events(scope, receive, send, match.group(1)):
+                return
+            match = events.POLL_PATH_PATTERN.match(scope['path'])
+            if match and await self._poll_messages(scope, receive, send, match.group(1)):
+                return
+
+        loop = asyncio.get_running_loop()
+        started = []
+
+        def start_response(status: str, headers: list, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+
+        environ = self.get_environ(scope, bytes(body))
+        result = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        try:
+            iterator = iter(result)
+            # The status may not be set until the first chunk is produced.
+            chunk = await loop.run_in_executor(self.executor, _next_chunk, iterator)
+            status, headers = started
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            })
+            if chunk is None:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            while chunk is not None:
+                next_chunk = await loop.run_in_executor(self.executor, _next_chunk, iterator)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': next_chunk is not None})
+                chunk = next_chunk
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+    async def _message_events(self, scope: dict, receive, send, user_id: str) -> bool:
+        """Serve a stream of server-sent events for the user's new messages.
+        Return False, without sending anything, if the user or the cursor is
+        invalid, so the WSGI application can respond with the error."""
+        loop = asyncio.get_running_loop()
+        data_manager = self.data_manager
+        cursor = dict(scope.get('headers', ())).get(b'last-event-id', b'').decode('latin-1') or None
+        if cursor is None:
+            cursor = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('cursor', [None])[-1]
+        try:
+            if cursor is None:
+                cursor = await loop.run_in_executor(self.executor, data_manager.get_last_message_id, user_id)
+            else:
+                await loop.run_in_executor(self.executor, data_manager.get_messages_after, user_id, cursor, 0)
+        except (KeyError, ValueError):
+            return False
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache')],
+        })
+        # Send the headers right away, rather than with the first event.
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': True})
+        changed = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(changed.set)
+
+        data_manager.add_message_listener(user_id, listener)
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            while True:
+                # Cleared before looking, so a message added while we look
+                # wakes us up again.
+                changed.clear()
+                messages, cursor = await loop.run_in_executor(self.executor, data_manager.get_messages_after,
+                                                              user_id, cursor)
+                if messages:
+                    chunk = ''.join(events.format_message_event(message_data) for message_data in messages)
+                    await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+                    continue
+                waiting = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait([waiting, disconnected], timeout=events.KEEP_ALIVE_INTERVAL,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+                if disconnected in done:
+                    return True
+                if not done:
+                    await send({'type': 'http.response.body', 'body': events.KEEP_ALIVE.encode('utf-8'),
+                                'more_body': True})
+        finally:
+            data_manager.remove_message_listener(user_id, listener)
+            disconnected.cancel()
+
+    async def _poll_messages(self, scope: dict, receive, send, user_id: str) -> bool:
+        """Serve a long poll for the user's new messages, with the same
+        response as the WSGI application's. Return False, without sending
+        anything, if the request is invalid, so the WSGI application can
+        respond with the error."""
+        loop = asyncio.get_running_loop()
+        data_manager = self.data_manager
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        try:
+            limit, cursor, timeout = events.parse_poll_args({name: values[0] for name, values in query.items()})
+            if cursor is None:
+                cursor = await loop.run_in_executor(self.executor, data_manager.get_last_message_id, user_id)
+        except (KeyError, ValueError):
+            return False
+        deadline = loop.time() + timeout
+        changed = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(changed.set)
+
+        data_manager.add_message_listener(user_id, listener)
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            while True:
+                # Cleared before looking, so a message added while we look
+                # wakes us up again.
+                changed.clear()
+                try:
+                    messages, next_cursor = await loop.run_in_executor(self.executor, data_manager.get_messages_after,
+                                                                       user_id, cursor, limit)
+                except (KeyError, ValueError):
+                    return False
+                remaining = deadline - loop.time()
+                if messages or remaining <= 0:
+                    break
+                waiting = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait([waiting, disconnected], timeout=remaining,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+                if disconnected in done:
+                    return True
+        finally:
+            data_manager.remove_message_listener(user_id, listener)
+            disconnected.cancel()
+
+        accept_encoding = dict(scope.get('headers', ())).get(b'accept-encoding', b'').decode('latin-1')
+        body, coding = encoding.encode_json({'type': 'new_messages', 'value': messages, 'next_cursor': next_cursor},
+                                            encoding.choose_content_coding(parse_accept_header(accept_encoding)))
+        headers = [(b'content-type', b'application/json; charset=utf-8'), (b'vary', b'Accept-Encoding')]
+        if coding is not None:
+            headers.append((b'content-encoding', coding.encode('latin-1')))
+        if isinstance(body, bytes):
+            headers.append((b'content-length', str(len(body)).encode('latin-1')))
+            body = [body]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        return True
+
+
+class RequestError(ValueError):
+    """An error in a request read by the built-in server, with the status
+    of the response to send before closing the connection."""
+
+    def __init__(self, status: int, message: str = None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+class HTTPServerProtocol:
+    """A minimal HTTP/1.1 server for ASGI applications, with keep-alive,
+    Content-Length request bodies, and chunked streaming responses.
+
+    Request bodies must be framed by Content-Length. Requests with a
+    Transfer-Encoding are rejected and the connection closed, since their
+    bodies can't be told apart from the requests which follow them. Idle
+    connections and slowly sent requests are closed after a timeout."""
+
+    def __init__(self, app, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.app = app
+        self.reader = reader
+        self.writer = writer
+
+    async def read_headers(self) -> list:
+        """Read the header lines of a request, returning a list of (name,
+        value) pairs, with the names in lower case."""
+        headers = []
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            if len(headers) >= MAX_HEADERS:
+                raise RequestError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+
+    @staticmethod
+    def get_body_length(headers: list) -> int:
+        """Return the length of a request's body, from its headers."""
+        if any(name == b'transfer-encoding' for name, _ in headers):
+            if any(name == b'content-length' for name, _ in headers):
+                raise RequestError(HTTPStatus.BAD_REQUEST, "Both Content-Length and Transfer-Encoding were given.")
+            codings = [value.strip().lower() for name, values in headers if name == b'transfer-encoding'
+                       for value in values.split(b',')]
+            if codings[-1] == b'chunked':
+                raise RequestError(HTTPStatus.LENGTH_REQUIRED)
+            raise RequestError(HTTPStatus.NOT_IMPLEMENTED)
+        lengths = {value for name, value in headers if name == b'content-length'}
+        if not lengths:
+            return 0
+        if len(lengths) > 1 or not all(value.isdigit() for value in lengths):
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.")
+        length = int(lengths.pop())
+        if length > MAX_BODY_SIZE:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        return length
+
+    async def read_request(self):
+        """Read the next request from the connection, returning a tuple
+        (scope, body), or None if the connection was closed or stayed idle
+        for IDLE_TIMEOUT seconds. If the head or the body of the request
+        takes more than REQUEST_TIMEOUT seconds to arrive, a RequestError is
+        raised."""
+        try:
+            request_line = await asyncio.wait_for(self.reader.readline(), IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        if not request_line.strip():
+            return None
+        method, target, version = request_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if not version.startswith('HTTP/1.'):
+            raise ValueError(version)
+        try:
+            headers = await asyncio.wait_for(self.read_headers(), REQUEST_TIMEOUT)
+            length = self.get_body_length(headers)
+            body = await asyncio.wait_for(self.reader.readexactly(length), REQUEST_TIMEOUT) if length else b''
+        except asyncio.TimeoutError:
+            raise RequestError(HTTPStatus.REQUEST_TIMEOUT) from None
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': version[len('HTTP/'):],
+            'method': method.upper(),
+            'scheme': 'http',
+            'path': unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'server': self.writer.get_extra_info('sockname')[:2],
+            'client': (self.writer.get_extra_info('peername') or ('', 0))[:2],
+        }
+        return scope, body
+
+    @staticmethod
+    def keep_alive(scope: dict) -> bool:
+        """Whether the connection should be kept open after the request."""
+        connection = dict(scope['headers']).get(b'connection', b'').lower()
+        if scope['http_version'] == '1.0':
+            return connection == b'keep-alive'
+        return connection != b'close'
+
+    async def handle_request(self, scope: dict, body: bytes) -> bool:
+        """Pass a request to the application and write its response. Return
+        whether the connection can be reused afterward."""
+        keep_alive = self.keep_alive(scope)
+        state = {'chunked': False, 'finished': False}
+        received = []
+
+        async def receive():
+            if received:
+                # The request has been consumed; wait for the disconnect.
+                # Only applications which stream indefinitely, like event
+                # streams, wait for it, so no further requests can follow
+                # on this connection, and anything else read is discarded.
+                while await self.reader.read(65536):
+                    pass
+                return {'type': 'http.disconnect'}
+            received.append(True)
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message: dict):
+            if message['type'] == 'http.response.start':
+                state['status'] = message['status']
+                state['headers'] = list(message.get('headers', ()))
+            elif message['type'] == 'http.response.body':
+                chunk = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                if 'headers' in state:
+                    headers = state.pop('headers')
+                    names = {name.lower() for name, _ in headers}
+                    if b'content-length' not in names:
+                        if more_body:
+                            state['chunked'] = True
+                            headers.append((b'transfer-encoding', b'chunked'))
+                        else:
+                            headers.append((b'content-length', str(len(chunk)).encode('latin-1')))
+                    headers.append((b'connection', b'keep-alive' if keep_alive else b'close'))
+                    self.write_head(state['status'], headers)
+                if state['chunked']:
+                    if chunk:
+                        self.writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    if not more_body:
+                        self.writer.write(b'0\r\n\r\n')
+                else:
+                    self.writer.write(chunk)
+                await self.writer.drain()
+                if not more_body:
+                    state['finished'] = True
+
+        try:
+            await self.app(scope, receive, send)
+        except ConnectionError:
+            raise
+        except Exception:
+            log.exception("Error in ASGI application:")
+            if 'status' not in state:
+                self.write_head(500, [(b'content-length', b'0'), (b'connection', b'close')])
+            return False
+        return keep_alive and state['finished']
+
+    def write_head(self, status: int, headers: list) -> None:
+        """Write the status line and headers of a response."""
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        lines = [('HTTP/1.1 %d %s' % (status, reason)).encode('latin-1')]
+        lines.extend(name + b': ' + value for name, value in headers)
+        self.writer.write(b'\r\n'.join(lines) + b'\r\n\r\n')
+
+    async def run(self) -> None:
+        """Serve requests on the connection until it is closed."""
+        try:
+            while True:
+                try:
+                    request = await self.read_request()
+                except (ValueError, asyncio.IncompleteReadError) as exc:
+                    status = exc.status if isinstance(exc, RequestError) else HTTPStatus.BAD_REQUEST
+                    self.write_head(status, [(b'content-length', b'0'), (b'connection', b'close')])
+                    break
+                if request is None or not await self.handle_request(*request):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.writer.close()
+
+
+async def start_server(app, host: str = '127.0.0.1', port: int = 5000) -> asyncio.AbstractServer:
+    """Start serving an ASGI application with the built-in HTTP server."""
+    async def handle_connection(reader, writer):
+        await HTTPServerProtocol(app, reader, writer).run()
+
+    return await asyncio.start_server(handle_connection, host, port)
+
+
+async def serve(app, host: str = '127.0.0.1', port: int = 5000) -> None:
+    """Serve an ASGI application with the built-in HTTP server, forever."""
+    server = await start_server(app, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def __getattr__(name):
+    # Like the package's app attribute, the ASGI application is created on
+    # first access, because importing the endpoints starts up the data
+    # manager and its bots.
+    if name == 'application':
+        from . import app
+        from .endpoints import data_manager
+        global application
+        application = ASGIApp(app, data_manager=data_manager)
+        return application
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(prog='python -m aiml_bot_api.asgi',
+                                     description="Serve the API with the asyncio front-end.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="The number of threads for running request handlers.")
+    arguments = parser.parse_args(args)
+
+    from . import app
+    from .endpoints import data_manager
+    asgi_app = ASGIApp(app, threads=arguments.threads, data_manager=data_manager)
+    print("Serving on http://%s:%s/" % (arguments.host, arguments.port))
+    try:
+        asyncio.run(serve(asgi_app, arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Precompiled brain snapshots. Parsing the standard AIML set is by far the most
+expensive part of starting the API, so the loaded pattern graph can be
+compiled once into a snapshot file in the data folder. A manifest stored
+alongside the snapshot records the AIML source files it was built from, and
+the snapshot is only used while those sources are unchanged.
+
+Usage:
+
+    python -m aiml_bot_api.brain build [DATA_FOLDER]
+    python -m aiml_bot_api.brain compare [DATA_FOLDER]
+
+The build command (re)compiles the snapshot. The compare command measures
+bot startup time from the AIML sources against startup time from the
+snapshot.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import aiml_bot
+from aiml_bot.bot import AIML_INSTALL_PATH
+
+
+DEFAULT_DATA_FOLDER = '~/aiml_bot_api'
+
+# The files learned by the "load std aiml" command, as written in the
+# bootstrap AIML which ships with aiml_bot.
+STANDARD_AIML = os.path.join('standard', 'std-*.aiml')
+STANDARD_COMMANDS = "load std aiml"
+
+SNAPSHOT_FILE_NAME = 'brain.snapshot'
+MANIFEST_FILE_NAME = 'brain.manifest.json'
+
+
+def get_source_files(pattern: str = STANDARD_AIML) -> list:
+    """Return the sorted list of AIML files the bot would learn for the
+    given file pattern, resolved the same way aiml_bot.Bot.learn() does."""
+    patterns = [pattern]
+    if pattern != os.path.join(AIML_INSTALL_PATH, pattern):
+        patterns.append(os.path.join(AIML_INSTALL_PATH, pattern))
+    patterns += [pattern.lower() for pattern in patterns]
+    return sorted({os.path.abspath(path) for pattern in patterns for path in glob.glob(pattern)
+                   if os.path.isfile(path)})
+
+
+def get_manifest(pattern: str = STANDARD_AIML) -> dict:
+    """Return a manifest describing the current state of the AIML sources.
+    The brain is stored in marshal format, so the Python version is part of
+    the manifest as well."""
+    sources = []
+    for path in get_source_files(pattern):
+        stat = os.stat(path)
+        sources.append([path, stat.st_size, stat.st_mtime_ns])
+    return {
+        'aiml_bot': getattr(aiml_bot, '__version__', None),
+        'python': list(sys.version_info[:2]),
+        'sources': sources,
+    }
+
+
+def get_snapshot_path(data_folder: str) -> str:
+    """Return the path of the brain snapshot in the data folder."""
+    return os.path.join(os.path.expanduser(data_folder), SNAPSHOT_FILE_NAME)
+
+
+def snapshot_is_current(data_folder: str) -> bool:
+    """Return whether the data folder holds a snapshot which is up to date
+    with the AIML sources."""
+    data_folder = os.path.expanduser(data_folder)
+    if not os.path.isfile(os.path.join(data_folder, SNAPSHOT_FILE_NAME)):
+        return False
+    try:
+        with open(os.path.join(data_folder, MANIFEST_FILE_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return False
+    return manifest == get_manifest()
+
+
+def build_snapshot(data_folder: str) -> str:
+    """Compile the standard AIML set into a snapshot in the data folder and
+    return the snapshot's path. The snapshot and manifest are written to
+    temporary files first, so a concurrently starting process never sees a
+    partially written snapshot."""
+    data_folder = os.path.expanduser(data_folder)
+    if not os.path.isdir(data_folder):
+        os.makedirs(data_folder)
+    snapshot_path = os.path.join(data_folder, SNAPSHOT_FILE_NAME)
+    manifest_path = os.path.join(data_folder, MANIFEST_FILE_NAME)
+
+    # Take the manifest before loading, so that sources modified while the
+    # snapshot is being built cause it to be rebuilt next time.
+    manifest = get_manifest()
+    bot = aiml_bot.Bot(commands=STANDARD_COMMANDS)
+    bot.save_brain(snapshot_path + '.tmp')
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    # Remove the old manifest first; a snapshot without a matching manifest
+    # is never considered current.
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+    os.replace(snapshot_path + '.tmp', snapshot_path)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return snapshot_path
+
+
+class SnapshotBotFactory:
+    """Bot factory which loads the brain snapshot from the data folder if it
+    is present and up to date, and falls back on loading the standard AIML
+    set from source otherwise. Instances are picklable, so they can be used
+    to start process workers."""
+
+    def __init__(self, data_folder: str):
+        self.data_folder = os.path.expanduser(data_folder)
+
+    def __call__(self) -> aiml_bot.Bot:
+        if snapshot_is_current(self.data_folder):
+            return aiml_bot.Bot(brain_file=get_snapshot_path(self.data_folder))
+        return aiml_bot.Bot(commands=STANDARD_COMMANDS)
+
+
+def compare_startup(data_folder: str, repetitions: int = 3) -> dict:
+    """Measure the time taken to construct a bot from the AIML sources and
+    from the snapshot, building the snapshot first if necessary. Return the
+    best time of each, in seconds."""
+    if not snapshot_is_current(data_folder):
+        build_snapshot(data_folder)
+    snapshot_path = get_snapshot_path(data_folder)
+    results = {'source': None, 'snapshot': None}
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        aiml_bot.Bot(commands=STANDARD_COMMANDS, verbose=False)
+        elapsed = time.perf_counter() - start
+        if results['source'] is None or elapsed < results['source']:
+            results['source'] = elapsed
+
+        start = time.perf_counter()
+        aiml_bot.Bot(brain_file=snapshot_path, verbose=False)
+        elapsed = time.perf_counter() - start
+        if results['snapshot'] is None or elapsed < results['snapshot']:
+            results['snapshot'] = elapsed
+    return results
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(prog='python -m aiml_bot_api.brain',
+                                     description="Build or benchmark the precompiled brain snapshot.")
+    parser.add_argument('command', choices=['build', 'compare'])
+    parser.add_argument('data_folder', nargs='?', default=DEFAULT_DATA_FOLDER)
+    parser.add_argument('--repetitions', type=int, default=3, help="Timing repetitions for the compare command.")
+    arguments = parser.parse_args(args)
+
+    if arguments.command == 'build':
+        print("Snapshot written to %s" % build_snapshot(arguments.data_folder))
+    else:
+        results = compare_startup(arguments.data_folder, arguments.repetitions)
+        print("Startup from AIML sources: %.3f seconds" % results['source'])
+        print("Startup from snapshot:     %.3f seconds" % results['snapshot'])
+        if results['snapshot']:
+            print("Speedup:                   %.1fx" % (results['source'] / results['snapshot']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+A bounded cache for open resources, such as the data manager's per-user
+message stores and bot sessions. The cache is limited both in the number of
+entries it holds and in the total (estimated) memory size of the entries.
+Least recently used entries are evicted first, and LRU bookkeeping takes
+constant time.
+
+Evicting an entry may be expensive (closing files, persisting session data),
+so evictions are handed off to a background thread instead of being done on
+the thread which caused them. An entry which is requested again while its
+eviction is still pending is simply reclaimed.
+"""
+
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def _no_lock(key):
+    yield
+
+
+class CacheStats:
+    """Counters describing the behavior of a cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.reclaims = 0  # Hits on entries whose eviction was still pending
+        self.evictions = 0
+
+    def as_dict(self) -> dict:
+        """Return the counters as a dictionary."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reclaims': self.reclaims,
+            'evictions': self.evictions,
+        }
+
+
+class HandleCache:
+    """A bounded LRU cache with background eviction.
+
+    On a miss, load(key) is called to produce the value, which is then
+    cached. When the cache exceeds max_entries entries, or the total size of
+    its entries exceeds max_size, the least recently used entries are
+    scheduled for eviction, and evict(key, value) is eventually called for
+    each of them by the background thread. The size of a new entry is given
+    by sizeof(value), or 0 if sizeof is not provided, and can be updated
+    with resize(). The most recently used entry is never evicted.
+
+    If lock is provided, it must be a function which returns a context
+    manager that excludes all other use of the given key. The background
+    thread holds it while evicting an entry, so callers which hold a lock
+    that it excludes while using an entry (including while calling get())
+    don't have the entry evicted out from under them.
+
+    If several threads miss on the same key at once, only the first loads
+    it, and the others wait for it to be loaded.
+    """
+
+    def __init__(self, load, evict, max_entries: int = 1000, max_size: int = None, sizeof=None, lock=None):
+        if max_entries < 1:
+            raise ValueError(max_entries)
+        self.load = load
+        self.evict = evict
+        self.sizeof = sizeof
+        self.lock = lock or _no_lock
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.stats = CacheStats()
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Key -> value, least recently used first
+        self._sizes = {}  # Key -> size
+        self._total_size = 0
+        self._evicting = {}  # Key -> value, for entries scheduled for eviction
+        self._evicting_sizes = {}  # Key -> size, for entries scheduled for eviction
+        self._eviction_queue = deque()
+        self._eviction_scheduled = threading.Condition(self._lock)
+        self._loading = set()  # Keys currently being loaded
+        self._loaded = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='HandleCache eviction', daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    @property
+    def total_size(self) -> int:
+        """The total size of the cached entries."""
+        return self._total_size
+
+    def get(self, key):
+        """Return the cached value for the key, loading it if necessary."""
+        with self._lock:
+            while key in self._loading:
+                self._loaded.wait()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return self._entries[key]
+            if key in self._evicting:
+                value = self._evicting.pop(key)
+                self._entries[key] = value
+                self._sizes[key] = self._evicting_sizes.pop(key)
+                self._total_size += self._sizes[key]
+                self.stats.hits += 1
+                self.stats.reclaims += 1
+                self._enforce_limits()
+                return value
+            self.stats.misses += 1
+            self._loading.add(key)
+        try:
+            value = self.load(key)
+            size = 0 if self.sizeof is None else self.sizeof(value)
+            with self._lock:
+                self._entries[key] = value
+                self._sizes[key] = size
+                self._total_size += size
+                self._enforce_limits()
+        finally:
+            with self._lock:
+                self._loading.discard(key)
+                self._loaded.notify_all()
+        return value
+
+    def peek(self, key, default=None):
+        """Return the cached value for the key without loading it or
+        affecting its recency. If it isn't cached, return the default."""
+        with self._lock:
+            return self._entries.get(key, default)
+
+    def discard(self, key, default=None):
+        """Remove the entry for the key without evicting it, and return its
+        value, so the caller can dispose of it. If it isn't cached, return
+        the default. The caller must ensure that the entry is not in use."""
+        with self._lock:
+            if key in self._entries:
+                self._total_size -= self._sizes.pop(key, 0)
+                return self._entries.pop(key)
+            if key in self._evicting:
+                del self._evicting_sizes[key]
+                return self._evicting.pop(key)
+            return default
+
+    def resize(self, key, size: int) -> None:
+        """Set the size of a cached entry, evicting other entries if the
+        cache exceeds its size limit as a result."""
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._total_size += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+            self._enforce_limits()
+
+    def _enforce_limits(self) -> None:
+        # Must be called with self._lock held.
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or
+                                          (self.max_size is not None and self._total_size > self.max_size)):
+            key, value = self._entries.popitem(last=False)
+            self._evicting_sizes[key] = self._sizes.pop(key, 0)
+            self._total_size -= self._evicting_sizes[key]
+            self._evicting[key] = value
+            self._eviction_queue.append(key)
+            self._eviction_scheduled.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._eviction_queue and not self._closed:
+                    self._eviction_scheduled.wait()
+                if not self._eviction_queue:
+                    return
+                key = self._eviction_queue.popleft()
+            self._evict_pending(key)
+
+    def _evict_pending(self, key) -> None:
+        with self.lock(key):
+            with self._lock:
+                if key not in self._evicting:
+                    return  # The entry was reclaimed before we got to it.
+                value = self._evicting.pop(key)
+                del self._evicting_sizes[key]
+            # noinspection PyBroadException
+            try:
+                self.evict(key, value)
+            except Exception:
+                log.exception("Error evicting %r from cache:" % (key,))
+            with self._lock:
+                self.stats.evictions += 1
+
+    def close(self) -> None:
+        """Finish all pending evictions and stop the background thread. The
+        remaining entries are left in the cache; see clear()."""
+        with self._lock:
+            self._closed = True
+            self._eviction_scheduled.notify()
+        self._thread.join()
+
+    def clear(self) -> None:
+        """Evict every entry, on the calling thread. The caller must ensure
+        that no entry is in use."""
+        with self._lock:
+            entries = list(self._entries.items()) + list(self._evicting.items())
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_size = 0
+            self._evicting.clear()
+            self._evicting_sizes.clear()
+            self._eviction_queue.clear()
+        for key, value in entries:
+            # noinspection PyBroadException
+            try:
+                self.evict(key, value)
+            except Exception:
+                log.exception("Error evicting %r from cache:" % (key,))
+            self.stats.evictions += 1
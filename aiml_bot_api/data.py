@@ -4,34 +4,145 @@ interface to the user and message data, ensuring consistency, persistence, and
 thread safety.
 """
 
-import datetime
-import hashlib
+import logging
+import math
 import os
-import shelve
+import pickle
 import threading
+import time
+from bisect import bisect_left, bisect_right, insort
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import aiml_bot
 
+from . import metrics
+from .brain import DEFAULT_DATA_FOLDER, SnapshotBotFactory
+from .cache import HandleCache
+from .ids import (ORIGIN_PREFIXES, MessageIdGenerator, format_timestamp, get_id_origin, get_id_timestamp,
+                  is_ordered_id, is_valid_id, make_id, parse_time)
+from .index import MessageIndex
+from .retention import RetentionPolicy, RetentionWorker
+from .search import TokenIndex
+from .sessions import SessionStore
+from .storage import LockedStore, StorageBackend, get_backend
+from .workers import BotPool
+
+
+log = logging.getLogger(__name__)
+
+
+# Lock modes. A lock set is a two-level hierarchy: the set as a whole, and
+# the individual items in it. Items are locked shared (S) or exclusive (X).
+# The set as a whole is locked in the same modes by operations on the entire
+# set, and in the corresponding intention mode (IS or IX) by operations on a
+# single item, so that item operations exclude whole-set operations that
+# conflict with them, but not each other.
+SHARED = 'S'
+EXCLUSIVE = 'X'
+INTENT_SHARED = 'IS'
+INTENT_EXCLUSIVE = 'IX'
+
+# Mode -> the modes it can be held together with.
+_COMPATIBLE_MODES = {
+    INTENT_SHARED: frozenset([INTENT_SHARED, INTENT_EXCLUSIVE, SHARED]),
+    INTENT_EXCLUSIVE: frozenset([INTENT_SHARED, INTENT_EXCLUSIVE]),
+    SHARED: frozenset([INTENT_SHARED, SHARED]),
+    EXCLUSIVE: frozenset(),
+}
+
+_INTENT_MODES = {
+    SHARED: INTENT_SHARED,
+    EXCLUSIVE: INTENT_EXCLUSIVE,
+}
+
+
+class _LockState:
+    """The holders of and waiters for a single lock in a lock set."""
+
+    __slots__ = ['held', 'waiting', 'changed']
+
+    def __init__(self, mutex: threading.Lock):
+        self.held = {}  # Mode -> number of holders
+        self.waiting = deque()  # Requests, in the order they were made
+        self.changed = threading.Condition(mutex)
+
+    def allows(self, mode: str) -> bool:
+        """Whether the lock can be granted in the given mode, given the modes
+        it is currently held in."""
+        compatible = _COMPATIBLE_MODES[mode]
+        return all(held in compatible for held in self.held)
+
+    def is_idle(self) -> bool:
+        """Whether the lock is neither held nor waited for."""
+        return not self.held and not self.waiting
+
 
 class ItemLock:
-    """A lock for a single item in a lock set."""
+    """A lock for a single item in a lock set, in either exclusive or shared
+    mode."""
 
-    def __init__(self, lock_set: 'LockSet', item):
+    def __init__(self, lock_set: 'LockSet', item, mode: str = EXCLUSIVE):
+        if mode not in _INTENT_MODES:
+            raise ValueError(mode)
         self.lock_set = lock_set
         self.item = item
+        self.mode = mode
+        self.acquired_at = None  # When the lock was acquired, if instrumentation is enabled
+
+    def shared(self) -> 'ItemLock':
+        """Return a shared lock for the same item."""
+        return ItemLock(self.lock_set, self.item, SHARED)
 
     def acquire(self):
         """Acquire the lock."""
-        with self.lock_set.per_item_lock:
-            while self.item in self.lock_set.locked_items:
-                self.lock_set.item_unlocked.wait()
-            self.lock_set.locked_items.add(self.item)
+        if metrics.registry.enabled:
+            start = time.perf_counter()
+        self.lock_set.acquire_item(self.item, self.mode)
+        if metrics.registry.enabled:
+            self.acquired_at = time.perf_counter()
+            metrics.LOCK_WAIT_SECONDS.observe(self.acquired_at - start, self.lock_set.name, 'item', self.mode)
 
     def release(self):
         """Release the lock."""
-        with self.lock_set.per_item_lock:
-            self.lock_set.locked_items.remove(self.item)
+        acquired_at, self.acquired_at = self.acquired_at, None
+        self.lock_set.release_item(self.item, self.mode)
+        if acquired_at is not None:
+            metrics.LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired_at, self.lock_set.name, 'item',
+                                              self.mode)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class SharedSetLock:
+    """A shared lock for an entire lock set. It is compatible with other
+    shared locks on the set and with shared locks on its items, but
+    excludes exclusive locks on either."""
+
+    def __init__(self, lock_set: 'LockSet'):
+        self.lock_set = lock_set
+        self.acquired_at = None  # When the lock was acquired, if instrumentation is enabled
+
+    def acquire(self):
+        """Acquire the lock."""
+        if metrics.registry.enabled:
+            start = time.perf_counter()
+        self.lock_set.acquire_set(SHARED)
+        if metrics.registry.enabled:
+            self.acquired_at = time.perf_counter()
+            metrics.LOCK_WAIT_SECONDS.observe(self.acquired_at - start, self.lock_set.name, 'set', SHARED)
+
+    def release(self):
+        """Release the lock."""
+        acquired_at, self.acquired_at = self.acquired_at, None
+        self.lock_set.release_set(SHARED)
+        if acquired_at is not None:
+            metrics.LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired_at, self.lock_set.name, 'set', SHARED)
 
     def __enter__(self):
         self.acquire()
@@ -41,23 +152,113 @@ class ItemLock:
 
 
 class LockSet:
-    """A set of named resource locks."""
+    """A set of named resource locks, with hierarchical reader/writer
+    semantics. The name of the set itself is used to label its lock timings.
 
-    def __init__(self):
-        self.list_lock = threading.Lock()  # For updating the list itself
-        self.per_item_lock = threading.Lock()  # For updating the list of locked items
-        self.item_unlocked = threading.Condition(self.per_item_lock)
-        self.locked_items = set()  # The list of currently locked items
+    Each item can be locked exclusively, with `with lock_set[item]`, or
+    shared, with `with lock_set[item].shared()`. The entire set can be
+    locked exclusively, with `with lock_set`, which waits until no items are
+    locked and keeps any from being locked, or shared, with
+    `with lock_set.shared()`, which only excludes exclusive item locks.
+
+    Requests for each lock are granted in the order they are made, so a
+    stream of readers can't starve a writer: once an exclusive request is
+    waiting, later shared requests queue up behind it. As a consequence,
+    locks are not reentrant; a thread which holds a lock in the set must not
+    request another lock on the same item, or on the set as a whole.
+    """
+
+    def __init__(self, name: str = None):
+        self.name = name
+        self._mutex = threading.Lock()  # Protects the state of every lock in the set
+        self._set_state = _LockState(self._mutex)
+        self._item_states = {}  # Item -> _LockState, for items which are locked or waited for
+        self.acquired_at = None  # When the set was acquired exclusively, if instrumentation is enabled
+
+    @staticmethod
+    def _acquire(state: _LockState, mode: str) -> None:
+        # Must be called with the mutex held.
+        if state.waiting or not state.allows(mode):
+            request = [mode]  # A unique object to mark our place in line
+            state.waiting.append(request)
+            try:
+                while state.waiting[0] is not request or not state.allows(mode):
+                    state.changed.wait()
+            except BaseException:
+                state.waiting.remove(request)
+                state.changed.notify_all()
+                raise
+            state.waiting.popleft()
+            if state.waiting:
+                # The next request in line may be compatible, too.
+                state.changed.notify_all()
+        state.held[mode] = state.held.get(mode, 0) + 1
+
+    @staticmethod
+    def _release(state: _LockState, mode: str) -> None:
+        # Must be called with the mutex held.
+        count = state.held[mode] - 1
+        if count:
+            state.held[mode] = count
+        else:
+            del state.held[mode]
+        if state.waiting:
+            state.changed.notify_all()
+
+    def acquire_set(self, mode: str = EXCLUSIVE) -> None:
+        """Lock the entire set in the given mode."""
+        with self._mutex:
+            self._acquire(self._set_state, mode)
+
+    def release_set(self, mode: str = EXCLUSIVE) -> None:
+        """Unlock the entire set, which was locked in the given mode."""
+        with self._mutex:
+            self._release(self._set_state, mode)
+
+    def acquire_item(self, item, mode: str = EXCLUSIVE) -> None:
+        """Lock an item in the given mode, after locking the set in the
+        corresponding intention mode."""
+        with self._mutex:
+            self._acquire(self._set_state, _INTENT_MODES[mode])
+            state = self._item_states.get(item)
+            if state is None:
+                state = self._item_states[item] = _LockState(self._mutex)
+            try:
+                self._acquire(state, mode)
+            except BaseException:
+                if state.is_idle():
+                    del self._item_states[item]
+                self._release(self._set_state, _INTENT_MODES[mode])
+                raise
+
+    def release_item(self, item, mode: str = EXCLUSIVE) -> None:
+        """Unlock an item, which was locked in the given mode."""
+        with self._mutex:
+            state = self._item_states[item]
+            self._release(state, mode)
+            if state.is_idle():
+                del self._item_states[item]
+            self._release(self._set_state, _INTENT_MODES[mode])
 
     def acquire(self):
-        """Acquire the entire set of locks."""
-        self.list_lock.acquire()
-        while self.locked_items:
-            self.item_unlocked.wait()
+        """Acquire the entire set of locks exclusively."""
+        if metrics.registry.enabled:
+            start = time.perf_counter()
+        self.acquire_set(EXCLUSIVE)
+        if metrics.registry.enabled:
+            self.acquired_at = time.perf_counter()
+            metrics.LOCK_WAIT_SECONDS.observe(self.acquired_at - start, self.name, 'set', EXCLUSIVE)
 
     def release(self):
         """Release the entire set of locks."""
-        self.list_lock.release()
+        acquired_at, self.acquired_at = self.acquired_at, None
+        self.release_set(EXCLUSIVE)
+        if acquired_at is not None:
+            metrics.LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired_at, self.name, 'set', EXCLUSIVE)
+
+    def shared(self) -> SharedSetLock:
+        """Return a shared lock for the entire set."""
+        return SharedSetLock(self)
 
     def __getitem__(self, item):
         return ItemLock(self, item)
@@ -69,36 +270,190 @@ class LockSet:
         self.release()
 
 
+class ChangeCounter:
+    """Counts changes to resources, to validate cached copies of them and to
+    notify listeners when they change. The counts are kept in memory, and
+    each tag includes the time the counter was created, so tags handed out
+    before a restart never match those handed out after it."""
+
+    def __init__(self):
+        self.created = time.time()
+        self._epoch = '%x' % int(self.created * 1000000)
+        self._lock = threading.Lock()
+        self._changes = {}  # Key -> (number of changes, time of last change)
+        self._listeners = {}  # Key -> set of functions to call on each change
+
+    def touch(self, key=None) -> None:
+        """Record a change to the resource with the given key, and call its
+        listeners."""
+        with self._lock:
+            count, _ = self._changes.get(key, (0, None))
+            self._changes[key] = (count + 1, time.time())
+            listeners = list(self._listeners.get(key, ()))
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, key, listener) -> None:
+        """Register a function to be called, with no arguments, whenever the
+        resource with the given key changes. It is called on the thread
+        making the change, possibly with locks held, so it must return
+        quickly and must not call back into the data manager."""
+        with self._lock:
+            self._listeners.setdefault(key, set()).add(listener)
+
+    def remove_listener(self, key, listener) -> None:
+        """Unregister a function registered with add_listener()."""
+        with self._lock:
+            listeners = self._listeners.get(key)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[key]
+
+    def wait(self, key, tag: str, timeout: float = None) -> bool:
+        """Wait until the tag of the resource with the given key is no longer
+        the one given, or until the timeout expires. Return whether the
+        resource changed."""
+        changed = threading.Event()
+        self.add_listener(key, changed.set)
+        try:
+            if self.get(key)[0] != tag:
+                return True
+            return changed.wait(timeout)
+        finally:
+            self.remove_listener(key, changed.set)
+
+    def get(self, key=None) -> (str, float):
+        """Return a tuple (tag, modified) for the resource with the given
+        key, where the tag changes whenever the resource does, and modified
+        is the time of the last change, or the time the counter was created
+        if there have been none since."""
+        with self._lock:
+            count, modified = self._changes.get(key, (0, self.created))
+        return '%s-%d' % (self._epoch, count), modified
+
+
+class UserMessages:
+    """The cached state of a user whose messages are in use: the open
+    message store, the indexes over it, the user's message archive, and the
+    estimated size of the user's bot session."""
+
+    def __init__(self, messages_db, message_index: MessageIndex, session_size: int = 0):
+        self.messages_db = messages_db
+        self.message_index = message_index
+        self.token_index = None  # Built on demand, on the first search
+        self.archive = None
+        self.session_size = session_size
+
+
 class DataManager:
     """The DataManager handles the storage of conversational data and
     triggering of the bot on behalf of the endpoints. It is designed to be
-    thread-safe."""
+    thread-safe.
+
+    Bot responses are computed by a pool of bot workers. Each user is pinned
+    to a single worker, so that user's session is always handled by the same
+    bot, while users pinned to different workers are answered in parallel.
+    If a bot is provided, it is used as the sole worker. Otherwise, the
+    given number of workers is started, each with a bot constructed by
+    bot_factory. By default, bots are loaded from the precompiled brain
+    snapshot in the data folder if it is up to date, or from the standard
+    AIML set otherwise; see the brain module. The worker_mode determines
+    whether workers are run as threads or as separate processes.
+
+    Data is persisted in the data folder by a storage backend, which can be
+    given either by name ('shelve', the default, 'log', or 'sqlite') or as a
+    StorageBackend instance; see the storage module.
+
+    The message stores and bot sessions of recently active users are kept
+    open in a cache, which holds at most max_cached_users users and, if
+    max_session_memory is given, at most that many bytes of (pickled)
+    session data. Closing a user's store and persisting their session when
+    they are evicted from the cache is done in the background.
+
+    Session changes are persisted write-behind: they are flushed to storage
+    in batches by a background thread, every session_flush_interval seconds
+    or as soon as session_flush_threshold sessions have changed. A crash
+    loses at most one flush interval of session changes; see the sessions
+    module.
+
+    If response_cache_size is given, the bot workers cache up to that many
+    responses each, and reuse them for inputs that would get the same
+    response; see the responses module.
+
+    If a retention policy is given, it is applied periodically in the
+    background, moving old messages out of the live message stores into
+    compressed archives, where they can still be read by ID; see the
+    retention module."""
 
-    def __init__(self, bot: aiml_bot.Bot = None, data_folder: str = None):
+    def __init__(self, bot: aiml_bot.Bot = None, data_folder: str = None, workers: int = 1,
+                 worker_mode: str = 'thread', bot_factory=None, storage='shelve', max_cached_users: int = 1000,
+                 max_session_memory: int = None, session_flush_interval: float = 1.0,
+                 session_flush_threshold: int = 100, response_cache_size: int = None,
+                 retention: RetentionPolicy = None):
+        self.closed = True  # Until initialization is complete, so close() has nothing to do if it fails
         if data_folder is None:
-            data_folder = os.path.expanduser('~/aiml_bot_api')
+            data_folder = os.path.expanduser(DEFAULT_DATA_FOLDER)
         if not os.path.isdir(data_folder):
             os.makedirs(data_folder)
-        if not os.path.isdir(os.path.join(data_folder, 'messages')):
-            os.makedirs(os.path.join(data_folder, 'messages'))
 
         self.data_folder = data_folder
+        self.storage = get_backend(storage, data_folder)  # type: StorageBackend
 
-        self.users = shelve.open(os.path.join(data_folder, 'users.db'))
-        self.user_sessions = shelve.open(os.path.join(data_folder, 'user_sessions.db'))
+        # Operations on different users don't exclude each other, so access
+        # to the users store, which they share, is serialized by the store.
+        self.users = LockedStore(metrics.instrument_store(self.storage.open_users(), 'users'))
+        # User ID -> (oldest time, count) of the live messages of each user
+        # who isn't cached, written when the user is evicted and dropped when
+        # the user is loaded again, so the retention policy can check users
+        # without loading them. Messages only change while their user is
+        # cached, so a summary which exists is current; one which was dropped
+        # before a crash is written again the next time the user is evicted.
+        self.message_stats = LockedStore(metrics.instrument_store(self.storage.open_message_stats(),
+                                                                  'message_stats'))
+        self.user_sessions = SessionStore(metrics.instrument_store(self.storage.open_sessions(), 'sessions'),
+                                          os.path.join(data_folder, 'user_sessions.journal'),
+                                          session_flush_interval, session_flush_threshold)
+        self.sorted_user_ids = sorted(self.users)
+        self.sorted_user_ids_lock = threading.Lock()  # For concurrent additions to the sorted list
 
-        self.user_message_cache = {}
-        self.user_message_lru = deque()
-        self.max_cached_users = 1000
+        # Listing users takes the user set lock shared, while adding a user
+        # or changing a user's name locks that user exclusively. Operations
+        # on a user's messages lock the user shared, which keeps the user
+        # from being evicted from the user cache, and lock the user's
+        # messages shared to read them or exclusively to add to them.
+        self.user_locks = LockSet('user')
+        self.message_locks = LockSet('message')
 
-        self.user_locks = LockSet()
-        self.message_locks = LockSet()
-        self.sessions_lock = threading.Lock()
-        self.bot_lock = threading.Lock()
+        # Changes to the users, as a whole, and to each user's messages.
+        self.user_changes = ChangeCounter()
+        self.message_changes = ChangeCounter()
 
-        if bot is None:
-            bot = aiml_bot.Bot(commands="load std aiml")
-        self.bot = bot
+        self.user_cache = HandleCache(self._load_user_messages, self._evict_user_messages, max_cached_users,
+                                      max_session_memory, sizeof=lambda user_messages: user_messages.session_size,
+                                      lock=self._lock_user)
+
+        self.message_ids = MessageIdGenerator()
+
+        if bot is None and bot_factory is None:
+            bot_factory = SnapshotBotFactory(data_folder)
+        self.bot_pool = BotPool(bot_factory, workers, worker_mode, bot, response_cache_size)
+
+        # The threads which add messages in bulk, one per bot worker, and
+        # which import messages, one per bot worker, so that each user's
+        # batches are always imported by the same thread, in order. They are
+        # kept for the life of the data manager, since each thread holds a
+        # connection with some storage backends.
+        self._adders = ThreadPoolExecutor(len(self.bot_pool), thread_name_prefix='add_messages')
+        self._importers = [ThreadPoolExecutor(1, thread_name_prefix='import') for _ in range(len(self.bot_pool))]
+
+        self.retention = retention
+        self.retention_worker = None if retention is None else RetentionWorker(self, retention)
+
+        if metrics.registry.enabled:
+            metrics.registry.add_collector(self.collect_metrics)
+
+        self.closed = False
 
     def __del__(self) -> None:
         self.close()
@@ -107,31 +462,72 @@ class DataManager:
         """Close all resources held by the data manager in a clean and safe
         manner. Once this has been called, the data manager will no longer be
         in a usable state."""
+        if self.closed:
+            return
+        self.closed = True
+        metrics.registry.remove_collector(self.collect_metrics)
+        if self.retention_worker is not None:
+            self.retention_worker.stop()
+        self._adders.shutdown()
+        for importer in self._importers:
+            importer.shutdown()
+        # Pending evictions need the user locks, so they must be finished
+        # before the locks are acquired.
+        self.user_cache.close()
         self.user_locks.acquire()
         self.message_locks.acquire()
-        self.sessions_lock.acquire()
-        self.bot_lock.acquire()
 
+        self.user_cache.clear()
+        self.bot_pool.close()
         self.users.close()
+        self.message_stats.close()
         self.user_sessions.close()
-        for messages_db in self.user_message_cache.values():
-            messages_db.close()
+        self.storage.close()
 
     def get_user_ids(self) -> list:
-        """Return a list of user IDs."""
-        with self.user_locks:
-            return list(self.users)
+        """Return a list of user IDs, in sorted order."""
+        with self.user_locks.shared():
+            return list(self.sorted_user_ids)
+
+    def get_user_page(self, after: str = None, limit: int = None) -> (list, str):
+        """Return a page of up to limit user IDs, in sorted order, starting
+        after the given user ID (or from the beginning, if after is None).
+        A tuple (user_ids, next_cursor) is returned, where next_cursor is the
+        value of after for the following page, or None if this is the last
+        page."""
+        with self.user_locks.shared():
+            start = 0 if after is None else bisect_right(self.sorted_user_ids, after)
+            end = len(self.sorted_user_ids) if limit is None else min(start + limit, len(self.sorted_user_ids))
+            user_ids = self.sorted_user_ids[start:end]
+            next_cursor = user_ids[-1] if user_ids and end < len(self.sorted_user_ids) else None
+            return user_ids, next_cursor
+
+    def iter_users(self, batch_size: int = 100):
+        """Yield the data of each user, in sorted order of user ID. Users are
+        read in batches, taking the user locks once per batch, and the locks
+        are not held while the caller processes the users. Users added after
+        iteration begins are not included."""
+        user_ids = self.get_user_ids()
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            users = self.get_users_bulk(batch)
+            for user_id in batch:
+                if user_id in users:
+                    yield users[user_id]
 
     def add_user(self, user_id: str, user_name: str) -> None:
         """Add a new user. The user id must be new. Otherwise a KeyError is
         raised."""
-        with self.user_locks, self.user_locks[user_id]:
+        with self.user_locks[user_id]:
             if user_id in self.users:
                 raise KeyError(user_id)
             self.users[user_id] = {
                 'id': user_id,
                 'name': user_name,
             }
+            with self.sorted_user_ids_lock:
+                insort(self.sorted_user_ids, user_id)
+            self.user_changes.touch()
 
     def set_user_name(self, user_id: str, user_name: str) -> None:
         """Set the user's name to a new value. The user ID must already exist.
@@ -144,42 +540,323 @@ class DataManager:
             user_data = self.users[user_id]
             user_data['name'] = user_name
             self.users[user_id] = user_data
+            self.user_changes.touch()
 
     def get_user_data(self, user_id: str) -> dict:
         """Return the data associated with a given user ID. If no such user ID
         exists, raise a KeyError."""
-        with self.user_locks[user_id]:
+        with self.user_locks[user_id].shared():
             return self.users[user_id]
 
-    def _get_messages(self, user_id: str) -> dict:
-        if user_id in self.user_message_cache:
-            messages_db = self.user_message_cache[user_id]
-            self.user_message_lru.remove(user_id)
-        else:
-            if len(self.user_message_cache) >= self.max_cached_users:
-                lru = self.user_message_lru.popleft()
-                self.user_message_cache.pop(lru).close()
-                with self.bot_lock:
-                    session_data = self.bot.get_session_data(lru)
-                with self.sessions_lock:
-                    self.user_sessions[lru] = session_data
-                with self.bot_lock:
-                    self.bot.delete_session(lru)
-            messages_db = shelve.open(os.path.join(self.data_folder, 'messages', user_id + '.db'))
-            with self.sessions_lock:
-                session_data = self.user_sessions.get(user_id, {})
-            with self.bot_lock:
-                self.bot.set_session_data(session_data, user_id)
-            self.user_message_lru.append(user_id)
-        return messages_db
+    def get_users_version(self) -> (str, float):
+        """Return a tuple (tag, modified) describing the current state of the
+        users and their data, where the tag changes whenever a user is added
+        or changed, and modified is the time of the last such change (or of
+        the data manager's creation). No storage is accessed."""
+        return self.user_changes.get()
+
+    def get_users_bulk(self, user_ids) -> dict:
+        """Return a dictionary mapping each of the given user IDs to the
+        user's data. User IDs which don't exist are omitted. The user locks
+        are acquired only once for the entire batch."""
+        with self.user_locks.shared():
+            return {user_id: self.users[user_id] for user_id in user_ids if user_id in self.users}
+
+    @contextmanager
+    def _lock_user(self, user_id: str):
+        with self.user_locks[user_id], self.message_locks[user_id]:
+            yield
+
+    def _load_user_messages(self, user_id: str) -> UserMessages:
+        self.message_stats.pop(user_id, None)
+        with metrics.timed(metrics.STORAGE_SECONDS, 'messages', 'open'):
+            messages_db = metrics.instrument_store(self.storage.open_messages(user_id), 'messages')
+        session_data = self.user_sessions.get(user_id, {})
+        self.bot_pool.set_session_data(user_id, session_data)
+        # Messages archived from a store which hasn't been compacted since
+        # are still in it, but are no longer live.
+        archive = self.storage.open_archive(user_id)
+        user_messages = UserMessages(messages_db, MessageIndex.build(messages_db, archive),
+                                     len(pickle.dumps(session_data, pickle.HIGHEST_PROTOCOL)))
+        user_messages.archive = archive
+        return user_messages
+
+    def _evict_user_messages(self, user_id: str, user_messages: UserMessages) -> None:
+        user_messages.messages_db.close()
+        session_data = self.bot_pool.get_session_data(user_id)
+        self.user_sessions[user_id] = session_data
+        self.bot_pool.delete_session(user_id)
+        message_index = user_messages.message_index
+        self.message_stats[user_id] = (message_index.times[0] if len(message_index) else None, len(message_index))
+
+    def _get_user_messages(self, user_id: str) -> UserMessages:
+        # The caller must hold the user's locks.
+        return self.user_cache.get(user_id)
+
+    def _get_token_index(self, user_messages: UserMessages) -> TokenIndex:
+        if user_messages.token_index is None:
+            messages_db = user_messages.messages_db
+            user_messages.token_index = TokenIndex.build(messages_db[message_id]
+                                                         for message_id in user_messages.message_index.ids)
+        return user_messages.token_index
+
+    def get_cache_stats(self) -> dict:
+        """Return the hit, miss, and eviction counters of the user cache,
+        along with the number of cached users and their total estimated
+        session size in bytes."""
+        stats = self.user_cache.stats.as_dict()
+        stats['users'] = len(self.user_cache)
+        stats['session_bytes'] = self.user_cache.total_size
+        return stats
+
+    def get_response_cache_stats(self) -> dict:
+        """Return the hit, miss, and eviction counters of the bots' response
+        caches, along with the number of cached responses, or None if
+        response caching is disabled."""
+        return self.bot_pool.get_response_cache_stats()
+
+    def collect_metrics(self) -> list:
+        """Return the data manager's cache counters and other state, as
+        samples for the metrics registry."""
+        user_cache = self.get_cache_stats()
+        samples = [
+            ('aiml_bot_api_user_cache_events_total', 'counter', "User cache lookups and evictions, by outcome.",
+             [({'event': event}, user_cache[event]) for event in ('hits', 'misses', 'reclaims', 'evictions')]),
+            ('aiml_bot_api_user_cache_users', 'gauge', "Users in the user cache.", [({}, user_cache['users'])]),
+            ('aiml_bot_api_user_cache_session_bytes', 'gauge', "Estimated size of the cached sessions.",
+             [({}, user_cache['session_bytes'])]),
+            ('aiml_bot_api_sessions_dirty', 'gauge', "Sessions with changes not yet flushed to storage.",
+             [({}, self.user_sessions.dirty_count)]),
+        ]
+        response_cache = self.get_response_cache_stats()
+        if response_cache is not None:
+            samples.append(('aiml_bot_api_response_cache_events_total', 'counter',
+                            "Response cache lookups and evictions, by outcome.",
+                            [({'event': event}, response_cache[event])
+                             for event in ('hits', 'misses', 'uncacheable', 'evictions')]))
+            samples.append(('aiml_bot_api_response_cache_responses', 'gauge', "Responses in the response caches.",
+                            [({}, response_cache['size'])]))
+        return samples
+
+    def get_messages_version(self, user_id: str) -> (str, float):
+        """Return a tuple (tag, modified) describing the current state of the
+        given user's messages, where the tag changes whenever a message is
+        added, and modified is the time of the last such change (or of the
+        data manager's creation). No storage is accessed, and the user's
+        existence is not checked."""
+        return self.message_changes.get(user_id)
 
     def get_message_ids(self, user_id: str) -> list:
-        """Return the list of message IDs for the given user."""
-        with self.user_locks[user_id]:
+        """Return the list of message IDs for the given user, in
+        chronological order. If the user does not exist, a KeyError is
+        raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                return list(self._get_user_messages(user_id).message_index.ids)
+
+    def get_message_page(self, user_id: str, after: str = None, limit: int = None, search: str = None) -> (list, str):
+        """Return a page of up to limit message IDs for the given user, in
+        chronological order, starting after the given message ID (or from
+        the beginning, if after is None). If a search query is given, only
+        messages matching it are listed; see search_message_ids(). A tuple
+        (message_ids, next_cursor) is returned, where next_cursor is the
+        value of after for the following page, or None if this is the last
+        page. If the user does not exist, a KeyError is raised. If the
+        cursor is not a valid message ID, a ValueError is raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                message_index = user_messages.message_index
+                if search is None:
+                    return message_index.page(after, limit)
+                matches = message_index.sort(self._get_token_index(user_messages).search(search))
+                return message_index.page(after, limit, matches)
+
+    def search_message_ids(self, user_id: str, query: str) -> list:
+        """Return the IDs of the given user's messages which match the
+        search query, in chronological order. Each whitespace-separated
+        term of the query must match a word of the message's content,
+        ignoring case. Terms ending in '*' match words with that prefix.
+        The query is answered from the user's token index, which is built
+        the first time the user's messages are searched. If the user does
+        not exist, a KeyError is raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                matches = self._get_token_index(user_messages).search(query)
+                return user_messages.message_index.sort(matches)
+
+    def get_messages_bulk(self, user_id: str, message_ids) -> dict:
+        """Return a dictionary mapping each of the given message IDs to the
+        message's data, whether the message is live or archived. Message IDs
+        which don't exist are omitted. The user's locks are acquired only
+        once for the entire batch. If the user does not exist, a KeyError is
+        raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                messages_db = user_messages.messages_db
+                messages = {}
+                missing = []
+                for message_id in message_ids:
+                    if message_id in messages_db:
+                        messages[message_id] = messages_db[message_id]
+                    else:
+                        missing.append(message_id)
+                if missing:
+                    archive = user_messages.archive
+                    for message_id in missing:
+                        if message_id in archive:
+                            messages[message_id] = archive[message_id]
+                return messages
+
+    def iter_messages(self, user_id: str, after: float = None, before: float = None, batch_size: int = 100):
+        """Yield the data of each of the given user's messages with a time
+        between after and before, inclusive, in chronological order. Times
+        are given as floats, as for find_message_ids(). Messages are read
+        in batches, taking the user's locks once per batch, and the locks
+        are not held while the caller processes the messages. Messages added
+        after iteration begins may be left out. If the user does not exist,
+        a KeyError is raised when iteration begins. If the storage backend
+        indexes messages by time, each batch is read from its index with a
+        single range query."""
+        if self.storage.indexes_message_times:
+            yield from self._iter_messages_by_time(user_id, after, before, batch_size)
+            return
+        message_ids = self.find_message_ids(user_id, after=after, before=before)
+        for start in range(0, len(message_ids), batch_size):
+            batch = message_ids[start:start + batch_size]
+            messages = self.get_messages_bulk(user_id, batch)
+            for message_id in batch:
+                if message_id in messages:
+                    yield messages[message_id]
+
+    def _iter_messages_by_time(self, user_id: str, after: float, before: float, batch_size: int):
+        # The range query's bounds are whole seconds, which bracket the float
+        # bounds, so the exact bounds are applied to the messages it returns.
+        start = None if after is None else '%014d' % math.floor(after)
+        end = None if before is None else '%014d' % (math.floor(before) + 1)
+        last = None
+        while True:
+            with self.user_locks[user_id].shared():
+                if user_id not in self.users:
+                    raise KeyError(user_id)
+                with self.message_locks[user_id].shared():
+                    message_index = self._get_user_messages(user_id).message_index
+                    batch = self.storage.read_messages_by_time(user_id, start, end, last, batch_size)
+                    # Rows left behind by an interrupted archiving pass are
+                    # not in the index, and are skipped.
+                    live = [message_data for message_data in batch if message_data['id'] in message_index]
+            for message_data in live:
+                message_time = float(message_data['time'])
+                if (after is None or message_time >= after) and (before is None or message_time <= before):
+                    yield message_data
+            if len(batch) < batch_size:
+                return
+            last = (batch[-1]['time'], batch[-1]['id'])
+
+    def iter_all_messages(self, after: float = None, before: float = None, batch_size: int = 100):
+        """Yield a tuple (user_data, messages) for each user, in sorted order
+        of user ID, where messages is an iterator over the data of the user's
+        messages with a time between after and before, inclusive, as for
+        iter_messages(). Messages are only read as they are consumed."""
+        for user_data in self.iter_users(batch_size):
+            yield user_data, self.iter_messages(user_data['id'], after, before, batch_size)
+
+    def get_messages_after(self, user_id: str, after: str = None, limit: int = None) -> (list, str):
+        """Return the data of up to limit of the given user's messages
+        following the message ID after (or from the beginning, if after is
+        None), in chronological order. A tuple (messages, cursor) is
+        returned, where cursor is the ID of the last message returned, or
+        after if there were none. If the user does not exist, a KeyError is
+        raised. If the cursor is not a valid message ID, a ValueError is
+        raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                message_ids, _ = user_messages.message_index.page(after, limit)
+                messages = [user_messages.messages_db[message_id] for message_id in message_ids]
+        return messages, message_ids[-1] if message_ids else after
+
+    def get_last_message_id(self, user_id: str) -> str:
+        """Return the ID of the given user's most recent message, or None if
+        the user has no messages. If the user does not exist, a KeyError is
+        raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                message_ids = self._get_user_messages(user_id).message_index.ids
+                return message_ids[-1] if message_ids else None
+
+    def wait_for_messages(self, user_id: str, after: str = None, limit: int = None,
+                          timeout: float = None) -> (list, str):
+        """Like get_messages_after(), but if there are no messages following
+        the cursor yet, wait up to timeout seconds (or indefinitely, if
+        timeout is None) for some to be added. No locks are held, and no
+        storage is accessed, while waiting. If the timeout expires, an empty
+        list of messages is returned, along with the cursor."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # The version is taken first, so a message added after it is
+            # either returned or wakes us up.
+            tag, _ = self.get_messages_version(user_id)
+            messages, cursor = self.get_messages_after(user_id, after, limit)
+            if messages:
+                return messages, cursor
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return messages, cursor
+            self.message_changes.wait(user_id, tag, remaining)
+
+    def add_message_listener(self, user_id: str, listener) -> None:
+        """Register a function to be called, with no arguments, whenever
+        messages are added for the given user. It is called on the thread
+        adding the messages, with the user's locks held, so it must return
+        quickly and must not call back into the data manager; typically it
+        just wakes up another thread or task."""
+        self.message_changes.add_listener(user_id, listener)
+
+    def remove_message_listener(self, user_id: str, listener) -> None:
+        """Unregister a function registered with add_message_listener()."""
+        self.message_changes.remove_listener(user_id, listener)
+
+    def find_message_ids(self, user_id: str, origin: str = None, after: float = None,
+                         before: float = None) -> list:
+        """Return the IDs of the given user's messages which have the given
+        origin and a time between after and before, inclusive, in
+        chronological order. Times are given as floats, as returned by
+        float(time_string). The query is answered from the user's message
+        index, without loading any messages. If the user does not exist, a
+        KeyError is raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                return self._get_user_messages(user_id).message_index.select(origin, after, before)
+
+    def rebuild_index(self, user_id: str) -> None:
+        """Rebuild the given user's message index from storage, leaving out
+        archived messages which are still in the store because it hasn't
+        been compacted since. If the user does not exist, a KeyError is
+        raised."""
+        with self.user_locks[user_id].shared():
             if user_id not in self.users:
                 raise KeyError(user_id)
             with self.message_locks[user_id]:
-                return list(self._get_messages(user_id))
+                user_messages = self._get_user_messages(user_id)
+                user_messages.message_index = MessageIndex.build(user_messages.messages_db, user_messages.archive)
+                user_messages.token_index = None
 
     def add_message(self, user_id: str, content: str) -> (str, str):
         """Add a new incoming message from the user. The bot is given the
@@ -189,46 +866,460 @@ class DataManager:
         id2 is the message ID of the bot's reply. Otherwise, None is returned
         for the value of id2. If the user does not exist, a KeyError is raised.
         """
-        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S.%f')
-        message_id = 'c' + hashlib.sha256(timestamp.encode()).hexdigest()
-        with self.user_locks[user_id]:
+        with self.user_locks[user_id].shared(), self.message_locks[user_id]:
             if user_id not in self.users:
                 raise KeyError(user_id)
-            with self.message_locks[user_id]:
-                messages_db = self._get_messages(user_id)
-                messages_db[message_id] = {
+            return self._add_message(user_id, content)
+
+    def add_messages(self, messages) -> list:
+        """Add several new incoming messages at once, given as a sequence of
+        (user_id, content) pairs. Each message is handled as by
+        add_message(). Each user's messages are added in the order given,
+        taking the user's lock only once, while the messages of different
+        users are added concurrently. A list is returned with an entry for
+        each message, in the order given: the tuple (id1, id2) that
+        add_message() would have returned, or None if the user does not
+        exist."""
+        positions = {}  # User ID -> positions of the user's messages
+        for position, (user_id, _) in enumerate(messages):
+            positions.setdefault(user_id, []).append(position)
+        results = [None] * len(messages)
+
+        def add_user_messages(user_id: str) -> None:
+            with self.user_locks[user_id].shared(), self.message_locks[user_id]:
+                if user_id not in self.users:
+                    return
+                for position in positions[user_id]:
+                    results[position] = self._add_message(user_id, messages[position][1])
+
+        for future in [self._adders.submit(add_user_messages, user_id) for user_id in positions]:
+            future.result()
+        return results
+
+    def _add_message(self, user_id: str, content: str) -> (str, str):
+        # The caller must hold the user's lock, shared, and the user's
+        # message lock, exclusively, and check that the user exists. The
+        # message lock is held until the bot's response is added, so each
+        # user's messages and responses are added in order.
+        user_messages = self._get_user_messages(user_id)
+        message_id, timestamp = self.message_ids.new_id('client')
+        user_messages.messages_db[message_id] = {
+            'id': message_id,
+            'origin': 'client',
+            'content': content,
+            'time': timestamp,
+        }
+        user_messages.message_index.add(message_id, timestamp, 'client')
+        if user_messages.token_index is not None:
+            user_messages.token_index.add(message_id, content)
+        self.message_changes.touch(user_id)
+        with metrics.timed(metrics.BOT_RESPONSE_SECONDS):
+            response, session_data = self.bot_pool.respond(user_id, content)
+        self.user_sessions[user_id] = session_data
+        user_messages.session_size = len(pickle.dumps(session_data, pickle.HIGHEST_PROTOCOL))
+        self.user_cache.resize(user_id, user_messages.session_size)
+        log.debug("Response to %r: %r", user_id, response)
+        if response:
+            response_id, timestamp = self.message_ids.new_id('server')
+            user_messages.messages_db[response_id] = {
+                'id': response_id,
+                'origin': 'server',
+                'content': response,
+                'time': timestamp,
+            }
+            user_messages.message_index.add(response_id, timestamp, 'server')
+            if user_messages.token_index is not None:
+                user_messages.token_index.add(response_id, response)
+            self.message_changes.touch(user_id)
+        else:
+            response_id = None
+        return message_id, response_id
+
+    def import_messages(self, messages, replay: bool = False, batch_size: int = 100) -> dict:
+        """Import messages in bulk. The messages are given as an iterable of
+        (user_id, message_data) pairs, where the message data has the
+        message's content and, optionally, its origin ('client' by default),
+        time, and ID, as in the data returned by get_message_data(). Messages
+        without a time are given the time encoded in their ID or, failing
+        that, the current time, and messages without an ID are given a new
+        one. Messages whose IDs already exist are skipped, so importing the
+        same messages twice is harmless.
+
+        Messages are written in batches of up to batch_size messages per
+        user, taking the user's locks once per batch. If replay is set, the
+        content of each imported client message is also run through the bot,
+        to rebuild the user's session. Each user's messages are written and
+        replayed in order, while users pinned to different bot workers are
+        imported in parallel. The bot's replies are discarded, since the
+        imported messages already include the replies that were given.
+
+        A summary of the import is returned, as a dictionary with these
+        counts:
+
+        * users: The number of users with messages to import.
+        * imported: The number of messages imported.
+        * duplicates: The number of messages skipped because their IDs
+          already existed.
+        * replayed: The number of messages run through the bot.
+        * rejected: The number of messages which were malformed, including
+          those with IDs that are malformed or that don't match the
+          message's origin and time, or were for users that don't exist.
+        """
+        summary = {'users': 0, 'imported': 0, 'duplicates': 0, 'replayed': 0, 'rejected': 0}
+        summary_lock = threading.Lock()
+        # Each user's batches always go to the same importer, so they are
+        # imported in order.
+        in_flight = threading.BoundedSemaphore(2 * len(self._importers))
+        pending = deque()  # Futures for the submitted batches, oldest first
+        batches = {}
+        seen_users = set()
+
+        def import_batch(user_id: str, batch: list) -> None:
+            # noinspection PyBroadException
+            try:
+                counts = self._import_batch(user_id, batch, replay)
+            except Exception:
+                log.exception("Error importing messages for %r:" % user_id)
+                counts = {'rejected': len(batch)}
+            finally:
+                in_flight.release()
+            with summary_lock:
+                for key, count in counts.items():
+                    summary[key] += count
+
+        def submit(user_id: str) -> None:
+            importer = self._importers[self.bot_pool.worker_index(user_id)]
+            in_flight.acquire()
+            try:
+                future = importer.submit(import_batch, user_id, batches.pop(user_id))
+            except BaseException:
+                in_flight.release()  # The batch will never be imported to release it.
+                raise
+            pending.append(future)
+            while pending and pending[0].done():
+                pending.popleft()
+
+        try:
+            for user_id, message_data in messages:
+                if user_id not in seen_users:
+                    seen_users.add(user_id)
+                    summary['users'] += 1
+                batch = batches.setdefault(user_id, [])
+                batch.append(message_data)
+                if len(batch) >= batch_size:
+                    submit(user_id)
+            for user_id in list(batches):
+                submit(user_id)
+        finally:
+            for future in pending:
+                future.result()
+        return summary
+
+    @staticmethod
+    def _validate_imported_message(message_data) -> bool:
+        if not (isinstance(message_data, dict) and isinstance(message_data.get('content'), str) and
+                message_data['content'].strip() and message_data.get('origin', 'client') in ORIGIN_PREFIXES and
+                isinstance(message_data.get('id', ''), str) and
+                not message_data.keys() - {'id', 'origin', 'content', 'time'}):
+            return False
+        timestamp = None
+        if 'time' in message_data:
+            try:
+                timestamp = parse_time(message_data['time'])
+            except (TypeError, ValueError):
+                return False
+        message_id = message_data.get('id')
+        if message_id:
+            # The message's origin and time are read back from its ID when
+            # the index is rebuilt, so they have to agree with it.
+            if not is_valid_id(message_id) or get_id_origin(message_id) != message_data.get('origin', 'client'):
+                return False
+            if timestamp is not None and is_ordered_id(message_id) and get_id_timestamp(message_id) != timestamp:
+                return False
+        return True
+
+    def _import_batch(self, user_id: str, batch: list, replay: bool) -> dict:
+        counts = {'imported': 0, 'duplicates': 0, 'replayed': 0, 'rejected': 0}
+        with self.user_locks[user_id].shared(), self.message_locks[user_id]:
+            if user_id not in self.users:
+                counts['rejected'] = len(batch)
+                return counts
+            to_replay = []
+            user_messages = self._get_user_messages(user_id)
+            archive = user_messages.archive
+            for message_data in batch:
+                if not self._validate_imported_message(message_data):
+                    counts['rejected'] += 1
+                    continue
+                origin = message_data.get('origin', 'client')
+                content = message_data['content'].strip()
+                message_id = message_data.get('id')
+                if 'time' in message_data:
+                    message_time = message_data['time']
+                    message_id = message_id or make_id(origin, parse_time(message_time))
+                elif message_id and is_ordered_id(message_id):
+                    message_time = format_timestamp(get_id_timestamp(message_id))
+                else:
+                    new_id, message_time = self.message_ids.new_id(origin)
+                    message_id = message_id or new_id
+                if message_id in user_messages.message_index.id_keys or message_id in archive:
+                    counts['duplicates'] += 1
+                    continue
+                user_messages.messages_db[message_id] = {
                     'id': message_id,
-                    'origin': 'client',
+                    'origin': origin,
                     'content': content,
-                    'time': timestamp,
+                    'time': message_time,
                 }
-            with self.bot_lock:
-                response = self.bot.respond(content, user_id)
-                session_data = self.bot.get_session_data(user_id)
-            with self.sessions_lock:
+                user_messages.message_index.add(message_id, message_time, origin)
+                if user_messages.token_index is not None:
+                    user_messages.token_index.add(message_id, content)
+                counts['imported'] += 1
+                if replay and origin == 'client':
+                    to_replay.append(content)
+            if counts['imported']:
+                self.message_changes.touch(user_id)
+            if to_replay:
+                session_data = None
+                for content in to_replay:
+                    with metrics.timed(metrics.BOT_RESPONSE_SECONDS):
+                        _, session_data = self.bot_pool.respond(user_id, content)
+                    counts['replayed'] += 1
                 self.user_sessions[user_id] = session_data
-            print("Response:", repr(response))
-            if response:
-                timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S.%f')
-                response_id = 's' + hashlib.sha256(timestamp.encode()).hexdigest()
-                response_data = {
-                    'id': response_id,
-                    'origin': 'server',
-                    'content': response,
-                    'time': timestamp,
-                }
-                with self.message_locks[user_id]:
-                    messages_db[response_id] = response_data
-            else:
-                response_id = None
-            return message_id, response_id
+                user_messages.session_size = len(pickle.dumps(session_data, pickle.HIGHEST_PROTOCOL))
+                self.user_cache.resize(user_id, user_messages.session_size)
+        return counts
 
     def get_message_data(self, user_id: str, message_id: str) -> dict:
-        """Return the data associated with a given message. If the user or
-        message does not exist, a KeyError is raised."""
-        with self.user_locks[user_id]:
+        """Return the data associated with a given message, whether it is
+        live or archived. If the user or message does not exist, a KeyError
+        is raised."""
+        with self.user_locks[user_id].shared():
             if user_id not in self.users:
                 raise KeyError(user_id)
-            with self.message_locks[user_id]:
-                messages_db = self._get_messages(user_id)
-                return messages_db[message_id]
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                if message_id in user_messages.messages_db:
+                    return user_messages.messages_db[message_id]
+                return user_messages.archive[message_id]
+
+    def has_message(self, user_id: str, message_id: str) -> bool:
+        """Return whether the given user exists and has the given message,
+        whether it is live or archived. The question is answered from the
+        user's message index and archive index, without reading any
+        messages."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                return False
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                return message_id in user_messages.message_index or message_id in user_messages.archive
+
+    def get_archived_message_ids(self, user_id: str) -> list:
+        """Return the IDs of the given user's archived messages, in
+        chronological order. If the user does not exist, a KeyError is
+        raised."""
+        with self.user_locks[user_id].shared():
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            with self.message_locks[user_id].shared():
+                return self._get_user_messages(user_id).archive.ids()
+
+    def archive_messages(self, user_id: str, count: int, segment_size: int = 1000) -> int:
+        """Move up to count of the given user's oldest live messages into the
+        user's archive, with up to segment_size messages per archive
+        segment, and return the number of messages moved. The user's locks
+        are taken once per segment. If the storage backend compacts message
+        stores, the live copies of the messages are then dropped by
+        compacting the user's store (see compact_messages()), which is much
+        cheaper than deleting them one at a time. Otherwise, they are
+        deleted. If the user does not exist, a KeyError is raised."""
+        delete = not self.storage.compacts_messages
+        archived = 0
+        while archived < count and not self.closed:
+            with self.user_locks[user_id].shared():
+                if user_id not in self.users:
+                    raise KeyError(user_id)
+                with self.message_locks[user_id]:
+                    user_messages = self._get_user_messages(user_id)
+                    message_ids = user_messages.message_index.ids[:min(segment_size, count - archived)]
+                    if not message_ids:
+                        break
+                    messages_db = user_messages.messages_db
+                    # The segment is complete before the live copies are
+                    # dropped, so an interruption can't lose messages.
+                    user_messages.archive.append([messages_db[message_id] for message_id in message_ids])
+                    if delete:
+                        for message_id in message_ids:
+                            del messages_db[message_id]
+                    user_messages.message_index.drop_first(len(message_ids))
+                    user_messages.token_index = None
+                    self.message_changes.touch(user_id)
+            archived += len(message_ids)
+        if archived and not delete:
+            self.compact_messages(user_id)
+        return archived
+
+    def compact_messages(self, user_id: str, batch_size: int = 1000) -> bool:
+        """Compact the given user's live message store, giving back the space
+        of deleted and archived messages, if the storage backend supports
+        it. Return whether the store was compacted. If the user does not
+        exist, a KeyError is raised.
+
+        The live messages are copied into a new store in batches, taking the
+        user's locks shared for each batch, so messages can still be added
+        during the copy. Messages are only held up while any messages added
+        in the meantime are copied and the new store is put in place."""
+        if not self.storage.compacts_messages:
+            return False
+        copy = self.storage.open_messages_copy(user_id)
+        copied = set()
+        replaced = False
+        try:
+            position = 0
+            while not self.closed:
+                with self.user_locks[user_id].shared():
+                    if user_id not in self.users:
+                        raise KeyError(user_id)
+                    with self.message_locks[user_id].shared():
+                        user_messages = self._get_user_messages(user_id)
+                        batch = user_messages.message_index.ids[position:position + batch_size]
+                        for message_id in batch:
+                            copy[message_id] = user_messages.messages_db[message_id]
+                copied.update(batch)
+                position += len(batch)
+                if len(batch) < batch_size:
+                    break
+            if self.closed:
+                return False
+            with self.user_locks[user_id].shared():
+                if user_id not in self.users:
+                    raise KeyError(user_id)
+                with self.message_locks[user_id]:
+                    user_messages = self._get_user_messages(user_id)
+                    live = set(user_messages.message_index.ids)
+                    for message_id in live - copied:
+                        copy[message_id] = user_messages.messages_db[message_id]
+                    for message_id in copied - live:
+                        del copy[message_id]
+                    copy.close()
+                    copy = None
+                    user_messages.messages_db.close()
+                    try:
+                        self.storage.replace_messages(user_id)
+                        replaced = True
+                    finally:
+                        user_messages.messages_db = metrics.instrument_store(self.storage.open_messages(user_id),
+                                                                             'messages')
+            return True
+        finally:
+            if copy is not None:
+                copy.close()
+            if not replaced:
+                self.storage.discard_messages_copy(user_id)
+
+    def apply_retention(self, policy: RetentionPolicy = None) -> dict:
+        """Apply the retention policy (by default, the data manager's own) to
+        every user, archiving the messages which fall outside it; see
+        archive_messages(). Users who aren't cached are checked against the
+        summary of their live messages in the message stats store, and are
+        only loaded if some of their messages fall outside the policy.
+        Return a summary, as a dictionary with the number of users whose
+        messages were archived ('users') and the number of messages
+        archived ('archived')."""
+        policy = policy or self.retention
+        if policy is None:
+            raise ValueError("No retention policy was given.")
+        summary = {'users': 0, 'archived': 0}
+        cutoff = policy.get_cutoff()
+        for user_id in self.get_user_ids():
+            if self.closed:
+                break
+            try:
+                with self.user_locks[user_id].shared():
+                    if user_id not in self.users:
+                        continue
+                    with self.message_locks[user_id].shared():
+                        count = self._count_expired(user_id, policy, cutoff)
+                if count:
+                    summary['archived'] += self.archive_messages(user_id, count, policy.segment_size)
+                    summary['users'] += 1
+            except KeyError:
+                continue  # The user was removed.
+        return summary
+
+    def _count_expired(self, user_id: str, policy: RetentionPolicy, cutoff: float) -> int:
+        # The caller must hold the user's locks.
+        if self.user_cache.peek(user_id) is None:
+            stats = self.message_stats.get(user_id)
+            if stats is not None and not policy.has_expired(stats[0], stats[1], cutoff):
+                return 0
+        return policy.count_expired(self._get_user_messages(user_id).message_index.times, cutoff)
+
+    def export_user(self, user_id: str) -> dict:
+        """Return everything stored for the given user, as a dictionary with
+        the user's data ('user'), the data of all of the user's live and
+        archived messages in chronological order ('messages' and
+        'archived'), and the user's bot session data ('session'), suitable
+        for import_user(). If the user does not exist, a KeyError is
+        raised."""
+        with self.user_locks[user_id].shared():
+            user_data = self.users[user_id]
+            with self.message_locks[user_id].shared():
+                user_messages = self._get_user_messages(user_id)
+                messages = [user_messages.messages_db[message_id] for message_id in user_messages.message_index.ids]
+                archived = list(user_messages.archive.values())
+                # The bot holds the latest session data while the user is
+                # cached.
+                session_data = self.bot_pool.get_session_data(user_id)
+        return {'user': user_data, 'messages': messages, 'archived': archived, 'session': session_data}
+
+    def import_user(self, record: dict) -> dict:
+        """Add a user exported with export_user(), along with their messages
+        and bot session. If the user already exists, their name is kept,
+        messages they already have are skipped, and their session is
+        replaced, so importing the same user twice is harmless. Return a
+        summary of the import, as for import_messages(), with the number of
+        archived messages added to the user's archive ('archived')."""
+        user_id = record['user']['id']
+        try:
+            self.add_user(user_id, record['user']['name'])
+        except KeyError:
+            pass  # The user already exists.
+        summary = self.import_messages((user_id, message_data) for message_data in record['messages'])
+        with self.user_locks[user_id].shared(), self.message_locks[user_id]:
+            user_messages = self._get_user_messages(user_id)
+            archived = [message_data for message_data in record.get('archived', ())
+                        if message_data['id'] not in user_messages.message_index.id_keys and
+                        message_data['id'] not in user_messages.archive]
+            user_messages.archive.append(archived)
+            summary['archived'] = len(archived)
+            session_data = record['session']
+            self.bot_pool.set_session_data(user_id, session_data)
+            self.user_sessions[user_id] = session_data
+            user_messages.session_size = len(pickle.dumps(session_data, pickle.HIGHEST_PROTOCOL))
+            self.user_cache.resize(user_id, user_messages.session_size)
+        return summary
+
+    def remove_user(self, user_id: str) -> None:
+        """Remove a user, along with their live and archived messages and bot
+        session. If the user does not exist, a KeyError is raised."""
+        with self.user_locks[user_id], self.message_locks[user_id]:
+            if user_id not in self.users:
+                raise KeyError(user_id)
+            user_messages = self.user_cache.discard(user_id)
+            if user_messages is not None:
+                user_messages.messages_db.close()
+                self.bot_pool.delete_session(user_id)
+            self.storage.delete_messages(user_id)
+            self.storage.delete_archive(user_id)
+            self.message_stats.pop(user_id, None)
+            if user_id in self.user_sessions:
+                del self.user_sessions[user_id]
+            del self.users[user_id]
+            with self.sorted_user_ids_lock:
+                index = bisect_left(self.sorted_user_ids, user_id)
+                if index < len(self.sorted_user_ids) and self.sorted_user_ids[index] == user_id:
+                    del self.sorted_user_ids[index]
+            self.user_changes.touch()
+            self.message_changes.touch(user_id)
@@ -0,0 +1,165 @@
+"""
+Response encoding for the JSON endpoints: serialization, content coding, and
+streaming.
+
+JSON is serialized with the fastest encoder available. orjson and ujson are
+used if they are installed, in that order of preference, and the standard
+json module otherwise. The encoder can be chosen explicitly with
+set_json_encoder() or the AIML_BOT_API_JSON_ENCODER environment variable.
+All encoders produce compact UTF-8 output.
+
+Bodies of at least MIN_COMPRESSED_SIZE bytes are compressed with gzip or
+deflate, if the client accepts either. Results listing more than
+MIN_STREAMED_ITEMS items are serialized and compressed incrementally as the
+response is sent, instead of being built in memory in full first.
+"""
+
+import json
+import os
+import zlib
+
+
+# The smallest body worth compressing, in bytes.
+MIN_COMPRESSED_SIZE = 1024
+
+# The smallest number of listed items for which a result is streamed.
+MIN_STREAMED_ITEMS = 1000
+
+# The approximate size of each chunk of a streamed body, in bytes.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The zlib window bits for each supported content coding.
+CONTENT_CODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def _json_dumps(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _load_orjson():
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    import orjson
+    return orjson.dumps
+
+
+def _load_ujson():
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    import ujson
+
+    def ujson_dumps(value) -> bytes:
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    return ujson_dumps
+
+
+def _load_json():
+    return _json_dumps
+
+
+# The supported JSON encoders, in order of preference. Each is given by a
+# function which returns its serialization function, or raises ImportError
+# if the encoder isn't installed.
+JSON_ENCODERS = {
+    'orjson': _load_orjson,
+    'ujson': _load_ujson,
+    'json': _load_json,
+}
+
+_dumps = _json_dumps
+_encoder_name = 'json'
+
+
+def set_json_encoder(name: str = None) -> str:
+    """Select the JSON encoder by name, or the fastest one available if no
+    name is given, and return its name. If the named encoder is unknown or
+    not installed, a ValueError is raised."""
+    global _dumps, _encoder_name
+    if name is not None and name not in JSON_ENCODERS:
+        raise ValueError(name)
+    for candidate in ([name] if name else JSON_ENCODERS):
+        try:
+            dumps_function = JSON_ENCODERS[candidate]()
+        except ImportError:
+            continue
+        _dumps, _encoder_name = dumps_function, candidate
+        return candidate
+    raise ValueError(name)
+
+
+def get_json_encoder() -> str:
+    """Return the name of the JSON encoder in use."""
+    return _encoder_name
+
+
+def dumps(value) -> bytes:
+    """Serialize a value as JSON, in UTF-8."""
+    return _dumps(value)
+
+
+def choose_content_coding(accept_encodings) -> str:
+    """Return the supported content coding the client prefers, given the
+    parsed Accept-Encoding header (a werkzeug Accept object), or None if it
+    accepts none of them."""
+    return accept_encodings.best_match(list(CONTENT_CODINGS))
+
+
+def encode_json(result: dict, coding: str = None) -> (object, str):
+    """Serialize a result as the body of a JSON response, compressed with
+    the given content coding if it's worth compressing. Return a tuple
+    (body, coding), where the body is a byte string, or an iterator over
+    byte strings if the result lists enough values to be streamed, and the
+    coding is the one applied, or None."""
+    value = result.get('value')
+    if isinstance(value, list) and len(value) >= MIN_STREAMED_ITEMS:
+        body = iter_json_chunks(result)
+        if coding is not None:
+            body = compress_stream(body, coding)
+        return body, coding
+    body = dumps(result)
+    if coding is None or len(body) < MIN_COMPRESSED_SIZE:
+        return body, None
+    return compress(body, coding), coding
+
+
+def compress(data: bytes, coding: str) -> bytes:
+    """Compress the data with the given content coding."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, CONTENT_CODINGS[coding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, coding: str):
+    """Compress a stream of byte strings with the given content coding,
+    yielding the compressed chunks."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, CONTENT_CODINGS[coding])
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_json_chunks(result: dict, key: str = 'value'):
+    """Serialize a dictionary whose entry for the key is a list, yielding
+    the JSON a chunk at a time. The list's items are serialized as they are
+    reached, and the list is placed last in the object."""
+    head = dict(result)
+    items = head.pop(key)
+    prefix = dumps(head)[:-1]  # Without the closing brace
+    buffer = [prefix, b',' if head else b'', dumps(key), b':[']
+    size = 0
+    for index, item in enumerate(items):
+        data = dumps(item)
+        buffer.append(b',' + data if index else data)
+        size += len(data) + 1
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(b']}')
+    yield b''.join(buffer)
+
+
+set_json_encoder(os.environ.get('AIML_BOT_API_JSON_ENCODER') or None)
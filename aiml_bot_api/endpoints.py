@@ -3,7 +3,12 @@
 
 ### GET /user/
 
-Return a list of user IDs.
+Return a list of user IDs, in sorted order.
+
+Optional query parameters:
+
+* limit: The maximum number of user IDs to return.
+* cursor: The next_cursor value from the previous page.
 
 Output:
 
@@ -13,9 +18,12 @@ Output:
             "<user id>",
             "<user id>",
             ...
-        ]
+        ],
+        "next_cursor": "<cursor>"
     }
 
+The next cursor will be null if there are no more user IDs to list.
+
 ### POST /user/
 
 Create a new user.
@@ -52,7 +60,14 @@ Output:
 
 ### GET /user/<user id>/message/
 
-Get a list of the messages to/from a user.
+Get a list of the messages to/from a user, in chronological order.
+
+Optional query parameters:
+
+* limit: The maximum number of message IDs to return.
+* cursor: The next_cursor value from the previous page.
+* search: A search query. Only messages containing every word of the query
+  are listed. Words ending in "*" match any word with that prefix.
 
 Output:
 
@@ -62,9 +77,12 @@ Output:
             "<message id>",
             "<message id>",
             ...
-        ]
+        ],
+        "next_cursor": "<cursor>"
     }
 
+The next cursor will be null if there are no more message IDs to list.
+
 
 ### POST /user/<user id>/message/
 
@@ -109,6 +127,205 @@ Output:
 * The timestamp will be a string formatted as "%Y%m%d%H%M%S.%f".
 
 
+### POST /user/<user id>/message/batch-get/
+
+Get the information for several messages at once.
+
+Input:
+
+    {
+        "ids": ["<message id>", "<message id>", ...]
+    }
+
+Output:
+
+    {
+        "type": "message_batch",
+        "value": [
+            {
+                "id": "<message id>",
+                "origin": "<origin>",
+                "time": "<timestamp>",
+                "content": "<message content>"
+            },
+            ...
+        ],
+        "missing": ["<message id>", ...]
+    }
+
+Messages are listed in the order they were requested. The IDs of requested
+messages which do not exist are listed under "missing".
+
+
+### GET /user/<user id>/message/poll/
+
+Wait for new messages to/from a user (long polling). If there are messages
+after the cursor, they are returned right away; otherwise the request waits
+until some are added or the timeout expires.
+
+Optional query parameters:
+
+* cursor: The ID of the last message the client has seen. By default, the
+  user's most recent message.
+* limit: The maximum number of messages to return.
+* timeout: How many seconds to wait, at most 60. The default is 30.
+
+Output:
+
+    {
+        "type": "new_messages",
+        "value": [
+            {
+                "id": "<message id>",
+                "origin": "<origin>",
+                "time": "<timestamp>",
+                "content": "<message content>"
+            },
+            ...
+        ],
+        "next_cursor": "<cursor>"
+    }
+
+The list of messages is empty if the timeout expired. The next cursor is the
+cursor for the next poll.
+
+
+### GET /user/<user id>/message/events/
+
+A stream of server-sent events (text/event-stream) for new messages to/from
+a user. Each message is sent as an event of type "message", whose data is
+the message's information in JSON, as for GET
+/user/<user id>/message/<message id>/, and whose ID is the message ID. A
+comment is sent every 15 seconds while the stream is idle.
+
+Optional query parameters:
+
+* cursor: The ID of the last message the client has seen. By default, the
+  user's most recent message. A Last-Event-ID header, as sent by
+  reconnecting clients, takes precedence.
+
+
+### POST /message/batch/
+
+Send several new messages, for one or more users, at once. Each user's
+messages are handled in the order given, while the messages of different
+users are handled concurrently.
+
+Input:
+
+    {
+        "messages": [
+            {"user_id": "<user id>", "content": "<message content>"},
+            ...
+        ]
+    }
+
+Output:
+
+    {
+        "type": "messages_received",
+        "value": [
+            {"user_id": "<user id>", "id": "<message id>", "response_id": "<response id>"},
+            {"user_id": "<user id>", "error": "User not found."},
+            ...
+        ]
+    }
+
+There is one result for each message, in the order the messages were
+given.
+
+
+### GET /user/<user id>/message/export/
+
+Export the user's messages as newline-delimited JSON, in chronological
+order. The response is streamed, one message per line:
+
+    {"id": "<message id>", "origin": "<origin>", "time": "<timestamp>", "content": "<message content>"}
+    ...
+
+Optional query parameters:
+
+* after: Only export messages with a time at or after this timestamp.
+* before: Only export messages with a time at or before this timestamp.
+
+Timestamps are formatted as for message times.
+
+
+### GET /export/
+
+Export all users and their messages as newline-delimited JSON. The
+response is streamed. Each user is followed by their messages, in
+chronological order:
+
+    {"type": "user", "value": {"id": "<user id>", "name": "<user name>"}}
+    {"type": "message", "user_id": "<user id>", "value": {"id": "<message id>", ...}}
+    ...
+
+The after and before query parameters are accepted, as for the export of a
+single user's messages.
+
+
+### POST /import/
+
+Import users and messages in bulk. The request body is newline-delimited
+JSON, in the format produced by GET /export/, with the content type
+application/x-ndjson. Users which don't exist yet are created. Messages
+keep their IDs and times if they have them; messages whose IDs already
+exist are skipped.
+
+Optional query parameters:
+
+* replay: If "true", the content of each imported client message is run
+  through the bot, in order for each user, to rebuild the user's session.
+
+Output:
+
+    {
+        "type": "import_summary",
+        "value": {
+            "users": <number of users with messages>,
+            "users_created": <number of users created>,
+            "imported": <number of messages imported>,
+            "duplicates": <number of messages which already existed>,
+            "replayed": <number of messages run through the bot>,
+            "rejected": <number of malformed records>
+        }
+    }
+
+
+### GET /metrics
+
+Return the API's metrics in the Prometheus text format: latency histograms
+for endpoints, GraphQL operations, bot responses, storage operations, and
+lock waits and holds, along with cache counters. Metrics are only collected
+if the AIML_BOT_API_METRICS environment variable is set to 1; otherwise a
+404 error is returned. See the metrics module.
+
+
+## Caching
+
+Listings and user information (GET /user/, GET /user/<user id>/, and
+GET /user/<user id>/message/) are returned with an ETag header, and a
+Last-Modified header if the data hasn't changed in the last second. A
+request which sends a matching If-None-Match header (or, without one, an
+If-Modified-Since header no earlier than the last change) gets an empty 304
+response instead, without any data being read from storage. The tags are
+only valid until the server is restarted. Caches are told to revalidate
+these responses before reusing them.
+
+Messages never change once they are created, so individual messages
+(GET /user/<user id>/message/<message id>/) are returned with headers that
+allow clients and caches to keep them indefinitely, and with an ETag which
+is answered with 304 without reading from storage.
+
+
+## Compression
+
+JSON responses of 1 KB or more, and NDJSON exports, are compressed with gzip
+or deflate if the request's Accept-Encoding header allows it. Listings of
+1000 or more items are streamed as they are serialized.
+
+
 ## Errors
 
 For any request, an error may be returned rather than the expected result.
@@ -121,20 +338,114 @@ Errors will be formatted as:
 
 """
 
+import datetime
 import json
 import logging
+import os
+import re
+import threading
+import time
 from functools import wraps
 
-from flask import Flask, request, Response
+from flask import Flask, g, request, Response, stream_with_context
 
+from . import encoding, events, metrics
 from .data import DataManager
+from .ids import parse_time
+from .retention import RetentionPolicy
+from .sharding import ShardedDataManager
 
 
 log = logging.getLogger(__name__)
+# Request headers are logged to this logger at the DEBUG level, for
+# diagnostics. Like all debug logging, this is off unless configured.
+header_log = logging.getLogger(__name__ + '.headers')
 app = Flask(__name__)
 
 # TODO: Initialize this from a configuration file.
-data_manager = DataManager()
+if os.environ.get('AIML_BOT_API_SHARDS'):
+    data_manager = ShardedDataManager(data_folder=os.environ.get('AIML_BOT_API_DATA_FOLDER'),
+                                      shards=int(os.environ['AIML_BOT_API_SHARDS']),
+                                      retention=RetentionPolicy.from_environment())
+else:
+    data_manager = DataManager(data_folder=os.environ.get('AIML_BOT_API_DATA_FOLDER'),
+                               retention=RetentionPolicy.from_environment())
+
+
+# How long clients and caches may keep responses which never change, in
+# seconds.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Matches the type and name of a named GraphQL operation.
+GRAPHQL_OPERATION_PATTERN = re.compile(r'^\s*(query|mutation|subscription)\s+(\w+)')
+
+# Operation names are chosen by clients, so only this many distinct names
+# are used to label GraphQL metrics. Operations with names seen after that
+# are labeled '(other)', which keeps the number of label values bounded.
+MAX_GRAPHQL_OPERATION_NAMES = 100
+
+_graphql_operation_names = set()
+_graphql_operation_names_lock = threading.Lock()
+
+
+@app.before_request
+def start_request_timer():
+    """Note the start time of the request, if metrics are being collected."""
+    if metrics.registry.enabled:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response: Response) -> Response:
+    """Record the duration of the request, if metrics are being collected.
+    Streamed responses are timed up to the start of the stream."""
+    start = g.get('request_start')
+    if start is None:
+        return response
+    duration = time.perf_counter() - start
+    endpoint = request.url_rule.rule if request.url_rule else '(unmatched)'
+    metrics.HTTP_REQUEST_SECONDS.observe(duration, endpoint, request.method, str(response.status_code))
+    if request.endpoint == 'graphql':
+        metrics.GRAPHQL_OPERATION_SECONDS.observe(duration, get_graphql_operation())
+    return response
+
+
+def get_graphql_operation() -> str:
+    """Return a label for the GraphQL operation of the current request: its
+    type followed by its name, '(anonymous)' if it has no name, or '(other)'
+    if MAX_GRAPHQL_OPERATION_NAMES other names have already been seen."""
+    data = request.get_json(silent=True) if request.method == 'POST' else None
+    if not isinstance(data, dict):
+        data = request.args
+    query = data.get('query') or ''
+    match = GRAPHQL_OPERATION_PATTERN.match(query)
+    if data.get('operationName'):
+        operation_type = match.group(1) if match else 'query'
+        name = str(data['operationName'])
+    elif match:
+        operation_type, name = match.groups()
+    else:
+        return 'mutation (anonymous)' if query.lstrip().startswith('mutation') else 'query (anonymous)'
+    with _graphql_operation_names_lock:
+        if name not in _graphql_operation_names:
+            if len(_graphql_operation_names) >= MAX_GRAPHQL_OPERATION_NAMES:
+                name = '(other)'
+            else:
+                _graphql_operation_names.add(name)
+    return '%s %s' % (operation_type, name)
+
+
+def json_response(result: dict, status: int = None) -> Response:
+    """Return a response with the result serialized as JSON. The body is
+    compressed if it is large enough and the client accepts a supported
+    content coding, and results listing many values are streamed; see the
+    encoding module."""
+    body, coding = encoding.encode_json(result, encoding.choose_content_coding(request.accept_encodings))
+    response = Response(body, status=status, content_type='application/json; charset=utf-8')
+    if coding is not None:
+        response.content_encoding = coding
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 def json_only(func):
@@ -142,7 +453,8 @@ def json_only(func):
     @wraps(func)
     def wrapped(*args, **kwargs):
         """The decorated function."""
-        print(request.headers)
+        if header_log.isEnabledFor(logging.DEBUG):
+            header_log.debug("Headers of %s %s:\n%s", request.method, request.path, request.headers)
         if request.method in ('POST', 'PUT') and request.headers['Content-Type'] != 'application/json':
             return Response('Unsupported Media Type: %s' % request.headers['Content-Type'], status=415)
         else:
@@ -151,51 +463,195 @@ def json_only(func):
                 status = raw_result.pop('status')
             else:
                 status = None
-            return Response(raw_result, status=status, content_type='application/json; charset=utf-8')
+            return json_response(raw_result, status)
     return wrapped
 
 
+def conditional(get_version):
+    """Decorator for GET endpoints whose responses only change when the
+    underlying data does. The get_version function is called with the
+    endpoint's arguments, and must return a tuple (tag, modified) describing
+    the current state of the data without accessing storage, as
+    DataManager.get_users_version() does. If the request's If-None-Match or
+    If-Modified-Since header shows that the client already has the current
+    state, a 304 response is returned without calling the endpoint.
+    Successful responses are given ETag and Last-Modified headers, and
+    caches are told to revalidate them before reuse."""
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            """The decorated function."""
+            if request.method not in ('GET', 'HEAD'):
+                return func(*args, **kwargs)
+            # The version is taken before the response is generated, so the
+            # response is never older than its tag says.
+            tag, modified = get_version(*args, **kwargs)
+            # Last-Modified has a resolution of one second, so a later change
+            # in the same second would go unnoticed by a client that only
+            # sends If-Modified-Since. It's only given for older changes.
+            if time.time() - modified >= 1:
+                last_modified = datetime.datetime.fromtimestamp(int(modified), datetime.timezone.utc)
+            else:
+                last_modified = None
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(tag)
+            else:
+                not_modified = (last_modified is not None and request.if_modified_since is not None and
+                                last_modified <= request.if_modified_since)
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = func(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response.set_etag(tag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapped
+    return decorator
+
+
+def immutable(get_tag, exists):
+    """Decorator for GET endpoints whose successful responses never change.
+    The get_tag function is called with the endpoint's arguments, and must
+    return a tag identifying the response without accessing storage. If the
+    request's If-None-Match header includes the tag, and the exists function,
+    called with the same arguments, confirms that the resource still exists,
+    a 304 response is returned without calling the endpoint. Successful
+    responses are given an ETag header, and clients and caches are allowed
+    to keep them indefinitely."""
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            """The decorated function."""
+            tag = get_tag(*args, **kwargs)
+            if request.if_none_match.contains_weak(tag) and exists(*args, **kwargs):
+                response = Response(status=304)
+            else:
+                response = func(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            # The tag is weak, since the response may be compressed.
+            response.set_etag(tag, weak=True)
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+            return response
+        return wrapped
+    return decorator
+
+
+def get_page_args() -> (int, str):
+    """Return the limit and cursor query parameters of a paginated listing.
+    If the limit is not a positive integer, a ValueError is raised."""
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError(limit)
+    return limit, request.args.get('cursor')
+
+
+def get_time_bounds() -> (str, str):
+    """Return the after and before query parameters bounding the times of
+    exported messages. If either is not a valid timestamp, a ValueError is
+    raised."""
+    after = request.args.get('after')
+    before = request.args.get('before')
+    for bound in after, before:
+        if bound is not None:
+            parse_time(bound)
+    return after, before
+
+
+def iter_messages_between(user_id: str, after: str = None, before: str = None):
+    """Yield the data of the user's messages with times between after and
+    before, inclusive. The data manager compares times as floats, which
+    can't represent every microsecond of a timestamp, so its results are
+    narrowed down here by comparing the timestamps themselves, which are
+    fixed-width strings."""
+    messages = data_manager.iter_messages(user_id, None if after is None else float(after),
+                                          None if before is None else float(before))
+    for message_data in messages:
+        if (after is None or message_data['time'] >= after) and (before is None or message_data['time'] <= before):
+            yield message_data
+
+
+def ndjson_response(records, name: str) -> Response:
+    """Return a streamed response with each of the records, which are
+    generated lazily, serialized as a line of JSON, and compressed if the
+    client accepts a supported content coding. An error while generating
+    the records ends the response early, since the status has already been
+    sent by then."""
+    def generate():
+        # noinspection PyBroadException
+        try:
+            for record in records:
+                yield encoding.dumps(record) + b'\n'
+        except Exception:
+            log.exception("Error in %s (GET):" % name)
+
+    coding = encoding.choose_content_coding(request.accept_encodings)
+    body = stream_with_context(generate())
+    if coding is not None:
+        body = encoding.compress_stream(body, coding)
+    response = Response(body, content_type='application/x-ndjson; charset=utf-8')
+    if coding is not None:
+        response.content_encoding = coding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 @app.route('/users/', methods=['GET', 'POST'])
+@conditional(lambda: data_manager.get_users_version())
 @json_only
 def all_users():
     """The list of all users in the system.
     The client can get the list of users, or post a new user to the list."""
     if request.method == 'GET':
+        try:
+            limit, cursor = get_page_args()
+        except ValueError:
+            return {'type': 'error', 'value': 'Invalid limit.', 'status': 400}
+
         # noinspection PyBroadException
         try:
-            user_ids = data_manager.get_user_ids()
+            user_ids, next_cursor = data_manager.get_user_page(cursor, limit)
         except Exception:
             log.exception("Error in all_users() (GET):")
-            return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+            return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
         else:
-            return json.dumps({'type': 'user_list', 'value': user_ids})
+            return {'type': 'user_list', 'value': user_ids, 'next_cursor': next_cursor}
     else:
         assert request.method == 'POST'
         user_data = request.get_json()
         if not isinstance(user_data, dict) or 'id' not in user_data or 'name' not in user_data or len(user_data) > 2:
-            return json.dumps({'type': 'error', 'value': 'Malformed request.', 'status': 400})
+            return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
 
         user_id = user_data['id']  # type: str
         if not isinstance(user_id, str) or not user_id.isidentifier():
-            return json.dumps({'type': 'error', 'value': 'Invalid user ID.', 'status': 400})
+            return {'type': 'error', 'value': 'Invalid user ID.', 'status': 400}
 
         user_name = user_data['name']  # type: str
         if not isinstance(user_name, str) or not user_name:
-            return json.dumps({'type': 'error', 'value': 'Invalid user name.', 'status': 400})
+            return {'type': 'error', 'value': 'Invalid user name.', 'status': 400}
 
         # noinspection PyBroadException
         try:
             data_manager.add_user(user_id, user_name)
         except KeyError:
-            return json.dumps({'type': 'error', 'value': 'User already exists.', 'status': 405})
+            return {'type': 'error', 'value': 'User already exists.', 'status': 405}
         except Exception:
             log.exception("Error in all_users() (%s):" % request.method)
-            return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+            return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
         else:
-            return json.dumps({'type': 'user_created', 'id': user_id})
+            return {'type': 'user_created', 'id': user_id}
 
 
 @app.route('/users/<user_id>/', methods=['GET', 'PUT'])
+@conditional(lambda user_id: data_manager.get_users_version())
 @json_only
 def one_user(user_id):
     """A specific user. The client can get or set the associated properties for
@@ -205,78 +661,89 @@ def one_user(user_id):
         try:
             user_data = data_manager.get_user_data(user_id)
         except KeyError:
-            return json.dumps({'type': 'error', 'value': 'User not found.', 'status': 404})
+            return {'type': 'error', 'value': 'User not found.', 'status': 404}
         except Exception:
             log.exception("Error in one_user() (GET):")
-            return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+            return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
         else:
-            return json.dumps({'type': 'user', 'value': user_data})
+            return {'type': 'user', 'value': user_data}
     else:
         assert request.method == 'PUT'
         user_data = request.get_json()
         if (not isinstance(user_data, dict) or not user_data.keys() <= {'id', 'name'} or
                 user_data.get('id', user_id) != user_id):
-            return json.dumps({'type': 'error', 'value': 'Malformed request.', 'status': 400})
+            return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
 
         if 'name' in user_data:
             user_name = user_data['name']  # type: str
             if not isinstance(user_name, str) or not user_name:
-                return json.dumps({'type': 'error', 'value': 'Invalid user name.', 'status': 400})
+                return {'type': 'error', 'value': 'Invalid user name.', 'status': 400}
 
             # noinspection PyBroadException
             try:
                 data_manager.set_user_name(user_id, user_name)
             except KeyError:
-                return json.dumps({'type': 'error', 'value': 'User not found.', 'status': 405})
+                return {'type': 'error', 'value': 'User not found.', 'status': 405}
             except Exception:
                 log.exception("Error in all_users() (%s):" % request.method)
-                return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+                return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
 
-        return json.dumps({'type': 'user_updated', 'id': user_id})
+        return {'type': 'user_updated', 'id': user_id}
 
 
 @app.route('/users/<user_id>/messages/', methods=['GET', 'POST'])
+@conditional(lambda user_id: data_manager.get_messages_version(user_id))
 @json_only
 def all_messages(user_id):
     """The list of all messages associated with a given user.
     The client can get the list of messages, or post a new message to the list."""
     if request.method == 'GET':
+        try:
+            limit, cursor = get_page_args()
+        except ValueError:
+            return {'type': 'error', 'value': 'Invalid limit.', 'status': 400}
+
         # noinspection PyBroadException
         try:
-            message_ids = data_manager.get_message_ids(user_id)
+            message_ids, next_cursor = data_manager.get_message_page(user_id, cursor, limit,
+                                                                     request.args.get('search'))
         except KeyError:
-            return json.dumps({'type': 'error', 'value': 'User not found.', 'status': 404})
+            return {'type': 'error', 'value': 'User not found.', 'status': 404}
+        except ValueError:
+            return {'type': 'error', 'value': 'Invalid cursor.', 'status': 400}
         except Exception:
             log.exception("Error in all_messages(%r) (GET):" % user_id)
-            return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+            return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
         else:
-            return json.dumps({'type': 'message_list', 'value': message_ids})
+            return {'type': 'message_list', 'value': message_ids, 'next_cursor': next_cursor}
     else:
         assert request.method == 'POST'
         message_data = request.get_json()
         if not (isinstance(message_data, dict) and message_data.get('origin', 'client') == 'client' and
                 'content' in message_data and not message_data.keys() - {'origin', 'content'}):
-            return json.dumps({'type': 'error', 'value': 'Malformed request.', 'status': 400})
+            return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
         content = message_data['content']
         if not isinstance(content, str):
-            return json.dumps({'type': 'error', 'value': 'Malformed request.', 'status': 400})
+            return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
         content = content.strip()
         if not content:
-            return json.dumps({'type': 'error', 'value': 'Empty message content.', 'status': 400})
+            return {'type': 'error', 'value': 'Empty message content.', 'status': 400}
 
         # noinspection PyBroadException
         try:
             message_id, response_id = data_manager.add_message(user_id, content)
         except KeyError:
-            return json.dumps({'type': 'error', 'value': 'User not found.', 'status': 404})
+            return {'type': 'error', 'value': 'User not found.', 'status': 404}
         except Exception:
             log.exception("Error in all_messages(%r) (%s):" % (user_id, request.method))
-            return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+            return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
 
-        return json.dumps({'type': 'message_received', 'id': message_id, 'response_id': response_id})
+        return {'type': 'message_received', 'id': message_id, 'response_id': response_id}
 
 
 @app.route('/users/<user_id>/messages/<message_id>/')
+@immutable(lambda user_id, message_id: message_id,
+           lambda user_id, message_id: data_manager.has_message(user_id, message_id))
 @json_only
 def one_message(user_id, message_id):
     """A specific message for a specific user.
@@ -285,9 +752,229 @@ def one_message(user_id, message_id):
     try:
         message_data = data_manager.get_message_data(user_id, message_id)
     except KeyError:
-        return json.dumps({'type': 'error', 'value': 'Message not found.', 'status': 404})
+        return {'type': 'error', 'value': 'Message not found.', 'status': 404}
     except Exception:
         log.exception("Error in one_message(%r, %r) (GET):" % (user_id, message_id))
-        return json.dumps({'type': 'error', 'value': 'Server-side error.', 'status': 500})
+        return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
+    else:
+        return {'type': 'message', 'value': message_data}
+
+
+@app.route('/users/<user_id>/messages/batch-get/', methods=['POST'])
+@json_only
+def batch_get_messages(user_id):
+    """Several specific messages for a specific user, retrieved at once.
+    The client can get the associated properties for each message."""
+    request_data = request.get_json()
+    if not (isinstance(request_data, dict) and request_data.keys() == {'ids'} and
+            isinstance(request_data['ids'], list) and
+            all(isinstance(message_id, str) for message_id in request_data['ids'])):
+        return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
+    message_ids = request_data['ids']
+
+    # noinspection PyBroadException
+    try:
+        messages = data_manager.get_messages_bulk(user_id, message_ids)
+    except KeyError:
+        return {'type': 'error', 'value': 'User not found.', 'status': 404}
+    except Exception:
+        log.exception("Error in batch_get_messages(%r) (POST):" % user_id)
+        return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
     else:
-        return json.dumps({'type': 'message', 'value': message_data})
+        return {
+            'type': 'message_batch',
+            'value': [messages[message_id] for message_id in message_ids if message_id in messages],
+            'missing': [message_id for message_id in message_ids if message_id not in messages],
+        }
+
+
+@app.route('/messages/batch/', methods=['POST'])
+@json_only
+def batch_messages():
+    """Several new messages, for any number of users, sent at once."""
+    request_data = request.get_json()
+    if not (isinstance(request_data, dict) and request_data.keys() == {'messages'} and
+            isinstance(request_data['messages'], list)):
+        return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
+    messages = []
+    for message_data in request_data['messages']:
+        if not (isinstance(message_data, dict) and message_data.keys() == {'user_id', 'content'} and
+                isinstance(message_data['user_id'], str) and isinstance(message_data['content'], str)):
+            return {'type': 'error', 'value': 'Malformed request.', 'status': 400}
+        content = message_data['content'].strip()
+        if not content:
+            return {'type': 'error', 'value': 'Empty message content.', 'status': 400}
+        messages.append((message_data['user_id'], content))
+
+    # noinspection PyBroadException
+    try:
+        results = data_manager.add_messages(messages)
+    except Exception:
+        log.exception("Error in batch_messages() (POST):")
+        return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
+
+    value = []
+    for (user_id, _), result in zip(messages, results):
+        if result is None:
+            value.append({'user_id': user_id, 'error': 'User not found.'})
+        else:
+            value.append({'user_id': user_id, 'id': result[0], 'response_id': result[1]})
+    return {'type': 'messages_received', 'value': value}
+
+
+@app.route('/users/<user_id>/messages/poll/')
+@json_only
+def poll_messages(user_id):
+    """New messages for a specific user, waiting for some to arrive if there
+    are none yet."""
+    try:
+        limit, cursor, timeout = events.parse_poll_args(request.args)
+    except ValueError:
+        return {'type': 'error', 'value': 'Invalid limit or timeout.', 'status': 400}
+
+    # noinspection PyBroadException
+    try:
+        if cursor is None:
+            cursor = data_manager.get_last_message_id(user_id)
+        messages, next_cursor = data_manager.wait_for_messages(user_id, cursor, limit, timeout)
+    except KeyError:
+        return {'type': 'error', 'value': 'User not found.', 'status': 404}
+    except ValueError:
+        return {'type': 'error', 'value': 'Invalid cursor.', 'status': 400}
+    except Exception:
+        log.exception("Error in poll_messages(%r) (GET):" % user_id)
+        return {'type': 'error', 'value': 'Server-side error.', 'status': 500}
+    else:
+        return {'type': 'new_messages', 'value': messages, 'next_cursor': next_cursor}
+
+
+@app.route('/users/<user_id>/messages/events/')
+def message_events(user_id):
+    """A stream of server-sent events for a specific user's new messages."""
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+
+    # noinspection PyBroadException
+    try:
+        if cursor is None:
+            cursor = data_manager.get_last_message_id(user_id)
+        else:
+            data_manager.get_messages_after(user_id, cursor, 0)  # Validate the cursor.
+    except KeyError:
+        return json_response({'type': 'error', 'value': 'User not found.'}, 404)
+    except ValueError:
+        return json_response({'type': 'error', 'value': 'Invalid cursor.'}, 400)
+    except Exception:
+        log.exception("Error in message_events(%r) (GET):" % user_id)
+        return json_response({'type': 'error', 'value': 'Server-side error.'}, 500)
+
+    def generate():
+        nonlocal cursor
+        # noinspection PyBroadException
+        try:
+            while True:
+                messages, cursor = data_manager.wait_for_messages(user_id, cursor,
+                                                                  timeout=events.KEEP_ALIVE_INTERVAL)
+                if not messages:
+                    yield events.KEEP_ALIVE
+                for message_data in messages:
+                    yield events.format_message_event(message_data)
+        except Exception:
+            log.exception("Error in message_events(%r) (GET):" % user_id)
+
+    response = Response(stream_with_context(generate()), content_type='text/event-stream; charset=utf-8')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/users/<user_id>/messages/export/')
+def export_messages(user_id):
+    """An export of a specific user's messages, as newline-delimited JSON."""
+    try:
+        after, before = get_time_bounds()
+    except ValueError:
+        return json_response({'type': 'error', 'value': 'Invalid time bound.'}, 400)
+
+    # noinspection PyBroadException
+    try:
+        data_manager.get_user_data(user_id)
+    except KeyError:
+        return json_response({'type': 'error', 'value': 'User not found.'}, 404)
+    except Exception:
+        log.exception("Error in export_messages(%r) (GET):" % user_id)
+        return json_response({'type': 'error', 'value': 'Server-side error.'}, 500)
+
+    return ndjson_response(iter_messages_between(user_id, after, before), 'export_messages(%r)' % user_id)
+
+
+@app.route('/export/')
+def export_all():
+    """An export of all users and their messages, as newline-delimited
+    JSON."""
+    try:
+        after, before = get_time_bounds()
+    except ValueError:
+        return json_response({'type': 'error', 'value': 'Invalid time bound.'}, 400)
+
+    def generate_records():
+        for user_data in data_manager.iter_users():
+            yield {'type': 'user', 'value': user_data}
+            for message_data in iter_messages_between(user_data['id'], after, before):
+                yield {'type': 'message', 'user_id': user_data['id'], 'value': message_data}
+
+    return ndjson_response(generate_records(), 'export_all()')
+
+
+@app.route('/import/', methods=['POST'])
+def import_all():
+    """A bulk import of users and messages, from newline-delimited JSON."""
+    if request.mimetype != 'application/x-ndjson':
+        return Response('Unsupported Media Type: %s' % request.headers.get('Content-Type'), status=415)
+    replay = request.args.get('replay', 'false').lower() == 'true'
+    counts = {'users_created': 0, 'rejected': 0}
+
+    def generate_messages():
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                counts['rejected'] += 1
+                continue
+            if not isinstance(record, dict):
+                counts['rejected'] += 1
+            elif record.get('type') == 'user' and isinstance(record.get('value'), dict):
+                user_id = record['value'].get('id')
+                user_name = record['value'].get('name')
+                if not (isinstance(user_id, str) and user_id.isidentifier() and
+                        isinstance(user_name, str) and user_name):
+                    counts['rejected'] += 1
+                    continue
+                try:
+                    data_manager.add_user(user_id, user_name)
+                except KeyError:
+                    pass  # The user already exists.
+                else:
+                    counts['users_created'] += 1
+            elif record.get('type') == 'message' and isinstance(record.get('user_id'), str):
+                yield record['user_id'], record.get('value')
+            else:
+                counts['rejected'] += 1
+
+    # noinspection PyBroadException
+    try:
+        summary = data_manager.import_messages(generate_messages(), replay)
+    except Exception:
+        log.exception("Error in import_all() (POST):")
+        return json_response({'type': 'error', 'value': 'Server-side error.'}, 500)
+    summary['users_created'] = counts['users_created']
+    summary['rejected'] += counts['rejected']
+    return json_response({'type': 'import_summary', 'value': summary})
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """The API's metrics, in the Prometheus text format."""
+    if not metrics.registry.enabled:
+        return json_response({'type': 'error', 'value': 'Metrics are disabled.'}, 404)
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,58 @@
+"""
+Delivery of new messages, by server-sent events and by long polling. A
+client which opens an event stream for a user gets each of the user's new
+messages, as soon as it is added, as an event whose data is the message's
+data in JSON and whose ID is the message ID. A client which long polls gets
+the messages following its cursor, waiting until some are added if there
+are none yet. Both are served by the Flask application, and natively by the
+asyncio front-end, which doesn't tie up a thread for each open stream or
+waiting poll.
+"""
+
+import re
+
+from . import encoding
+
+
+# How often a comment is sent on an idle event stream to keep it open, in
+# seconds.
+KEEP_ALIVE_INTERVAL = 15
+
+# The comment sent on an idle event stream.
+KEEP_ALIVE = ': keep-alive\n\n'
+
+# How long a long poll waits for new messages by default, and at most, in
+# seconds.
+DEFAULT_POLL_TIMEOUT = 30
+MAX_POLL_TIMEOUT = 60
+
+# Matches the path of a user's event stream, capturing the user ID.
+EVENTS_PATH_PATTERN = re.compile(r'^/users/([^/]+)/messages/events/$')
+
+# Matches the path of a user's long poll, capturing the user ID.
+POLL_PATH_PATTERN = re.compile(r'^/users/([^/]+)/messages/poll/$')
+
+
+def format_message_event(message_data: dict) -> str:
+    """Return a server-sent event for a message, with its data serialized
+    by the same JSON encoder as the other responses. The event's ID is the
+    message ID, so a reconnecting client resumes after the last message it
+    received."""
+    return 'id: %s\nevent: message\ndata: %s\n\n' % (message_data['id'],
+                                                       encoding.dumps(message_data).decode('utf-8'))
+
+
+def parse_poll_args(args) -> (int, str, float):
+    """Return the limit, cursor, and timeout of a long poll, given its query
+    parameters as a mapping. The timeout is limited to MAX_POLL_TIMEOUT. If
+    the limit is not a positive integer, or the timeout is not a
+    non-negative number, a ValueError is raised."""
+    limit = args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError(limit)
+    timeout = float(args.get('timeout', DEFAULT_POLL_TIMEOUT))
+    if not 0 <= timeout < float('inf'):
+        raise ValueError(timeout)
+    return limit, args.get('cursor'), min(timeout, MAX_POLL_TIMEOUT)
@@ -11,6 +11,28 @@
                 content
                 time
             }
+            archivedMessages {
+                (the same fields as messages)
+            }
+        }
+    }
+
+Users and messages can also be retrieved a page at a time, using
+Relay-style connections:
+
+    {
+        userConnection(first: 10, after: "<user id>") {
+            edges {
+                cursor
+                node {
+                    id
+                    messageConnection(first: 10, after: "<message id>") {
+                        edges { cursor node { id content } }
+                        pageInfo { hasNextPage endCursor }
+                    }
+                }
+            }
+            pageInfo { hasNextPage endCursor }
         }
     }
 
@@ -27,11 +49,63 @@
 
 import re
 
+import flask
 import flask_graphql
 import graphene
 from graphene import resolve_only_args
 
 from .endpoints import app, data_manager
+from .search import tokenize
+
+
+class MessageLoader:
+    """A per-request cache of message data, keyed by (user_id, message_id).
+    Resolvers which already hold message data prime the cache with it. When
+    a message which isn't cached is requested, it is fetched together with
+    every other message of the same user that has been deferred, i.e.
+    handed out to the schema without its data. Together, these ensure that
+    a query touches each message record at most once, regardless of how many
+    of its fields are selected."""
+
+    def __init__(self):
+        self.loaded = {}  # (user_id, message_id) -> message data
+        self.deferred = {}  # user_id -> set of message IDs which may be requested later
+
+    def prime(self, user_id: str, data: dict) -> None:
+        """Add already loaded message data to the cache."""
+        self.loaded[user_id, data['id']] = data
+
+    def defer(self, user_id: str, message_id: str) -> None:
+        """Note that the message may be requested later, so it can be
+        fetched in the same batch as other messages of the same user."""
+        if (user_id, message_id) not in self.loaded:
+            self.deferred.setdefault(user_id, set()).add(message_id)
+
+    def load(self, user_id: str, message_id: str) -> dict:
+        """Return the message data. If the message does not exist, a
+        KeyError is raised."""
+        key = (user_id, message_id)
+        if key not in self.loaded:
+            batch = self.deferred.pop(user_id, set())
+            batch.add(message_id)
+            self._fetch(user_id, batch)
+            if key not in self.loaded:
+                raise KeyError(message_id)
+        return self.loaded[key]
+
+    def _fetch(self, user_id: str, message_ids: set) -> None:
+        for message_id, data in data_manager.get_messages_bulk(user_id, message_ids).items():
+            self.loaded[user_id, message_id] = data
+
+
+def get_message_loader() -> MessageLoader:
+    """Return the message loader for the current request. Outside of a
+    request, a new loader is returned on each call."""
+    if not flask.has_app_context():
+        return MessageLoader()
+    if 'message_loader' not in flask.g:
+        flask.g.message_loader = MessageLoader()
+    return flask.g.message_loader
 
 
 class User(graphene.ObjectType):
@@ -48,7 +122,16 @@ class User(graphene.ObjectType):
         time=graphene.String(),
         after=graphene.String(),
         before=graphene.String(),
-        pattern=graphene.String()
+        pattern=graphene.String(),
+        search=graphene.String()
+    )
+    message_connection = graphene.Field(  # A page of the messages to/from this user, in chronological order.
+        lambda: MessageConnection,
+        first=graphene.Int(),
+        after=graphene.String()
+    )
+    archived_messages = graphene.List(  # The archived messages to/from this user, in chronological order.
+        lambda: Message
     )
 
     # noinspection PyShadowingBuiltins
@@ -69,31 +152,68 @@ class User(graphene.ObjectType):
 
     # noinspection PyShadowingBuiltins
     @resolve_only_args
-    def resolve_messages(self, id=None, origin=None, content=None, time=None, after=None, before=None, pattern=None):
-        """Resolve the list of messages nested under the user."""
+    def resolve_messages(self, id=None, origin=None, content=None, time=None, after=None, before=None, pattern=None,
+                         search=None):
+        """Resolve the list of messages nested under the user. The origin
+        and time range criteria are answered from the user's message index,
+        and the search criterion from the user's token index. Messages are
+        only loaded if other criteria must be checked, and then only the
+        candidates which satisfy the indexed criteria are loaded."""
         if id is None:
-            message_data = [data_manager.get_message_data(self.id, id) for id in data_manager.get_message_ids(self.id)]
+            lower = [float(value) for value in (after, time) if value is not None]
+            upper = [float(value) for value in (before, time) if value is not None]
+            message_ids = data_manager.find_message_ids(self.id, origin, max(lower, default=None),
+                                                        min(upper, default=None))
+            if search is not None:
+                matches = set(data_manager.search_message_ids(self.id, search))
+                message_ids = [id for id in message_ids if id in matches]
+            if content is not None and tokenize(content):
+                # A message with exactly this content contains all its words.
+                matches = set(data_manager.search_message_ids(self.id, ' '.join(tokenize(content))))
+                message_ids = [id for id in message_ids if id in matches]
+            if content is None and time is None and pattern is None:
+                return [Message(self.id, id) for id in message_ids]
+            messages = data_manager.get_messages_bulk(self.id, message_ids)
+            message_data = [messages[id] for id in message_ids if id in messages]
         else:
             try:
                 message_data = [data_manager.get_message_data(self.id, id)]
             except KeyError:
                 message_data = []
-        if origin is not None:
-            message_data = [data for data in message_data if data['origin'] == origin]
+            if origin is not None:
+                message_data = [data for data in message_data if data['origin'] == origin]
+            if after is not None:
+                after = float(after)
+                message_data = [data for data in message_data if float(data['time']) >= after]
+            if before is not None:
+                before = float(before)
+                message_data = [data for data in message_data if float(data['time']) <= before]
+            if search is not None:
+                matches = set(data_manager.search_message_ids(self.id, search))
+                message_data = [data for data in message_data if data['id'] in matches]
         if content is not None:
             message_data = [data for data in message_data if data['content'] == content]
         if time is not None:
             message_data = [data for data in message_data if data['time'] == time]
-        if after is not None:
-            after = float(after)
-            message_data = [data for data in message_data if float(data['time']) >= after]
-        if before is not None:
-            before = float(before)
-            message_data = [data for data in message_data if float(data['time']) <= before]
         if pattern is not None:
             pattern = re.compile(pattern)
             message_data = [data for data in message_data if pattern.match(data['content'])]
-        return [Message(self.id, data['id']) for data in message_data]
+        return [Message(self.id, data['id'], data) for data in message_data]
+
+    @resolve_only_args
+    def resolve_archived_messages(self):
+        """Resolve the list of archived messages nested under the user.
+        Archived messages are not included in the other message lists, but
+        can also be looked up by ID in messages."""
+        return [Message(self.id, id) for id in data_manager.get_archived_message_ids(self.id)]
+
+    @resolve_only_args
+    def resolve_message_connection(self, first=None, after=None):
+        """Resolve a page of the messages nested under the user."""
+        if first is not None and first < 0:
+            raise ValueError("The value of first must not be negative.")
+        message_ids, next_cursor = data_manager.get_message_page(self.id, after, first)
+        return make_connection(MessageConnection, [Message(self.id, id) for id in message_ids], after, next_cursor)
 
 
 class UserInput(graphene.InputObjectType):
@@ -166,11 +286,21 @@ class Message(graphene.ObjectType):
     user = graphene.Field(User)  # The user who received or sent this message.
 
     # noinspection PyShadowingBuiltins
-    def __init__(self, user_id, id):
+    def __init__(self, user_id, id, data: dict = None):
         self.user_id = user_id
         self.id = id
+        self.loader = get_message_loader()
+        if data is None:
+            self.loader.defer(user_id, id)
+        else:
+            self.loader.prime(user_id, data)
         super().__init__()
 
+    @property
+    def data(self) -> dict:
+        """The data associated with this message."""
+        return self.loader.load(self.user_id, self.id)
+
     @resolve_only_args
     def resolve_id(self):
         """Resolve the id field of the message."""
@@ -179,20 +309,17 @@ class Message(graphene.ObjectType):
     @resolve_only_args
     def resolve_origin(self):
         """Resolve the origin field of the message."""
-        data = data_manager.get_message_data(self.user_id, self.id)
-        return data['origin']
+        return self.data['origin']
 
     @resolve_only_args
     def resolve_content(self):
         """Resolve the content field of the message."""
-        data = data_manager.get_message_data(self.user_id, self.id)
-        return data['content']
+        return self.data['content']
 
     @resolve_only_args
     def resolve_time(self):
         """Resolve the time field of the message."""
-        data = data_manager.get_message_data(self.user_id, self.id)
-        return data['time']
+        return self.data['time']
 
     @resolve_only_args
     def resolve_user(self):
@@ -200,6 +327,35 @@ class Message(graphene.ObjectType):
         return User(self.user_id)
 
 
+class MessageConnection(graphene.relay.Connection):
+    """A page of messages, in chronological order. The cursor of each edge
+    is the ID of its message."""
+
+    class Meta:
+        node = Message
+
+
+class UserConnection(graphene.relay.Connection):
+    """A page of users, in order of ID. The cursor of each edge is the ID of
+    its user."""
+
+    class Meta:
+        node = User
+
+
+def make_connection(connection_type, nodes: list, after: str, next_cursor: str):
+    """Build a connection for a page of nodes which follows the after cursor.
+    The next cursor is None if this is the last page."""
+    edges = [connection_type.Edge(node=node, cursor=node.id) for node in nodes]
+    page_info = graphene.relay.PageInfo(
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None,
+        has_previous_page=after is not None,
+        has_next_page=next_cursor is not None
+    )
+    return connection_type(edges=edges, page_info=page_info)
+
+
 class SendMessageInput(graphene.InputObjectType):
     user = graphene.InputField(UserInput)
     content = graphene.String()
@@ -250,6 +406,53 @@ class SendMessage(graphene.Mutation):
         return SendMessage(user=user, message=message, response=response, error=error)
 
 
+class SendMessages(graphene.Mutation):
+    """Send several messages, for any number of users, at once. There is one
+    result for each message, in the order the messages were given."""
+
+    class Input:
+        input = graphene.List(graphene.NonNull(SendMessageInput))
+
+    results = graphene.List(SendMessage)
+    error = graphene.String()
+
+    @staticmethod
+    def mutate(root, args, context, info) -> 'SendMessages':
+        inputs = args.get('input')
+        if inputs is None:
+            return SendMessages(results=None, error='No input specified.')
+
+        # Each input is checked the same way SendMessage checks it. Inputs
+        # which fail get an error result, and the rest are sent as a batch.
+        results = [None] * len(inputs)
+        messages = []
+        positions = []
+        for position, data in enumerate(inputs):
+            user = data.get('user')  # type: UserInput
+            content = data.get('content')  # type: str
+            if user is None:
+                error = 'No user specified.'
+            elif not content:
+                error = 'No content specified.'
+            elif user.get('id') is None:
+                error = 'No user ID specified.'
+            else:
+                messages.append((user.get('id'), content))
+                positions.append(position)
+                continue
+            results[position] = SendMessage(user=None, message=None, response=None, error=error)
+
+        for position, (user_id, _), result in zip(positions, messages, data_manager.add_messages(messages)):
+            if result is None:
+                results[position] = SendMessage(user=None, message=None, response=None, error='User not found.')
+            else:
+                message_id, response_id = result
+                response = None if response_id is None else Message(user_id, response_id)
+                results[position] = SendMessage(user=User(user_id), message=Message(user_id, message_id),
+                                                response=response, error=None)
+        return SendMessages(results=results, error=None)
+
+
 class Query(graphene.ObjectType):
     """This is the schema entry point. Queries always start from this class
     and work their way through the other classes via the properties of each
@@ -276,6 +479,11 @@ class Query(graphene.ObjectType):
         id=graphene.String(),
         name=graphene.String()
     )
+    user_connection = graphene.Field(
+        UserConnection,
+        first=graphene.Int(),
+        after=graphene.String()
+    )
 
     # noinspection PyShadowingBuiltins
     @resolve_only_args
@@ -285,8 +493,8 @@ class Query(graphene.ObjectType):
             if name is None:
                 return [User(id) for id in data_manager.get_user_ids()]
             else:
-                return [User(id) for id in data_manager.get_user_ids()
-                        if data_manager.get_user_data(id)['name'] == name]
+                users = data_manager.get_users_bulk(data_manager.get_user_ids())
+                return [User(id) for id, data in users.items() if data['name'] == name]
         else:
             try:
                 data = data_manager.get_user_data(id)
@@ -297,11 +505,20 @@ class Query(graphene.ObjectType):
             else:
                 return []
 
+    @resolve_only_args
+    def resolve_user_connection(self, first=None, after=None):
+        """Resolve a page of users at the top level of the query."""
+        if first is not None and first < 0:
+            raise ValueError("The value of first must not be negative.")
+        user_ids, next_cursor = data_manager.get_user_page(after, first)
+        return make_connection(UserConnection, [User(id) for id in user_ids], after, next_cursor)
+
 
 class Mutation(graphene.ObjectType):
     add_user = AddUser.Field()
     set_user_name = SetUserName.Field()
     send_message = SendMessage.Field()
+    send_messages = SendMessages.Field()
 
 
 # Register the schema and map it into an endpoint.
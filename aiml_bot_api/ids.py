@@ -0,0 +1,122 @@
+"""
+Message ID generation. Message IDs consist of a single character encoding the
+message's origin, followed by a fixed-width hexadecimal timestamp (in
+microseconds since the epoch, UTC) and a random suffix:
+
+    c 0005f8c3a1b2c3d4 e5f6a7
+    ^ ^                ^
+    | |                +-- random suffix, to avoid collisions across processes
+    | +-- timestamp, strictly increasing within the process
+    +-- origin ('c' for client, 's' for server)
+
+Because the timestamp is fixed-width hex, sorting IDs by everything after the
+origin character sorts them chronologically, without loading the messages.
+Earlier versions used the origin character followed by the SHA-256 hash of
+the timestamp. These legacy IDs remain valid, but carry no order; the time
+must be read from the message itself.
+"""
+
+import datetime
+import os
+import re
+import threading
+import time
+
+
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S.%f'
+
+ORIGIN_PREFIXES = {
+    'client': 'c',
+    'server': 's',
+}
+
+TIMESTAMP_DIGITS = 16
+SUFFIX_DIGITS = 6
+ID_LENGTH = 1 + TIMESTAMP_DIGITS + SUFFIX_DIGITS
+LEGACY_ID_LENGTH = 1 + 64
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_VALID_ID = re.compile(r'[cs](?:[0-9a-f]{%d}|[0-9a-f]{%d})' % (ID_LENGTH - 1, LEGACY_ID_LENGTH - 1))
+
+
+class MessageIdGenerator:
+    """Generates unique, time-ordered message IDs. Successive IDs generated
+    by the same generator always have strictly increasing timestamps, even if
+    the clock doesn't advance (or goes backwards) between calls."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_timestamp = 0
+
+    def new_id(self, origin: str) -> (str, str):
+        """Return a new message ID for a message with the given origin, along
+        with the message's time, formatted as "YYYYMMDDHHMMSS.FFFFFF"."""
+        with self._lock:
+            timestamp = max(time.time_ns() // 1000, self._last_timestamp + 1)
+            self._last_timestamp = timestamp
+        return make_id(origin, timestamp), format_timestamp(timestamp)
+
+
+def make_id(origin: str, timestamp: int) -> str:
+    """Return a message ID for a message with the given origin and
+    timestamp, in microseconds since the epoch. This is for messages with
+    times in the past, such as imported ones; unlike IDs generated by a
+    MessageIdGenerator, IDs with the same timestamp have no defined order."""
+    suffix = int.from_bytes(os.urandom(SUFFIX_DIGITS // 2), 'big')
+    return '%s%0*x%0*x' % (ORIGIN_PREFIXES[origin], TIMESTAMP_DIGITS, timestamp, SUFFIX_DIGITS, suffix)
+
+
+def format_timestamp(timestamp: int) -> str:
+    """Format a timestamp, in microseconds since the epoch, as a message
+    time string."""
+    return (EPOCH + datetime.timedelta(microseconds=timestamp)).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_time(message_time: str) -> int:
+    """Parse a message time string into a timestamp, in microseconds since
+    the epoch."""
+    delta = datetime.datetime.strptime(message_time, TIMESTAMP_FORMAT) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def is_ordered_id(message_id: str) -> bool:
+    """Return whether the message ID is a time-ordered ID, as opposed to a
+    legacy hash ID."""
+    return len(message_id) == ID_LENGTH and message_id[0] in 'cs'
+
+
+def is_valid_id(message_id: str) -> bool:
+    """Return whether the message ID is well formed, either as a
+    time-ordered ID or as a legacy hash ID."""
+    return isinstance(message_id, str) and _VALID_ID.fullmatch(message_id) is not None
+
+
+def get_id_timestamp(message_id: str) -> int:
+    """Return the timestamp, in microseconds since the epoch, encoded in a
+    time-ordered message ID. Legacy IDs have no timestamp, so None is
+    returned for them."""
+    if not is_ordered_id(message_id):
+        return None
+    try:
+        return int(message_id[1:1 + TIMESTAMP_DIGITS], 16)
+    except ValueError:
+        return None
+
+
+def get_id_origin(message_id: str) -> str:
+    """Return the origin encoded in a message ID. Both time-ordered and
+    legacy IDs begin with the origin character."""
+    for origin, prefix in ORIGIN_PREFIXES.items():
+        if message_id.startswith(prefix):
+            return origin
+    raise ValueError(message_id)
+
+
+def get_sort_key(message_id: str, message_time: str = None) -> tuple:
+    """Return a key which sorts message IDs chronologically. The message's
+    time is only required for legacy IDs, which have no embedded timestamp."""
+    timestamp = get_id_timestamp(message_id)
+    if timestamp is None:
+        return parse_time(message_time), message_id
+    return timestamp, message_id[1 + TIMESTAMP_DIGITS:]
@@ -0,0 +1,152 @@
+"""
+In-memory message indexes. A MessageIndex keeps a user's message IDs in
+chronological order, so that ordered listings and pages of messages can be
+served without loading or sorting the whole conversation. The index is built
+from the user's message store when the store is opened, and kept up to date
+as messages are added.
+
+Alongside the IDs, the index keeps each message's time as a float in a
+compact array, and a bitmap per origin. This allows time range queries to be
+answered with a bisect and origin queries with a mask, so that only the
+matching messages need to be loaded.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .ids import format_timestamp, get_id_origin, get_id_timestamp, get_sort_key, is_ordered_id
+
+
+def _insert_bit(mask: int, position: int, bit: int) -> int:
+    """Insert a bit into a bitmap at the given position, shifting the bits
+    above it up by one."""
+    low = mask & ((1 << position) - 1)
+    return ((mask >> position) << (position + 1)) | (bit << position) | low
+
+
+def _iter_bits(mask: int):
+    """Yield the positions of the set bits in a bitmap, in ascending
+    order."""
+    bits = bin(mask)[:1:-1]  # Least significant bit first, without the '0b'
+    position = bits.find('1')
+    while position >= 0:
+        yield position
+        position = bits.find('1', position + 1)
+
+
+class MessageIndex:
+    """A chronologically ordered index of a user's message IDs, times, and
+    origins."""
+
+    def __init__(self):
+        self.keys = []  # The sort keys of the messages, in order
+        self.ids = []  # The message IDs, in the same order as the keys
+        self.id_keys = {}  # Message ID -> sort key
+        self.times = array('d')  # The message times, as floats, in the same order as the keys
+        self.origin_masks = {}  # Origin -> bitmap of the positions of messages with that origin
+
+    @classmethod
+    def build(cls, messages_db, exclude=()) -> 'MessageIndex':
+        """Build the index for a message store, leaving out the message IDs
+        in exclude. The origin and time of a message are encoded in its ID,
+        so only messages with legacy IDs need to be loaded to determine
+        their times."""
+        index = cls()
+        entries = []
+        for message_id in messages_db:
+            if message_id in exclude:
+                continue
+            if is_ordered_id(message_id):
+                message_time = format_timestamp(get_id_timestamp(message_id))
+            else:
+                message_time = messages_db[message_id]['time']
+            entries.append((get_sort_key(message_id, message_time), message_id, message_time))
+        entries.sort()
+        index.keys = [key for key, _, _ in entries]
+        index.ids = [message_id for _, message_id, _ in entries]
+        index.id_keys = dict(zip(index.ids, index.keys))
+        index.times = array('d', (float(message_time) for _, _, message_time in entries))
+        origins = [get_id_origin(message_id) for message_id in index.ids]
+        for origin in set(origins):
+            # Build each bitmap from a string of bits, most significant first.
+            bits = ''.join('1' if other == origin else '0' for other in reversed(origins))
+            index.origin_masks[origin] = int(bits, 2)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self.id_keys
+
+    def add(self, message_id: str, message_time: str, origin: str) -> None:
+        """Add a message to the index. New messages almost always sort
+        last, in which case they are appended rather than inserted."""
+        if message_id in self.id_keys:
+            return
+        key = get_sort_key(message_id, message_time)
+        if not self.keys or key > self.keys[-1]:
+            position = len(self.keys)
+        else:
+            position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.ids.insert(position, message_id)
+        self.id_keys[message_id] = key
+        self.times.insert(position, float(message_time))
+        for other_origin, mask in self.origin_masks.items():
+            self.origin_masks[other_origin] = _insert_bit(mask, position, 0)
+        self.origin_masks[origin] = self.origin_masks.get(origin, 0) | (1 << position)
+
+    def drop_first(self, count: int) -> None:
+        """Remove the given number of oldest messages from the index."""
+        for message_id in self.ids[:count]:
+            del self.id_keys[message_id]
+        del self.keys[:count]
+        del self.ids[:count]
+        del self.times[:count]
+        for origin, mask in self.origin_masks.items():
+            self.origin_masks[origin] = mask >> count
+
+    def get_key(self, cursor: str) -> tuple:
+        """Return the sort key for a cursor, which is the ID of a message.
+        The cursor need not be present in the index, provided it is a
+        time-ordered ID. Otherwise, a ValueError is raised."""
+        if cursor in self.id_keys:
+            return self.id_keys[cursor]
+        if is_ordered_id(cursor):
+            return get_sort_key(cursor)
+        raise ValueError(cursor)
+
+    def page(self, after: str = None, limit: int = None, message_ids: list = None) -> (list, str):
+        """Return a page of up to limit message IDs following the message
+        ID after (or from the beginning, if after is None), along with the
+        cursor for the next page. If there are no more messages, the cursor
+        is None. If a chronologically ordered list of message IDs is given,
+        the page is taken from those messages instead of all of them."""
+        if message_ids is None:
+            message_ids, keys = self.ids, self.keys
+        else:
+            keys = [self.id_keys[message_id] for message_id in message_ids]
+        start = 0 if after is None else bisect_right(keys, self.get_key(after))
+        end = len(message_ids) if limit is None else min(start + limit, len(message_ids))
+        page = message_ids[start:end]
+        next_cursor = page[-1] if page and end < len(message_ids) else None
+        return page, next_cursor
+
+    def sort(self, message_ids) -> list:
+        """Return the given message IDs in chronological order."""
+        return sorted(message_ids, key=self.id_keys.__getitem__)
+
+    def select(self, origin: str = None, after: float = None, before: float = None) -> list:
+        """Return the IDs of the messages with the given origin and with
+        times between after and before, inclusive, in chronological order.
+        Times are compared as floats, the same way message times are
+        compared in queries."""
+        start = 0 if after is None else bisect_left(self.times, after)
+        end = len(self.times) if before is None else bisect_right(self.times, before)
+        if start >= end:
+            return []
+        if origin is None:
+            return self.ids[start:end]
+        mask = (self.origin_masks.get(origin, 0) >> start) & ((1 << (end - start)) - 1)
+        return [self.ids[start + offset] for offset in _iter_bits(mask)]
@@ -0,0 +1,241 @@
+"""
+An append-only message store. Each user's conversation is kept as a log of
+length-prefixed, pickled records in messages/<user_id>.log, so adding a
+message is a single sequential write and reading the conversation in the
+order it was written is a sequential scan. A small offset index in
+messages/<user_id>.idx maps each message ID to the position of its latest
+record, so random access by ID does not require scanning the log.
+
+The index is only an accelerator. If it is missing, or lags behind the log
+after a crash, it is rebuilt or caught up from the log itself when the log
+is opened.
+
+To convert a data folder from the default shelve layout, stop the server
+and run:
+
+    python -m aiml_bot_api.message_log migrate [DATA_FOLDER] [--remove]
+"""
+
+import argparse
+import glob
+import os
+import pickle
+import shelve
+import struct
+import sys
+import threading
+from collections.abc import MutableMapping
+
+from .brain import DEFAULT_DATA_FOLDER
+
+
+# Each record is prefixed with its length as a big-endian unsigned int.
+RECORD_HEADER = struct.Struct('>I')
+
+# The marker appended to index entries for deleted keys.
+DELETED = 'deleted'
+
+
+class MessageLog(MutableMapping):
+    """A dict-like, persistent mapping from message IDs to message data,
+    stored as an append-only log. Iteration yields message IDs in the order
+    they were first added. Reads may be made from several threads at once,
+    but writes must be serialized by the caller, with each other and with
+    reads."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + '.idx'
+        self.offsets = {}  # Message ID -> offset of its latest record in the log
+        self.log_file = open(path, 'a+b')
+        self._file_lock = threading.Lock()  # Makes each seek and the reads or writes that follow it a unit
+        self._load_index()
+        self.index_file = open(self.index_path, 'a')
+
+    def _load_index(self) -> None:
+        last_offset = None
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    if not line.endswith('\n'):
+                        break  # A partially written entry from a crash.
+                    fields = line[:-1].split('\t')
+                    key, offset = fields[0], int(fields[1])
+                    if len(fields) > 2:
+                        self.offsets.pop(key, None)
+                    else:
+                        self.offsets[key] = offset
+                    if last_offset is None or offset > last_offset:
+                        last_offset = offset
+
+        # Skip past the last indexed record.
+        end = 0
+        if last_offset is not None:
+            self.log_file.seek(last_offset)
+            header = self.log_file.read(RECORD_HEADER.size)
+            end = last_offset + RECORD_HEADER.size + RECORD_HEADER.unpack(header)[0]
+
+        # Catch up on records written after the last index entry.
+        missing = []
+        for offset, end, key, value in self._scan(end):
+            missing.append(self._index_entry(key, offset, value is None))
+            if value is None:
+                self.offsets.pop(key, None)
+            else:
+                self.offsets[key] = offset
+
+        # Drop any partially written record left at the end by a crash, so
+        # new records are not appended after it.
+        if self.log_file.seek(0, os.SEEK_END) > end:
+            self.log_file.truncate(end)
+
+        if missing:
+            with open(self.index_path, 'a') as index_file:
+                index_file.writelines(missing)
+
+    @staticmethod
+    def _index_entry(key: str, offset: int, deleted: bool = False) -> str:
+        if deleted:
+            return '%s\t%d\t%s\n' % (key, offset, DELETED)
+        return '%s\t%d\n' % (key, offset)
+
+    def _scan(self, offset: int = 0):
+        """Yield (offset, end, key, value) for each complete record in the
+        log, starting at the given offset, where end is the offset following
+        the record. Deleted keys have a value of None. The log is read
+        through a file object of its own, so a scan doesn't disturb other
+        reads."""
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(offset)
+            while True:
+                header = log_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                payload = log_file.read(RECORD_HEADER.unpack(header)[0])
+                if len(payload) < RECORD_HEADER.unpack(header)[0]:
+                    return  # A partially written record from a crash.
+                record = pickle.loads(payload)
+                end = offset + RECORD_HEADER.size + len(payload)
+                yield offset, end, record[0], (record[1] if len(record) > 1 else None)
+                offset = end
+
+    def _append(self, record: tuple) -> int:
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self._file_lock:
+            self.log_file.seek(0, os.SEEK_END)
+            offset = self.log_file.tell()
+            self.log_file.write(RECORD_HEADER.pack(len(payload)) + payload)
+            self.log_file.flush()
+        return offset
+
+    def _read(self, offset: int):
+        with self._file_lock:
+            self.log_file.seek(offset)
+            size, = RECORD_HEADER.unpack(self.log_file.read(RECORD_HEADER.size))
+            payload = self.log_file.read(size)
+        return pickle.loads(payload)[1]
+
+    def __getitem__(self, key: str) -> dict:
+        return self._read(self.offsets[key])
+
+    def __setitem__(self, key: str, value: dict) -> None:
+        offset = self._append((key, value))
+        self.index_file.write(self._index_entry(key, offset))
+        self.index_file.flush()
+        self.offsets[key] = offset
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self.offsets:
+            raise KeyError(key)
+        offset = self._append((key,))
+        self.index_file.write(self._index_entry(key, offset, deleted=True))
+        self.index_file.flush()
+        del self.offsets[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.offsets
+
+    def __iter__(self):
+        return iter(list(self.offsets))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def values_in_order(self):
+        """Yield the current value of each message in the order the messages
+        were written, as a sequential scan of the log."""
+        for offset, _, key, value in self._scan():
+            if self.offsets.get(key) == offset:
+                yield value
+
+    def close(self) -> None:
+        """Close the underlying files."""
+        self.index_file.close()
+        self.log_file.close()
+
+
+def open_message_log(data_folder: str, user_id: str) -> MessageLog:
+    """Open the message log for the given user."""
+    return MessageLog(os.path.join(data_folder, 'messages', user_id + '.log'))
+
+
+def get_shelve_user_ids(data_folder: str) -> list:
+    """Return the IDs of the users with shelve message files in the data
+    folder. Depending on the dbm implementation, each shelf may consist of
+    several files, e.g. <user_id>.db.dat and <user_id>.db.dir."""
+    user_ids = set()
+    for path in glob.glob(os.path.join(data_folder, 'messages', '*.db*')):
+        name = os.path.basename(path)
+        user_ids.add(name[:name.index('.db')])
+    return sorted(user_ids)
+
+
+def migrate_shelve_messages(data_folder: str, remove: bool = False) -> dict:
+    """Copy each user's messages from the shelve layout into a message log,
+    in chronological order. If remove is set, the shelve files are deleted
+    once their messages have been copied. Users which already have a message
+    log are skipped. Return a mapping from each migrated user ID to the
+    number of messages copied. This must not be run while the data folder
+    is in use by a data manager."""
+    data_folder = os.path.expanduser(data_folder)
+    counts = {}
+    for user_id in get_shelve_user_ids(data_folder):
+        shelf_path = os.path.join(data_folder, 'messages', user_id + '.db')
+        log_path = os.path.join(data_folder, 'messages', user_id + '.log')
+        if os.path.exists(log_path):
+            continue
+        with shelve.open(shelf_path, 'r') as messages_db:
+            messages = sorted(messages_db.values(), key=lambda data: (data['time'], data['id']))
+        message_log = MessageLog(log_path + '.tmp')
+        try:
+            for data in messages:
+                message_log[data['id']] = data
+        finally:
+            message_log.close()
+        # Put the index in place before the log, so an interruption leaves
+        # either no log (and the migration is retried) or a complete one.
+        os.replace(message_log.index_path, os.path.splitext(log_path)[0] + '.idx')
+        os.replace(log_path + '.tmp', log_path)
+        if remove:
+            for path in glob.glob(glob.escape(shelf_path) + '*'):
+                os.remove(path)
+        counts[user_id] = len(messages)
+    return counts
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(prog='python -m aiml_bot_api.message_log',
+                                     description="Manage append-only message logs.")
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('data_folder', nargs='?', default=DEFAULT_DATA_FOLDER)
+    parser.add_argument('--remove', action='store_true', help="Delete shelve files after migrating them.")
+    arguments = parser.parse_args(args)
+
+    counts = migrate_shelve_messages(arguments.data_folder, arguments.remove)
+    print("Migrated %d messages for %d users." % (sum(counts.values()), len(counts)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Instrumentation. The API records latency histograms for its endpoints and
+GraphQL operations, bot responses, storage operations, and lock waits and
+holds, along with the data manager's cache counters, and exposes them in
+the Prometheus text format on the /metrics endpoint.
+
+Instrumentation is disabled by default. It is enabled by calling enable()
+before the data manager is created, or by setting the AIML_BOT_API_METRICS
+environment variable to 1 before the API is started. While it is disabled,
+each instrumented operation costs a single attribute check.
+"""
+
+import bisect
+import os
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+
+# The default histogram buckets, in seconds.
+LATENCY_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+class Histogram:
+    """A histogram metric, with a separate set of buckets for each
+    combination of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # Label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values) -> None:
+        """Record an observation. The label values are given in the order
+        of the label names."""
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if position < len(self.buckets):
+                series[position] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        """Return the lines of the metric in the Prometheus text format."""
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted((label_values, list(counts)) for label_values, counts in self._series.items())
+        for label_values, counts in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.label_names + ('le',), label_values + (bound,))
+                lines.append('%s_bucket%s %s' % (self.name, labels, cumulative))
+            labels = _format_labels(self.label_names + ('le',), label_values + ('+Inf',))
+            lines.append('%s_bucket%s %s' % (self.name, labels, counts[-1]))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append('%s_sum%s %r' % (self.name, labels, float(counts[-2])))
+            lines.append('%s_count%s %s' % (self.name, labels, counts[-1]))
+        return lines
+
+
+class Registry:
+    """The set of metrics exposed by the API. Besides histograms, which are
+    updated as events happen, collectors can be registered: functions which
+    are called when the metrics are rendered, and return a list of tuples
+    (name, type, documentation, samples), where samples is a list of
+    (labels, value) pairs and labels is a dictionary."""
+
+    def __init__(self):
+        self.enabled = False
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        """Return the histogram with the given name, creating it if
+        necessary."""
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name, documentation, label_names, buckets)
+            return self._histograms[name]
+
+    def add_collector(self, collector) -> None:
+        """Register a function to be called for samples when the metrics are
+        rendered."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector) -> None:
+        """Unregister a collector."""
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text format."""
+        with self._lock:
+            histograms = [self._histograms[name] for name in sorted(self._histograms)]
+            collectors = list(self._collectors)
+        lines = []
+        for histogram in histograms:
+            lines.extend(histogram.render())
+        for collector in collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append('# HELP %s %s' % (name, documentation))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in samples:
+                    lines.append('%s%s %s' % (name, _format_labels(tuple(labels), tuple(labels.values())), value))
+        return '\n'.join(lines) + '\n'
+
+
+# The registry used throughout the API.
+registry = Registry()
+
+
+def enable() -> None:
+    """Turn on instrumentation."""
+    registry.enabled = True
+
+
+def is_enabled() -> bool:
+    """Return whether instrumentation is turned on."""
+    return registry.enabled
+
+
+@contextmanager
+def timed(histogram: Histogram, *label_values):
+    """Time the body of the with statement, recording the duration in the
+    histogram if instrumentation is enabled."""
+    if not registry.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, *label_values)
+
+
+class TimedStore(MutableMapping):
+    """A dict-like store wrapper which records the duration of each read and
+    write of the wrapped store."""
+
+    def __init__(self, store: MutableMapping, name: str):
+        self.store = store
+        self.name = name
+
+    def _observe(self, operation: str, start: float) -> None:
+        STORAGE_SECONDS.observe(time.perf_counter() - start, self.name, operation)
+
+    def __getitem__(self, key):
+        start = time.perf_counter()
+        try:
+            return self.store[key]
+        finally:
+            self._observe('read', start)
+
+    def __setitem__(self, key, value) -> None:
+        start = time.perf_counter()
+        try:
+            self.store[key] = value
+        finally:
+            self._observe('write', start)
+
+    def __delitem__(self, key) -> None:
+        start = time.perf_counter()
+        try:
+            del self.store[key]
+        finally:
+            self._observe('delete', start)
+
+    def __contains__(self, key) -> bool:
+        start = time.perf_counter()
+        try:
+            return key in self.store
+        finally:
+            self._observe('read', start)
+
+    def __iter__(self):
+        start = time.perf_counter()
+        keys = list(self.store)
+        self._observe('scan', start)
+        return iter(keys)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def sync(self) -> None:
+        """Flush the wrapped store, if it supports flushing."""
+        if hasattr(self.store, 'sync'):
+            start = time.perf_counter()
+            self.store.sync()
+            self._observe('sync', start)
+
+    def close(self) -> None:
+        """Close the wrapped store."""
+        self.store.close()
+
+
+def instrument_store(store: MutableMapping, name: str) -> MutableMapping:
+    """Return the store wrapped in a TimedStore if instrumentation is
+    enabled, or the store itself otherwise."""
+    return TimedStore(store, name) if registry.enabled else store
+
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'aiml_bot_api_http_request_duration_seconds', "Time spent handling HTTP requests.",
+    ('endpoint', 'method', 'status'))
+GRAPHQL_OPERATION_SECONDS = registry.histogram(
+    'aiml_bot_api_graphql_operation_duration_seconds', "Time spent executing GraphQL operations.",
+    ('operation',))
+BOT_RESPONSE_SECONDS = registry.histogram(
+    'aiml_bot_api_bot_response_duration_seconds', "Time spent waiting for bot responses, including queueing.")
+STORAGE_SECONDS = registry.histogram(
+    'aiml_bot_api_storage_operation_duration_seconds', "Time spent in storage operations.",
+    ('store', 'operation'))
+LOCK_WAIT_SECONDS = registry.histogram(
+    'aiml_bot_api_lock_wait_seconds', "Time spent waiting to acquire locks.", ('lock', 'scope', 'mode'))
+LOCK_HOLD_SECONDS = registry.histogram(
+    'aiml_bot_api_lock_hold_seconds', "Time locks were held.", ('lock', 'scope', 'mode'))
+
+
+if os.environ.get('AIML_BOT_API_METRICS') == '1':
+    enable()
@@ -0,0 +1,231 @@
+"""
+Response memoization. Many inputs, like greetings and frequently asked
+questions, get the same response no matter who sends them. A ResponseCache
+remembers the responses to such inputs so the bot doesn't have to process
+the matched templates again.
+
+A response depends on more than the input, though. The template it comes
+from is selected using the bot's previous response ('that') and the current
+topic, and the template may read session predicates. So when a response is
+computed, everything the bot looked at is recorded along with it:
+
+* every pattern match made, including those made by <srai> and <sr>, as
+  the normalized input and the template that was selected, and
+* the value of every session predicate that was read.
+
+A cached response is only reused if matching each recorded input in the
+current session selects the same templates again, and every recorded
+predicate still has the same value. Pattern matching is cheap compared to
+template processing, so this check is much faster than computing the
+response.
+
+Responses from templates with side effects or nondeterministic output, such
+as <random>, <set>, <think>, <learn>, or <system>, or which depend on the
+conversation history, such as <input> and <that>, are never cached. Only
+single-sentence inputs are cached, since the bot updates the conversation
+history between the sentences of an input.
+
+The recording is done by temporarily replacing the bot's _process_element(),
+get_predicate(), and brain's match() methods, which aren't part of
+aiml_bot's public interface, so setup.py limits aiml_bot to the versions
+this was written against.
+"""
+
+import threading
+from collections import OrderedDict
+
+import aiml_bot
+from aiml_bot.utilities import split_sentences
+
+from .cache import CacheStats
+
+
+# Template elements whose output can't be reused for another session, or for
+# the same session at another time.
+UNCACHEABLE_ELEMENTS = frozenset([
+    'date',
+    'gossip',
+    'id',
+    'input',
+    'javascript',
+    'learn',
+    'random',
+    'set',
+    'size',
+    'system',
+    'that',
+    'thatstar',
+    'think',
+])
+
+
+class ResponseCacheStats(CacheStats):
+    """Counters describing the behavior of a response cache."""
+
+    def __init__(self):
+        super().__init__()
+        self.uncacheable = 0  # Responses which could not be cached
+
+    def as_dict(self) -> dict:
+        """Return the counters as a dictionary."""
+        counters = super().as_dict()
+        counters['uncacheable'] = self.uncacheable
+        return counters
+
+
+class CachedResponse:
+    """A response, along with the pattern matches and predicate values it
+    was computed from."""
+
+    __slots__ = ['matches', 'predicates', 'response']
+
+    def __init__(self, matches: tuple, predicates: tuple, response: str):
+        self.matches = matches  # (normalized input, template) pairs
+        self.predicates = predicates  # (name, value) pairs
+        self.response = response
+
+    def is_valid(self, bot: aiml_bot.Bot, session_id: str, that: str, topic: str) -> bool:
+        """Return whether the response is what the bot would respond with in
+        the session. The that and topic must be normalized."""
+        for name, value in self.predicates:
+            if bot.get_predicate(name, session_id) != value:
+                return False
+        for text, template in self.matches:
+            if bot._brain.match(text, that, topic) is not template:
+                return False
+        return True
+
+
+class _Trace:
+    """Records what the bot looks at while it computes a response, by
+    temporarily intercepting its element processing, predicate reads, and
+    pattern matches."""
+
+    def __init__(self, bot: aiml_bot.Bot):
+        self.bot = bot
+        self.matches = []
+        self.predicates = {}
+        self.cacheable = True
+
+    def _process_element(self, element: list, session_id: str) -> str:
+        if element[0] in UNCACHEABLE_ELEMENTS:
+            self.cacheable = False
+        return type(self.bot)._process_element(self.bot, element, session_id)
+
+    def get_predicate(self, name: str, session_id: str = None) -> str:
+        value = type(self.bot).get_predicate(self.bot, name, session_id)
+        self.predicates.setdefault(name, value)
+        return value
+
+    def match(self, pattern: str, that: str, topic: str):
+        brain = self.bot._brain
+        template = type(brain).match(brain, pattern, that, topic)
+        self.matches.append((pattern, template))
+        return template
+
+    def __enter__(self) -> '_Trace':
+        self.bot._process_element = self._process_element
+        self.bot.get_predicate = self.get_predicate
+        self.bot._brain.match = self.match
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        del self.bot._process_element
+        del self.bot.get_predicate
+        del self.bot._brain.match
+
+
+class ResponseCache:
+    """A size-bounded cache of bot responses, keyed by normalized input.
+    Several responses can be cached for the same input, for sessions in
+    different states, up to max_variants. When more than max_entries
+    responses are cached, those for the least recently used inputs are
+    evicted."""
+
+    def __init__(self, max_entries: int = 10000, max_variants: int = 4):
+        if max_entries < 1:
+            raise ValueError(max_entries)
+        self.max_entries = max_entries
+        self.max_variants = max_variants
+        self.stats = ResponseCacheStats()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Normalized input -> list of CachedResponse, least recently used first
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def respond(self, bot: aiml_bot.Bot, text: str, session_id: str) -> str:
+        """Return the bot's response to the text in the session, the same as
+        bot.respond(text, session_id) would, reusing a cached response if
+        possible."""
+        sentences = split_sentences(text) if text else []
+        if len(sentences) != 1:
+            with self._lock:
+                self.stats.uncacheable += 1
+            return bot.respond(text, session_id)
+        sentence = sentences[0]
+
+        with bot._respond_lock:
+            bot.add_session(session_id)
+            normal = bot._subbers['normal']
+            key = normal.sub(sentence)
+            output_history = bot.get_output_history(session_id)
+            that = normal.sub(output_history[-1] if output_history else '')
+            topic = normal.sub(bot.get_predicate('topic', session_id))
+
+            with self._lock:
+                variants = list(self._entries.get(key, ()))
+            for cached in variants:
+                if cached.is_valid(bot, session_id, that, topic):
+                    with self._lock:
+                        if key in self._entries:
+                            self._entries.move_to_end(key)
+                        self.stats.hits += 1
+                    self._record_exchange(bot, session_id, sentence, cached.response)
+                    return cached.response
+
+            with _Trace(bot) as trace:
+                response = bot.respond(text, session_id)
+
+            with self._lock:
+                self.stats.misses += 1
+                if trace.cacheable:
+                    self._add(key, CachedResponse(tuple(trace.matches), tuple(trace.predicates.items()), response))
+                else:
+                    self.stats.uncacheable += 1
+            return response
+
+    @staticmethod
+    def _record_exchange(bot: aiml_bot.Bot, session_id: str, sentence: str, response: str) -> None:
+        # Update the conversation history the same way bot.respond() does.
+        input_history = bot.get_input_history(session_id)
+        input_history.append(sentence)
+        del input_history[:-bot._max_history_size]
+        bot.set_input_history(input_history, session_id)
+        output_history = bot.get_output_history(session_id)
+        output_history.append(response)
+        del output_history[:-bot._max_history_size]
+        bot.set_output_history(output_history, session_id)
+
+    def _add(self, key: str, cached: CachedResponse) -> None:
+        # Must be called with self._lock held.
+        variants = self._entries.setdefault(key, [])
+        self._entries.move_to_end(key)
+        variants.insert(0, cached)
+        self._count += 1
+        if len(variants) > self.max_variants:
+            variants.pop()
+            self._count -= 1
+            self.stats.evictions += 1
+        while self._count > self.max_entries and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._count -= len(evicted)
+            self.stats.evictions += len(evicted)
+
+    def clear(self) -> None:
+        """Discard all cached responses. This must be done whenever the
+        bot's brain changes."""
+        with self._lock:
+            self._entries.clear()
+            self._count = 0
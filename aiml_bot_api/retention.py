@@ -0,0 +1,133 @@
+"""
+Message retention. A RetentionPolicy limits the messages kept in the users'
+live message stores, by age, by number per user, or both. The data manager
+applies its policy periodically, on a background thread: each user's oldest
+messages beyond the limits are moved into the user's compressed, read-only
+archive (see the archive module), where they can still be read by ID, and
+the user's live store is then compacted, if the storage backend supports it,
+to give back the space they took. Compaction copies the live messages to a
+new store a batch at a time, so messages can still be added in the meantime,
+and only holds up the user's writers while the few messages added during the
+copy are carried over and the new store is put in place.
+
+A deployment's policy is configured with these environment variables:
+
+* AIML_BOT_API_RETENTION_DAYS: Messages older than this many days are
+  archived.
+* AIML_BOT_API_RETENTION_MAX_MESSAGES: Only this many of each user's most
+  recent messages are kept live.
+* AIML_BOT_API_RETENTION_INTERVAL: The number of seconds between passes
+  (3600 by default).
+
+If neither of the first two is set, nothing is archived.
+"""
+
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from .ids import format_timestamp
+
+
+log = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """Which messages are kept in the live message stores. Messages older
+    than max_age seconds, and all but the max_messages most recent messages
+    of each user, are archived. The policy is applied every interval
+    seconds, archiving up to segment_size messages per archive segment."""
+
+    def __init__(self, max_age: float = None, max_messages: int = None, interval: float = 3600,
+                 segment_size: int = 1000):
+        if max_age is None and max_messages is None:
+            raise ValueError("A retention policy needs a maximum age or a maximum number of messages.")
+        if (max_age is not None and max_age < 0) or (max_messages is not None and max_messages < 0):
+            raise ValueError("Retention limits must not be negative.")
+        if segment_size < 1:
+            raise ValueError(segment_size)
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.interval = interval
+        self.segment_size = segment_size
+
+    @classmethod
+    def from_environment(cls) -> 'RetentionPolicy':
+        """Return the policy configured by the environment variables, or
+        None if there is none."""
+        days = os.environ.get('AIML_BOT_API_RETENTION_DAYS')
+        max_messages = os.environ.get('AIML_BOT_API_RETENTION_MAX_MESSAGES')
+        if not days and not max_messages:
+            return None
+        return cls(max_age=float(days) * 24 * 60 * 60 if days else None,
+                   max_messages=int(max_messages) if max_messages else None,
+                   interval=float(os.environ.get('AIML_BOT_API_RETENTION_INTERVAL') or 3600))
+
+    def as_dict(self) -> dict:
+        """Return the policy's settings, as keyword arguments for the
+        constructor."""
+        return {
+            'max_age': self.max_age,
+            'max_messages': self.max_messages,
+            'interval': self.interval,
+            'segment_size': self.segment_size,
+        }
+
+    def get_cutoff(self, now: float = None) -> float:
+        """Return the time before which messages are archived, as a float
+        comparable with message times, or None if there is no age limit."""
+        if self.max_age is None:
+            return None
+        now = time.time() if now is None else now
+        return float(format_timestamp(int((now - self.max_age) * 1000000)))
+
+    def count_expired(self, times, cutoff: float = None) -> int:
+        """Given the times of a user's live messages, as floats in
+        chronological order, and the cutoff returned by get_cutoff(), return
+        the number of oldest messages which should be archived."""
+        count = 0
+        if self.max_messages is not None:
+            count = max(len(times) - self.max_messages, 0)
+        if cutoff is not None:
+            count = max(count, bisect_left(times, cutoff))
+        return count
+
+    def has_expired(self, oldest: float, count: int, cutoff: float = None) -> bool:
+        """Given the time of a user's oldest live message, as a float (or
+        None if there are none), the number of live messages, and the cutoff
+        returned by get_cutoff(), return whether any of them should be
+        archived."""
+        if self.max_messages is not None and count > self.max_messages:
+            return True
+        return cutoff is not None and oldest is not None and oldest < cutoff
+
+
+class RetentionWorker:
+    """Applies a data manager's retention policy every interval seconds, on
+    a background thread."""
+
+    def __init__(self, data_manager, policy: RetentionPolicy):
+        self.data_manager = data_manager
+        self.policy = policy
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Retention', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.policy.interval):
+            # noinspection PyBroadException
+            try:
+                summary = self.data_manager.apply_retention(self.policy)
+            except Exception:
+                log.exception("Error applying the retention policy:")
+                continue
+            if summary['archived']:
+                log.info("Archived %d messages of %d users.", summary['archived'], summary['users'])
+
+    def stop(self) -> None:
+        """Stop the background thread, waiting for a pass in progress to
+        stop."""
+        self._stopped.set()
+        self._thread.join()
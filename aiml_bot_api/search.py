@@ -0,0 +1,87 @@
+"""
+Full-text search over message content. A TokenIndex is an inverted index
+from the words appearing in a user's messages to the IDs of the messages
+containing them. Search queries consist of one or more whitespace-separated
+terms, all of which must match. A term ending in '*' matches any word with
+that prefix; any other term matches the word exactly. Matching is
+case-insensitive.
+"""
+
+import re
+from bisect import bisect_left, insort
+
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> list:
+    """Split text into lower-case word tokens."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_query(query: str) -> list:
+    """Parse a search query into a list of (word, is_prefix) terms.
+    Punctuation within a term splits it into several terms, just as it
+    splits words in the indexed content."""
+    terms = []
+    for term in query.split():
+        is_prefix = term.endswith('*')
+        words = tokenize(term)
+        for position, word in enumerate(words):
+            terms.append((word, is_prefix and position == len(words) - 1))
+    return terms
+
+
+class TokenIndex:
+    """An inverted index from words to the IDs of the messages containing
+    them."""
+
+    def __init__(self):
+        self.postings = {}  # Word -> set of message IDs
+        self.words = []  # The indexed words, in sorted order, for prefix queries
+
+    @classmethod
+    def build(cls, messages) -> 'TokenIndex':
+        """Build the index from an iterable of message data."""
+        index = cls()
+        for data in messages:
+            for word in set(tokenize(data['content'])):
+                index.postings.setdefault(word, set()).add(data['id'])
+        index.words = sorted(index.postings)
+        return index
+
+    def add(self, message_id: str, content: str) -> None:
+        """Add a message to the index."""
+        for word in set(tokenize(content)):
+            if word not in self.postings:
+                self.postings[word] = set()
+                insort(self.words, word)
+            self.postings[word].add(message_id)
+
+    def match_term(self, word: str, is_prefix: bool = False) -> set:
+        """Return the IDs of the messages containing the word, or a word
+        beginning with it, if is_prefix is set."""
+        if not is_prefix:
+            return set(self.postings.get(word, ()))
+        message_ids = set()
+        position = bisect_left(self.words, word)
+        while position < len(self.words) and self.words[position].startswith(word):
+            message_ids |= self.postings[self.words[position]]
+            position += 1
+        return message_ids
+
+    def search(self, query: str) -> set:
+        """Return the IDs of the messages matching every term of the query.
+        A query without any terms matches nothing."""
+        terms = parse_query(query)
+        if not terms:
+            return set()
+        # Start with the term with the fewest matches, to keep the
+        # intersections small.
+        matches = sorted((self.match_term(word, is_prefix) for word, is_prefix in terms), key=len)
+        result = matches[0]
+        for message_ids in matches[1:]:
+            if not result:
+                break
+            result &= message_ids
+        return result
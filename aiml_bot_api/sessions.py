@@ -0,0 +1,211 @@
+"""
+Write-behind persistence for bot sessions. Saving a session after every bot
+reply would rewrite the pickled session in the underlying store each time,
+so instead a SessionStore keeps the latest data for each changed session in
+memory, marked dirty, and a background thread flushes the dirty sessions to
+the underlying store in batches, either every flush_interval seconds or as
+soon as max_dirty sessions are dirty, whichever comes first.
+
+Before a batch is applied to the underlying store, it is written to a small
+journal file and synced to disk. If the process crashes while the batch is
+being applied, the batch is replayed from the journal the next time the
+store is opened. Sessions which were changed but not yet flushed when the
+process crashed are lost, so a crash loses at most one flush interval of
+session changes.
+"""
+
+import logging
+import os
+import pickle
+import threading
+from collections.abc import MutableMapping
+
+from .message_log import RECORD_HEADER
+
+
+log = logging.getLogger(__name__)
+
+
+# Marks a session which was deleted but not yet flushed.
+_DELETED = object()
+
+
+def read_journal(path: str) -> dict:
+    """Return the batch of session changes recorded in the journal, or an
+    empty dictionary if there is no journal or it was not completely
+    written. Deleted sessions are mapped to None."""
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'rb') as journal:
+        header = journal.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return {}
+        size, = RECORD_HEADER.unpack(header)
+        record = journal.read(size)
+    if len(record) < size:
+        return {}  # The batch was never applied, so there's nothing to recover.
+    return pickle.loads(record)
+
+
+def write_journal(path: str, batch: dict) -> None:
+    """Durably record a batch of session changes in the journal. Deleted
+    sessions are mapped to None."""
+    record = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+    with open(path, 'wb') as journal:
+        journal.write(RECORD_HEADER.pack(len(record)))
+        journal.write(record)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+class SessionStore(MutableMapping):
+    """A thread-safe, dict-like, write-behind cache in front of a persistent
+    session store. Reads see the latest written data, whether or not it has
+    been flushed yet."""
+
+    def __init__(self, store: MutableMapping, journal_path: str, flush_interval: float = 1.0,
+                 max_dirty: int = 100):
+        self.store = store
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()  # Serializes access to the underlying store
+        self._dirty = {}  # User ID -> session data (or _DELETED), not yet flushed
+        self._flushing = {}  # The same, for the batch currently being flushed
+        self._flush_requested = threading.Condition(self._lock)
+        self._closed = False
+
+        self._recover()
+
+        self._thread = threading.Thread(target=self._run, name='SessionStore flush', daemon=True)
+        self._thread.start()
+
+    def _recover(self) -> None:
+        batch = read_journal(self.journal_path)
+        if batch:
+            log.info("Replaying %s session changes from %s.", len(batch), self.journal_path)
+            self._apply({user_id: _DELETED if data is None else data for user_id, data in batch.items()})
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _lookup(self, user_id: str):
+        # Must be called with self._lock held. Returns None if the latest
+        # data for the session is in the underlying store.
+        if user_id in self._dirty:
+            return self._dirty[user_id]
+        return self._flushing.get(user_id)
+
+    def __getitem__(self, user_id: str) -> dict:
+        with self._lock:
+            data = self._lookup(user_id)
+        if data is _DELETED:
+            raise KeyError(user_id)
+        if data is not None:
+            return data
+        with self._store_lock:
+            return self.store[user_id]
+
+    def __setitem__(self, user_id: str, data: dict) -> None:
+        with self._lock:
+            self._dirty[user_id] = data
+            if len(self._dirty) >= self.max_dirty:
+                self._flush_requested.notify_all()
+
+    def __delitem__(self, user_id: str) -> None:
+        if user_id not in self:
+            raise KeyError(user_id)
+        with self._lock:
+            self._dirty[user_id] = _DELETED
+
+    def __contains__(self, user_id) -> bool:
+        with self._lock:
+            data = self._lookup(user_id)
+        if data is not None:
+            return data is not _DELETED
+        with self._store_lock:
+            return user_id in self.store
+
+    def __iter__(self):
+        with self._lock:
+            pending = dict(self._flushing)
+            pending.update(self._dirty)
+        with self._store_lock:
+            user_ids = set(self.store)
+        for user_id, data in pending.items():
+            if data is _DELETED:
+                user_ids.discard(user_id)
+            else:
+                user_ids.add(user_id)
+        return iter(sorted(user_ids))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    @property
+    def dirty_count(self) -> int:
+        """The number of sessions with changes which have not been flushed."""
+        return len(self._dirty)
+
+    def _apply(self, batch: dict) -> None:
+        with self._store_lock:
+            for user_id, data in batch.items():
+                if data is _DELETED:
+                    if user_id in self.store:
+                        del self.store[user_id]
+                else:
+                    self.store[user_id] = data
+            if hasattr(self.store, 'sync'):
+                self.store.sync()
+
+    def flush(self) -> None:
+        """Write all dirty sessions to the underlying store, on the calling
+        thread."""
+        with self._lock:
+            while self._flushing:
+                # Another thread is flushing; wait for it to finish, so that
+                # batches are applied in order.
+                self._flush_requested.wait()
+            batch, self._dirty = self._dirty, {}
+            self._flushing = batch
+        try:
+            if batch:
+                write_journal(self.journal_path, {user_id: None if data is _DELETED else data
+                                                  for user_id, data in batch.items()})
+                self._apply(batch)
+                os.remove(self.journal_path)
+        except Exception:
+            # Keep the batch dirty, so it's retried on the next flush, unless
+            # the sessions have been changed again in the meantime.
+            with self._lock:
+                batch.update(self._dirty)
+                self._dirty = batch
+            raise
+        finally:
+            with self._lock:
+                self._flushing = {}
+                self._flush_requested.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._closed and len(self._dirty) < self.max_dirty:
+                    self._flush_requested.wait(self.flush_interval)
+                if self._closed:
+                    return
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error flushing sessions:")
+
+    def close(self) -> None:
+        """Stop the background thread, flush all dirty sessions, and close
+        the underlying store."""
+        with self._lock:
+            self._closed = True
+            self._flush_requested.notify_all()
+        self._thread.join()
+        self.flush()
+        self.store.close()
@@ -0,0 +1,702 @@
+"""
+Multi-process user sharding. Users are divided among several shards, each a
+separate worker process running its own DataManager, with its own data
+folder and bots, so bot responses and storage access for users on different
+shards run in parallel without sharing a GIL. A ShardedDataManager in the
+serving process acts as the router: it has the same interface as a
+DataManager, and forwards each operation on a single user to the shard that
+owns the user, which is chosen by consistent hashing of the user ID.
+Operations on all users, like listing them, are fanned out to every shard
+and the results merged.
+
+To serve sharded, set the AIML_BOT_API_SHARDS environment variable to the
+number of shards before the API is started. Shard i keeps its data in the
+shard-<i> subfolder of the data folder, and the number of shards is recorded
+in shards.json. When the API is started with a different number of shards,
+the users whose shard has changed are moved to their new shards before any
+requests are served. Consistent hashing keeps this to about 1/N of the users
+when a shard is added. Likewise, when a data folder which was used without
+sharding is first used with shards, its users are moved into the shards. A
+rebalance which is interrupted is resumed the next time. Rebalancing can
+also be done offline:
+
+    python -m aiml_bot_api.sharding rebalance [DATA_FOLDER] --shards N
+
+Each shard's process is started with `python -m aiml_bot_api.sharding shard`,
+listens on a local port, and exits when the serving process closes it or
+goes away. Metrics from the shards' caches are summed into the serving
+process's metrics, but the shards' latency histograms are not collected.
+"""
+
+import argparse
+import bisect
+import glob
+import hashlib
+import heapq
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+from . import metrics
+from .brain import DEFAULT_DATA_FOLDER
+from .data import DataManager
+from .retention import RetentionPolicy
+from .storage import SQLiteBackend
+
+
+log = logging.getLogger(__name__)
+
+
+# The number of points each shard is given on the hash ring. More points
+# spread the users more evenly among the shards.
+DEFAULT_REPLICAS = 100
+
+# The file in the data folder which records how users are sharded.
+STATE_FILE = 'shards.json'
+
+# The environment variable used to hand each shard process its
+# authentication key.
+AUTHKEY_VARIABLE = 'AIML_BOT_API_SHARD_AUTHKEY'
+
+# The most messages sent to a shard in a single call when importing.
+IMPORT_CHUNK_SIZE = 1000
+
+# The files in the data folder which hold the users of a data manager which
+# is not sharded, for each storage backend.
+UNSHARDED_USER_FILES = ['users.db*', SQLiteBackend.FILE_NAME]
+
+# The index of the shard process which serves the data of a data manager
+# which is not sharded, while its users are moved into the shards.
+UNSHARDED_INDEX = -1
+
+# How long a message listener's watcher waits on its shard before checking
+# whether it is still needed, in seconds.
+WATCH_TIMEOUT = 5
+
+
+def _hash(key: str) -> int:
+    # A stable hash, unlike hash(), which varies between processes.
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """A consistent hash ring, mapping keys to shard indices. Each shard has
+    a number of points on the ring, and a key belongs to the shard owning
+    the first point at or after the key's hash. When a shard is added, it
+    only takes over the keys which hash just before its new points."""
+
+    def __init__(self, shards: int, replicas: int = DEFAULT_REPLICAS):
+        if shards < 1:
+            raise ValueError(shards)
+        points = sorted((_hash('%d:%d' % (shard, replica)), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self.shards = shards
+        self.replicas = replicas
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        """Return the index of the shard which owns the key."""
+        position = bisect.bisect_left(self._hashes, _hash(key))
+        return self._owners[position % len(self._owners)]
+
+
+class ShardClient(BaseManager):
+    """A connection to a shard process's data manager."""
+
+
+ShardClient.register('data_manager')
+
+
+class Shard:
+    """A shard's worker process, and a proxy for the data manager it runs.
+    The proxy can be used from any thread."""
+
+    def __init__(self, index: int, data_folder: str, options: dict = None):
+        self.index = index
+        self.data_folder = data_folder
+        authkey = os.urandom(32)
+        environment = dict(os.environ)
+        environment[AUTHKEY_VARIABLE] = authkey.hex()
+        environment['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        if metrics.registry.enabled:
+            environment['AIML_BOT_API_METRICS'] = '1'
+        command = [sys.executable, '-m', 'aiml_bot_api.sharding', 'shard', data_folder,
+                   '--options', json.dumps(options or {})]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+        # The shard reports its address once its data manager is ready.
+        line = self.process.stdout.readline()
+        if not line:
+            self.process.wait()
+            raise RuntimeError("Shard %d failed to start." % index)
+        host, port = json.loads(line.decode('utf-8'))
+        client = ShardClient(address=(host, port), authkey=authkey)
+        client.connect()
+        self.data_manager = client.data_manager()  # type: DataManager
+
+    def close(self, timeout: float = 60) -> None:
+        """Close the shard's data manager and stop its process."""
+        if self.process.poll() is not None:
+            return
+        try:
+            self.data_manager.close()
+        finally:
+            # The shard process exits when its input is closed.
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                log.warning("Shard %d did not exit; terminating it.", self.index)
+                self.process.terminate()
+                self.process.wait()
+
+
+def get_shard_folder(data_folder: str, index: int) -> str:
+    """Return the data folder of the shard with the given index."""
+    return os.path.join(data_folder, 'shard-%d' % index)
+
+
+def get_shard_indices(data_folder: str) -> list:
+    """Return the indices of the shards with data folders in the data
+    folder, in sorted order."""
+    indices = set()
+    for path in glob.glob(os.path.join(glob.escape(data_folder), 'shard-*')):
+        suffix = os.path.basename(path)[len('shard-'):]
+        if suffix.isdigit() and os.path.isdir(path):
+            indices.add(int(suffix))
+    return sorted(indices)
+
+
+def read_state(data_folder: str) -> dict:
+    """Return the recorded sharding state of the data folder, or None if it
+    has never been sharded."""
+    path = os.path.join(data_folder, STATE_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_state(data_folder: str, state: dict) -> None:
+    """Record the sharding state of the data folder, atomically."""
+    path = os.path.join(data_folder, STATE_FILE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(path + '.tmp', path)
+
+
+def start_shards(data_folder: str, indices, options: dict = None) -> dict:
+    """Start a shard for each of the given indices, in parallel, and return
+    a dictionary mapping each index to its shard."""
+    indices = list(indices)
+    with ThreadPoolExecutor(len(indices)) as executor:
+        futures = {index: executor.submit(Shard, index, get_shard_folder(data_folder, index), options)
+                   for index in indices}
+    shards = {}
+    error = None
+    for index, future in futures.items():
+        # noinspection PyBroadException
+        try:
+            shards[index] = future.result()
+        except Exception as exc:
+            error = exc
+    if error is not None:
+        for shard in shards.values():
+            shard.close()
+        raise error
+    return shards
+
+
+def has_unsharded_data(data_folder: str) -> bool:
+    """Return whether the data folder holds data written by a data manager
+    which is not sharded, as it does if it was used before sharding."""
+    return any(glob.glob(os.path.join(glob.escape(data_folder), pattern)) for pattern in UNSHARDED_USER_FILES)
+
+
+def _move_user(user_id: str, source: DataManager, source_name: str, shards: dict, target: int) -> None:
+    # Copy the user to the target shard, and only remove them from the source
+    # once the target holds every one of their live and archived messages.
+    record = source.export_user(user_id)
+    target_manager = shards[target].data_manager
+    summary = target_manager.import_user(record)
+    held = set(target_manager.get_message_ids(user_id))
+    held.update(target_manager.get_archived_message_ids(user_id))
+    missing = [message_data['id'] for message_data in record['messages'] + record['archived']
+               if message_data['id'] not in held]
+    if summary['rejected'] or missing:
+        raise RuntimeError("Shard %d rejected %d of the messages of user %r when moving them from %s."
+                           % (target, max(summary['rejected'], len(missing)), user_id, source_name))
+    source.remove_user(user_id)
+
+
+def migrate_unsharded(data_folder: str, shards: dict, ring: HashRing, options: dict = None) -> int:
+    """Move every user of the data manager which is not sharded, and keeps
+    its data in the data folder itself, to the shard the ring assigns them
+    to, given the running shards. Users are moved as by rebalance(), so an
+    interrupted or failed migration can simply be run again. Return the
+    number of users moved."""
+    unsharded = Shard(UNSHARDED_INDEX, data_folder, options)
+    try:
+        moved = 0
+        for user_id in unsharded.data_manager.get_user_ids():
+            _move_user(user_id, unsharded.data_manager, "the unsharded data", shards, ring.shard_for(user_id))
+            moved += 1
+    finally:
+        unsharded.close()
+    log.info("Moved %d users from the unsharded data into %d shards.", moved, ring.shards)
+    return moved
+
+
+def rebalance(data_folder: str, shards: dict, ring: HashRing) -> int:
+    """Move every user who is not on the shard the ring assigns them to,
+    given the running shards, which must include every shard with a data
+    folder. The shards assigned no users by the ring are closed and their
+    data folders removed. Return the number of users moved.
+
+    Each user is copied to their new shard, and only removed from their old
+    one once the new one holds every one of their live and archived
+    messages; otherwise, a RuntimeError is raised, leaving the user on both.
+    The sharding state records that a rebalance is in progress until it is
+    complete, so an interrupted or failed rebalance can simply be run
+    again."""
+    write_state(data_folder, {'shards': ring.shards, 'replicas': ring.replicas, 'rebalancing': True})
+    moved = 0
+    for index in sorted(shards):
+        source = shards[index].data_manager
+        for user_id in source.get_user_ids():
+            target = ring.shard_for(user_id)
+            if target == index:
+                continue
+            _move_user(user_id, source, "shard %d" % index, shards, target)
+            moved += 1
+    for index in sorted(shards):
+        if index >= ring.shards:
+            shards.pop(index).close()
+            shutil.rmtree(get_shard_folder(data_folder, index))
+    write_state(data_folder, {'shards': ring.shards, 'replicas': ring.replicas})
+    log.info("Rebalanced %d users among %d shards.", moved, ring.shards)
+    return moved
+
+
+def open_shards(data_folder: str, ring: HashRing, options: dict = None) -> dict:
+    """Start the shards for the ring, first moving the users into them if
+    the data folder was used without sharding, or rebalancing the users
+    among them if it was sharded differently, and return a dictionary
+    mapping each shard index to its shard."""
+    state = read_state(data_folder)
+    indices = set(get_shard_indices(data_folder)) | set(range(ring.shards))
+    shards = start_shards(data_folder, sorted(indices), options)
+    try:
+        if state is None and has_unsharded_data(data_folder):
+            migrate_unsharded(data_folder, shards, ring, options)
+        if state is not None and state != {'shards': ring.shards, 'replicas': ring.replicas}:
+            rebalance(data_folder, shards, ring)
+        else:
+            write_state(data_folder, {'shards': ring.shards, 'replicas': ring.replicas})
+    except BaseException:
+        for shard in shards.values():
+            shard.close()
+        raise
+    return shards
+
+
+def _sum_counts(counts_list: list) -> dict:
+    counts_list = [counts for counts in counts_list if counts is not None]
+    if not counts_list:
+        return None
+    total = {}
+    for counts in counts_list:
+        for key, count in counts.items():
+            total[key] = total.get(key, 0) + count
+    return total
+
+
+def _route(name: str):
+    # Return a method which forwards the call to the data manager of the
+    # shard owning the user given as the first argument.
+    def method(self, user_id: str, *args, **kwargs):
+        return getattr(self.get_shard(user_id), name)(user_id, *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = getattr(DataManager, name).__doc__
+    return method
+
+
+class ShardedDataManager:
+    """A data manager which divides users among several shard processes,
+    each running its own DataManager in its own subfolder of the data
+    folder, and routes each operation to the shards it concerns; see the
+    module documentation. It provides the same interface as a DataManager,
+    except that bots and bot factories can't be given, since each shard
+    constructs its own. The remaining options (workers, storage, etc.) are
+    passed to each shard's DataManager, and, apart from the retention
+    policy, must be JSON-serializable. Each shard applies the retention
+    policy to its own users.
+
+    If the data folder was last used with a different number of shards, the
+    users are rebalanced among the new shards before the constructor
+    returns."""
+
+    def __init__(self, data_folder: str = None, shards: int = 2, replicas: int = DEFAULT_REPLICAS, **options):
+        self.closed = True  # Until the shards are running
+        if data_folder is None:
+            data_folder = os.path.expanduser(DEFAULT_DATA_FOLDER)
+        if not os.path.isdir(data_folder):
+            os.makedirs(data_folder)
+
+        self.data_folder = data_folder
+        self.ring = HashRing(shards, replicas)
+        if options.get('retention') is not None:
+            options['retention'] = options['retention'].as_dict()
+        self.shards = open_shards(data_folder, self.ring, options)
+        self.closed = False
+        self._executor = ThreadPoolExecutor(shards, thread_name_prefix='shard_fan_out')
+
+        # Message listeners are called from a watcher thread per user, which
+        # waits on the user's shard for new messages.
+        self._listeners_lock = threading.Lock()
+        self._listeners = {}  # User ID -> set of listeners
+        self._watchers = {}  # User ID -> event set once the user's watcher is watching
+
+        if metrics.registry.enabled:
+            metrics.registry.add_collector(self.collect_metrics)
+
+    def __del__(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close every shard and stop its process. Once this has been
+        called, the data manager will no longer be in a usable state."""
+        if self.closed:
+            return
+        self.closed = True
+        metrics.registry.remove_collector(self.collect_metrics)
+        with self._listeners_lock:
+            self._listeners.clear()
+        for future in [self._executor.submit(shard.close) for shard in self.shards.values()]:
+            future.result()
+        self._executor.shutdown()
+
+    def get_shard(self, user_id: str) -> DataManager:
+        """Return the data manager of the shard which owns the given user."""
+        return self.shards[self.ring.shard_for(user_id)].data_manager
+
+    def _fan_out(self, name: str, *args) -> list:
+        # Call the method on every shard's data manager in parallel, and
+        # return the results in shard order.
+        futures = [self._executor.submit(getattr(self.shards[index].data_manager, name), *args)
+                   for index in range(self.ring.shards)]
+        return [future.result() for future in futures]
+
+    def _group(self, user_ids) -> dict:
+        # Shard index -> the given user IDs which the shard owns, in order.
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.ring.shard_for(user_id), []).append(user_id)
+        return groups
+
+    def get_user_ids(self) -> list:
+        """Return a list of user IDs, in sorted order."""
+        return list(heapq.merge(*self._fan_out('get_user_ids')))
+
+    def get_user_page(self, after: str = None, limit: int = None) -> (list, str):
+        """Return a page of up to limit user IDs, in sorted order, starting
+        after the given user ID (or from the beginning, if after is None).
+        A tuple (user_ids, next_cursor) is returned, where next_cursor is the
+        value of after for the following page, or None if this is the last
+        page."""
+        pages = self._fan_out('get_user_page', after, limit)
+        user_ids = list(heapq.merge(*(page for page, _ in pages)))
+        more = any(next_cursor is not None for _, next_cursor in pages)
+        if limit is not None and len(user_ids) > limit:
+            user_ids = user_ids[:limit]
+            more = True
+        return user_ids, user_ids[-1] if more and user_ids else None
+
+    def get_users_bulk(self, user_ids) -> dict:
+        """Return a dictionary mapping each of the given user IDs to the
+        user's data. User IDs which don't exist are omitted. Each shard is
+        asked only once for the entire batch."""
+        futures = [self._executor.submit(self.shards[index].data_manager.get_users_bulk, group)
+                   for index, group in self._group(user_ids).items()]
+        users = {}
+        for future in futures:
+            users.update(future.result())
+        return users
+
+    def get_users_version(self) -> (str, float):
+        """Return a tuple (tag, modified) describing the current state of the
+        users and their data, combined from the shards' versions."""
+        versions = self._fan_out('get_users_version')
+        return '.'.join(tag for tag, _ in versions), max(modified for _, modified in versions)
+
+    # Iteration is done here, in terms of the bulk operations, since
+    # generators can't be passed between processes.
+    iter_users = DataManager.iter_users
+    iter_messages = DataManager.iter_messages
+    iter_all_messages = DataManager.iter_all_messages
+
+    add_user = _route('add_user')
+    set_user_name = _route('set_user_name')
+    get_user_data = _route('get_user_data')
+    export_user = _route('export_user')
+    remove_user = _route('remove_user')
+    get_messages_version = _route('get_messages_version')
+    get_message_ids = _route('get_message_ids')
+    get_message_page = _route('get_message_page')
+    search_message_ids = _route('search_message_ids')
+    get_messages_bulk = _route('get_messages_bulk')
+    get_messages_after = _route('get_messages_after')
+    get_last_message_id = _route('get_last_message_id')
+    wait_for_messages = _route('wait_for_messages')
+    find_message_ids = _route('find_message_ids')
+    rebuild_index = _route('rebuild_index')
+    add_message = _route('add_message')
+    get_message_data = _route('get_message_data')
+    has_message = _route('has_message')
+    get_archived_message_ids = _route('get_archived_message_ids')
+    archive_messages = _route('archive_messages')
+    compact_messages = _route('compact_messages')
+
+    def import_user(self, record: dict) -> dict:
+        """Add a user exported with export_user(), along with their messages
+        and bot session, to the shard which owns them, and return the
+        summary of the import."""
+        return self.get_shard(record['user']['id']).import_user(record)
+
+    def apply_retention(self, policy: RetentionPolicy = None) -> dict:
+        """Apply the retention policy (by default, each shard's own) on every
+        shard, in parallel, and return the shards' summaries, summed."""
+        return _sum_counts(self._fan_out('apply_retention', policy))
+
+    def get_cache_stats(self) -> dict:
+        """Return the user cache counters of the shards, summed."""
+        return _sum_counts(self._fan_out('get_cache_stats'))
+
+    def get_response_cache_stats(self) -> dict:
+        """Return the response cache counters of the shards, summed, or None
+        if response caching is disabled."""
+        return _sum_counts(self._fan_out('get_response_cache_stats'))
+
+    def collect_metrics(self) -> list:
+        """Return the shards' cache counters and other state, summed, as
+        samples for the metrics registry."""
+        combined = {}  # Name -> (type, documentation, {labels: value})
+        for samples in self._fan_out('collect_metrics'):
+            for name, metric_type, documentation, values in samples:
+                _, _, totals = combined.setdefault(name, (metric_type, documentation, {}))
+                for labels, value in values:
+                    key = tuple(sorted(labels.items()))
+                    totals[key] = totals.get(key, 0) + value
+        return [(name, metric_type, documentation, [(dict(key), value) for key, value in totals.items()])
+                for name, (metric_type, documentation, totals) in combined.items()]
+
+    def add_messages(self, messages) -> list:
+        """Add several new incoming messages at once, given as a sequence of
+        (user_id, content) pairs, as for DataManager.add_messages(). Each
+        shard adds its users' messages in a single call, and the shards add
+        them in parallel."""
+        positions = {}  # Shard index -> positions of the shard's messages
+        for position, (user_id, _) in enumerate(messages):
+            positions.setdefault(self.ring.shard_for(user_id), []).append(position)
+        futures = {index: self._executor.submit(self.shards[index].data_manager.add_messages,
+                                                [messages[position] for position in shard_positions])
+                   for index, shard_positions in positions.items()}
+        results = [None] * len(messages)
+        for index, future in futures.items():
+            for position, result in zip(positions[index], future.result()):
+                results[position] = result
+        return results
+
+    def import_messages(self, messages, replay: bool = False, batch_size: int = 100) -> dict:
+        """Import messages in bulk, as for DataManager.import_messages().
+        The messages are divided among the shards and sent to each in
+        chunks, and the shards import them in parallel. Each shard's chunks
+        are imported in order."""
+        summary = {'users': 0, 'imported': 0, 'duplicates': 0, 'replayed': 0, 'rejected': 0}
+        summary_lock = threading.Lock()
+        # Each shard's chunks always go to the same importer, so they are
+        # imported in order.
+        importers = {index: ThreadPoolExecutor(1, thread_name_prefix='shard_import') for index in self.shards}
+        in_flight = threading.BoundedSemaphore(2 * len(importers))
+        chunks = {}
+        seen_users = set()
+
+        def import_chunk(index: int, chunk: list) -> None:
+            # noinspection PyBroadException
+            try:
+                counts = self.shards[index].data_manager.import_messages(chunk, replay, batch_size)
+            except Exception:
+                log.exception("Error importing messages into shard %d:" % index)
+                counts = {'rejected': len(chunk)}
+            finally:
+                in_flight.release()
+            counts.pop('users', None)  # Counted here, across chunks
+            with summary_lock:
+                for key, count in counts.items():
+                    summary[key] += count
+
+        def submit(index: int) -> None:
+            in_flight.acquire()
+            importers[index].submit(import_chunk, index, chunks.pop(index))
+
+        try:
+            for user_id, message_data in messages:
+                if user_id not in seen_users:
+                    seen_users.add(user_id)
+                    summary['users'] += 1
+                index = self.ring.shard_for(user_id)
+                chunk = chunks.setdefault(index, [])
+                chunk.append((user_id, message_data))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    submit(index)
+            for index in list(chunks):
+                submit(index)
+        finally:
+            for importer in importers.values():
+                importer.shutdown()
+        return summary
+
+    def add_message_listener(self, user_id: str, listener) -> None:
+        """Register a function to be called, with no arguments, whenever
+        messages are added for the given user. It is called on a watcher
+        thread, shortly after the user's shard adds the messages, so it must
+        return quickly and must not call back into the data manager. It is
+        also called if watching the shard fails, for example because the
+        user was removed, so the caller can find out for itself."""
+        with self._listeners_lock:
+            self._listeners.setdefault(user_id, set()).add(listener)
+            watching = self._watchers.get(user_id)
+            if watching is None:
+                watching = self._watchers[user_id] = threading.Event()
+                threading.Thread(target=self._watch, args=(user_id, watching), daemon=True,
+                                 name='Message watcher for %s' % user_id).start()
+        # Wait until a new watcher knows the user's last message, so any
+        # messages added after this returns are noticed.
+        watching.wait(WATCH_TIMEOUT)
+
+    def remove_message_listener(self, user_id: str, listener) -> None:
+        """Unregister a function registered with add_message_listener()."""
+        with self._listeners_lock:
+            listeners = self._listeners.get(user_id)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[user_id]
+
+    def _watch(self, user_id: str, watching: threading.Event) -> None:
+        shard = self.get_shard(user_id)
+        cursor = None
+        while True:
+            with self._listeners_lock:
+                # The watcher is unregistered in the same critical section
+                # that decides it is no longer needed, so a listener added
+                # after it exits starts a new one.
+                if self.closed or user_id not in self._listeners:
+                    del self._watchers[user_id]
+                    return
+            # noinspection PyBroadException
+            try:
+                if cursor is None:
+                    cursor = shard.get_last_message_id(user_id)
+                    watching.set()
+                messages, cursor = shard.wait_for_messages(user_id, cursor, 1, WATCH_TIMEOUT)
+            except Exception:
+                if self.closed:
+                    continue
+                log.exception("Error watching messages for %r:" % user_id)
+                watching.set()
+                # Wake the listeners, so they can check for themselves (for
+                # example, whether the user still exists), and try again
+                # after a pause if any remain.
+                self._notify_listeners(user_id)
+                time.sleep(WATCH_TIMEOUT)
+                continue
+            if messages:
+                self._notify_listeners(user_id)
+
+    def _notify_listeners(self, user_id: str) -> None:
+        with self._listeners_lock:
+            listeners = list(self._listeners.get(user_id, ()))
+        for listener in listeners:
+            listener()
+
+
+def serve_shard(data_folder: str, options: dict) -> None:
+    """Run a shard's data manager, serving it to the process which started
+    this one until that process closes our standard input."""
+    # The shard's address is the only thing written to standard output, so
+    # anything else written there, like the bot's loading messages, is sent
+    # to standard error instead.
+    address_file = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    if options.get('retention') is not None:
+        options['retention'] = RetentionPolicy(**options['retention'])
+    data_manager = DataManager(data_folder=data_folder, **options)
+    server_class = type('ShardServer', (BaseManager,), {})
+    server_class.register('data_manager', callable=lambda: data_manager)
+    authkey = bytes.fromhex(os.environ.pop(AUTHKEY_VARIABLE))
+    server = server_class(address=('127.0.0.1', 0), authkey=authkey).get_server()
+
+    threading.Thread(target=server.serve_forever, daemon=True, name='Shard server').start()
+    address_file.write(json.dumps(list(server.address)) + '\n')
+    address_file.close()
+
+    sys.stdin.buffer.read()  # Until the serving process closes it or exits
+    data_manager.close()
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(description="Manage sharded AIML Bot API data.")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    rebalance_parser = commands.add_parser('rebalance', help="Move users among a new number of shards.")
+    rebalance_parser.add_argument('data_folder', nargs='?', default=os.path.expanduser(DEFAULT_DATA_FOLDER),
+                                  help="The data folder.")
+    rebalance_parser.add_argument('--shards', type=int, required=True, help="The new number of shards.")
+    rebalance_parser.add_argument('--replicas', type=int, default=DEFAULT_REPLICAS,
+                                  help="The number of points each shard has on the hash ring.")
+    rebalance_parser.add_argument('--storage', default='shelve', help="The storage backend.")
+
+    shard_parser = commands.add_parser('shard', help="Run a single shard (used internally).")
+    shard_parser.add_argument('data_folder', help="The shard's data folder.")
+    shard_parser.add_argument('--options', default='{}', help="The data manager's options, as JSON.")
+
+    arguments = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+
+    if arguments.command == 'shard':
+        serve_shard(arguments.data_folder, json.loads(arguments.options))
+        return 0
+
+    if not os.path.isdir(arguments.data_folder):
+        print("No such data folder: %s" % arguments.data_folder, file=sys.stderr)
+        return 1
+    ring = HashRing(arguments.shards, arguments.replicas)
+    indices = set(get_shard_indices(arguments.data_folder)) | set(range(ring.shards))
+    options = {'storage': arguments.storage}
+    shards = start_shards(arguments.data_folder, sorted(indices), options)
+    try:
+        moved = 0
+        if read_state(arguments.data_folder) is None and has_unsharded_data(arguments.data_folder):
+            moved += migrate_unsharded(arguments.data_folder, shards, ring, options)
+        moved += rebalance(arguments.data_folder, shards, ring)
+    finally:
+        for shard in shards.values():
+            shard.close()
+    print("Moved %d users; the data folder now has %d shards." % (moved, ring.shards))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
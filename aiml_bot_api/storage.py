@@ -0,0 +1,464 @@
+"""
+Storage backends for the data manager. A backend provides four kinds of
+persistent, dict-like stores:
+
+* the users store, mapping user IDs to user data,
+* the sessions store, mapping user IDs to bot session data,
+* the message stats store, mapping user IDs to a summary of their live
+  messages, which lets the retention policy check users without loading
+  them, and
+* one message store per user, mapping message IDs to message data.
+
+Message stores are opened and closed individually, since the data manager
+only keeps a bounded number of them open at a time. A message store must
+allow reads from several threads at once, since the data manager lets
+readers of a user's messages share the user's message lock. Writes to a
+message store, on the other hand, are serialized by the data manager, with
+each other and with reads. Access to the users, sessions, and message
+stats stores, which the data manager shares among users, is serialized
+entirely, by wrapping the sessions store in a SessionStore and the others
+in a LockedStore.
+
+Three backends are available:
+
+* 'shelve' (the default): users.db, user_sessions.db, message_stats.db,
+  and messages/<user_id>.db, each a shelf.
+* 'log': like 'shelve', but with an append-only message log per user in
+  messages/<user_id>.log; see the message_log module.
+* 'sqlite': a single SQLite database, aiml_bot_api.sqlite3, in WAL mode,
+  with message rows indexed by user and time, from which time ranges of
+  messages are read directly. Each thread gets its own connection, so reads
+  run concurrently with the (single) writer. A thread's connection is
+  closed when the thread exits.
+
+Every backend keeps archived messages in the same layout, in
+archive/<user_id>/; see the archive module. The 'shelve' and 'log' backends
+never reclaim the space of deleted messages by themselves, so their message
+stores can be compacted, by copying the remaining messages into a new store
+in messages/compact/ and putting it in place of the old one. SQLite reuses
+the space of deleted rows, so its messages are not compacted.
+"""
+
+import glob
+import os
+import pickle
+import shelve
+import shutil
+import sqlite3
+import threading
+import weakref
+from collections.abc import MutableMapping
+
+from .archive import MessageArchive, open_message_archive
+from .message_log import MessageLog, open_message_log
+
+
+class StorageBackend:
+    """The interface for storage backends."""
+
+    name = None
+
+    # Whether message stores can be compacted; see open_messages_copy().
+    compacts_messages = False
+
+    # Whether messages can be read by time range; see read_messages_by_time().
+    indexes_message_times = False
+
+    def __init__(self, data_folder: str):
+        self.data_folder = data_folder
+
+    def open_users(self) -> MutableMapping:
+        """Open the store mapping user IDs to user data."""
+        raise NotImplementedError()
+
+    def open_sessions(self) -> MutableMapping:
+        """Open the store mapping user IDs to bot session data."""
+        raise NotImplementedError()
+
+    def open_message_stats(self) -> MutableMapping:
+        """Open the store mapping user IDs to summaries of their live
+        messages."""
+        raise NotImplementedError()
+
+    def open_messages(self, user_id: str) -> MutableMapping:
+        """Open the store mapping the user's message IDs to message data.
+        The returned store must have a close() method."""
+        raise NotImplementedError()
+
+    def delete_messages(self, user_id: str) -> None:
+        """Delete all of the user's messages. The user's message store must
+        not be open. By default, the messages are deleted one at a time."""
+        messages = self.open_messages(user_id)
+        try:
+            for message_id in list(messages):
+                del messages[message_id]
+        finally:
+            messages.close()
+
+    def open_messages_copy(self, user_id: str) -> MutableMapping:
+        """Open a new, empty message store for the user, to be filled with a
+        compacted copy of the user's messages and then put in place of the
+        user's message store by replace_messages(). This is only supported
+        if compacts_messages is set. The returned store must have a close()
+        method."""
+        raise NotImplementedError()
+
+    def replace_messages(self, user_id: str) -> None:
+        """Replace the user's message store with the copy opened by
+        open_messages_copy(). Neither store may be open."""
+        raise NotImplementedError()
+
+    def discard_messages_copy(self, user_id: str) -> None:
+        """Delete the copy of the user's message store opened by
+        open_messages_copy(), if any. The copy must not be open."""
+        raise NotImplementedError()
+
+    def read_messages_by_time(self, user_id: str, start: str = None, end: str = None, after: tuple = None,
+                              limit: int = None) -> list:
+        """Return the data of up to limit of the user's messages with a time
+        string from start, inclusive, to end, exclusive, in order of time
+        and then ID, beginning after the message with the (time, ID) pair
+        given as after. Bounds of None are open. This is only supported if
+        indexes_message_times is set."""
+        raise NotImplementedError()
+
+    def open_archive(self, user_id: str) -> MessageArchive:
+        """Open the user's message archive."""
+        return open_message_archive(self.data_folder, user_id)
+
+    def delete_archive(self, user_id: str) -> None:
+        """Delete the user's message archive. It must not be open."""
+        path = os.path.join(self.data_folder, 'archive', user_id)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def close(self) -> None:
+        """Release any resources held by the backend itself. Stores opened by
+        the backend must be closed separately, before the backend is."""
+
+
+class ShelveBackend(StorageBackend):
+    """Storage backend which keeps each store in a separate shelf."""
+
+    name = 'shelve'
+    compacts_messages = True
+
+    def __init__(self, data_folder: str):
+        super().__init__(data_folder)
+        if not os.path.isdir(os.path.join(data_folder, 'messages')):
+            os.makedirs(os.path.join(data_folder, 'messages'))
+
+    def open_users(self) -> MutableMapping:
+        return shelve.open(os.path.join(self.data_folder, 'users.db'))
+
+    def open_sessions(self) -> MutableMapping:
+        return shelve.open(os.path.join(self.data_folder, 'user_sessions.db'))
+
+    def open_message_stats(self) -> MutableMapping:
+        return shelve.open(os.path.join(self.data_folder, 'message_stats.db'))
+
+    def open_messages(self, user_id: str) -> MutableMapping:
+        return shelve.open(os.path.join(self.data_folder, 'messages', user_id + '.db'))
+
+    @staticmethod
+    def _shelf_files(folder: str, user_id: str) -> list:
+        # Depending on the dbm implementation, a shelf may consist of several
+        # files, e.g. <user_id>.db.dat and <user_id>.db.dir.
+        return glob.glob(os.path.join(glob.escape(folder), glob.escape(user_id) + '.db*'))
+
+    def delete_messages(self, user_id: str) -> None:
+        for path in self._shelf_files(os.path.join(self.data_folder, 'messages'), user_id):
+            os.remove(path)
+
+    def open_messages_copy(self, user_id: str) -> MutableMapping:
+        self.discard_messages_copy(user_id)
+        copy_folder = os.path.join(self.data_folder, 'messages', 'compact')
+        if not os.path.isdir(copy_folder):
+            os.makedirs(copy_folder)
+        return shelve.open(os.path.join(copy_folder, user_id + '.db'), 'n')
+
+    def replace_messages(self, user_id: str) -> None:
+        messages_folder = os.path.join(self.data_folder, 'messages')
+        copies = self._shelf_files(os.path.join(messages_folder, 'compact'), user_id)
+        names = {os.path.basename(path) for path in copies}
+        for path in self._shelf_files(messages_folder, user_id):
+            if os.path.basename(path) not in names:
+                os.remove(path)
+        for path in copies:
+            os.replace(path, os.path.join(messages_folder, os.path.basename(path)))
+
+    def discard_messages_copy(self, user_id: str) -> None:
+        for path in self._shelf_files(os.path.join(self.data_folder, 'messages', 'compact'), user_id):
+            os.remove(path)
+
+
+class LogBackend(ShelveBackend):
+    """Storage backend which keeps users and sessions in shelves, and each
+    user's messages in an append-only message log."""
+
+    name = 'log'
+
+    def open_messages(self, user_id: str) -> MutableMapping:
+        return open_message_log(self.data_folder, user_id)
+
+    def delete_messages(self, user_id: str) -> None:
+        for extension in ('.log', '.idx'):
+            path = os.path.join(self.data_folder, 'messages', user_id + extension)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def open_messages_copy(self, user_id: str) -> MutableMapping:
+        self.discard_messages_copy(user_id)
+        copy_folder = os.path.join(self.data_folder, 'messages', 'compact')
+        if not os.path.isdir(copy_folder):
+            os.makedirs(copy_folder)
+        return MessageLog(os.path.join(copy_folder, user_id + '.log'))
+
+    def replace_messages(self, user_id: str) -> None:
+        # The old index is removed first, so an interruption leaves the log
+        # without an index, which is rebuilt from the log when it is opened,
+        # rather than with an index for a different log.
+        messages_folder = os.path.join(self.data_folder, 'messages')
+        if os.path.isfile(os.path.join(messages_folder, user_id + '.idx')):
+            os.remove(os.path.join(messages_folder, user_id + '.idx'))
+        for extension in ('.log', '.idx'):
+            os.replace(os.path.join(messages_folder, 'compact', user_id + extension),
+                       os.path.join(messages_folder, user_id + extension))
+
+    def discard_messages_copy(self, user_id: str) -> None:
+        for extension in ('.log', '.idx'):
+            path = os.path.join(self.data_folder, 'messages', 'compact', user_id + extension)
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+class SQLiteBackend(StorageBackend):
+    """Storage backend which keeps all data in a single SQLite database in
+    write-ahead logging mode. Each thread uses its own connection. Statements
+    are written as constant, parameterized SQL, so each connection compiles
+    them once and reuses them from its statement cache."""
+
+    name = 'sqlite'
+    indexes_message_times = True
+
+    FILE_NAME = 'aiml_bot_api.sqlite3'
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS message_stats (id TEXT PRIMARY KEY, data BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "    user_id TEXT NOT NULL, id TEXT NOT NULL, time TEXT NOT NULL, origin TEXT NOT NULL, content TEXT NOT NULL,"
+        "    PRIMARY KEY (user_id, id)"
+        ") WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS messages_by_time ON messages (user_id, time, id)",
+    ]
+
+    def __init__(self, data_folder: str, timeout: float = 30.0):
+        super().__init__(data_folder)
+        self.path = os.path.join(data_folder, self.FILE_NAME)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()  # The open _ThreadConnections
+        self._connections_lock = threading.Lock()
+        connection = self.connection
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection to the database."""
+        thread_connection = getattr(self._local, 'connection', None)
+        if thread_connection is None:
+            # Transactions are managed explicitly (isolation_level=None), so
+            # each single-statement write commits immediately.
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            thread_connection = self._local.connection = _ThreadConnection(connection)
+            with self._connections_lock:
+                self._connections.add(thread_connection)
+        return thread_connection.connection
+
+    def open_users(self) -> MutableMapping:
+        return SQLiteTable(self, 'users')
+
+    def open_sessions(self) -> MutableMapping:
+        return SQLiteTable(self, 'sessions')
+
+    def open_message_stats(self) -> MutableMapping:
+        return SQLiteTable(self, 'message_stats')
+
+    def open_messages(self, user_id: str) -> MutableMapping:
+        return SQLiteMessages(self, user_id)
+
+    def delete_messages(self, user_id: str) -> None:
+        self.connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+
+    # Time strings have a fixed width, so they sort chronologically, and the
+    # range is read from the (user_id, time) index. A limit of -1 means none.
+    TIME_RANGE = ("SELECT id, origin, content, time FROM messages"
+                  " WHERE user_id = ? AND time >= ? AND time < ? AND (time, id) > (?, ?)"
+                  " ORDER BY time, id LIMIT ?")
+
+    def read_messages_by_time(self, user_id: str, start: str = None, end: str = None, after: tuple = None,
+                              limit: int = None) -> list:
+        after_time, after_id = after or ('', '')
+        rows = self.connection.execute(self.TIME_RANGE, (user_id, start or '', '\uffff' if end is None else end,
+                                                         after_time, after_id, -1 if limit is None else limit))
+        return [{'id': row[0], 'origin': row[1], 'content': row[2], 'time': row[3]} for row in rows]
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for thread_connection in list(self._connections):
+                thread_connection.connection.close()
+            self._connections.clear()
+
+
+class LockedStore(MutableMapping):
+    """A dict-like store wrapper which serializes all access to the wrapped
+    store with a lock, for stores which are shared by threads but aren't
+    safe to use from several threads at once, like shelves."""
+
+    def __init__(self, store: MutableMapping):
+        self.store = store
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self.store[key]
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            self.store[key] = value
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            del self.store[key]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self.store
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.store))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self.store)
+
+    def close(self) -> None:
+        """Close the wrapped store."""
+        with self._lock:
+            self.store.close()
+
+
+class _ThreadConnection:
+    """A thread's connection to an SQLite database. It is only referenced by
+    the thread's local data, and by the backend weakly, so it is closed as
+    soon as the thread exits."""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __del__(self):
+        self.connection.close()
+
+
+class SQLiteTable(MutableMapping):
+    """A dict-like view of a key/value table in an SQLite database. Values
+    are stored pickled."""
+
+    def __init__(self, backend: SQLiteBackend, table: str):
+        self.backend = backend
+        # The table name is one of a fixed set, never user input.
+        self._get = "SELECT data FROM %s WHERE id = ?" % table
+        self._set = "INSERT OR REPLACE INTO %s (id, data) VALUES (?, ?)" % table
+        self._delete = "DELETE FROM %s WHERE id = ?" % table
+        self._keys = "SELECT id FROM %s ORDER BY id" % table
+        self._count = "SELECT COUNT(*) FROM %s" % table
+
+    def __getitem__(self, key: str):
+        row = self.backend.connection.execute(self._get, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key: str, value) -> None:
+        self.backend.connection.execute(self._set, (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+    def __delitem__(self, key: str) -> None:
+        if not self.backend.connection.execute(self._delete, (key,)).rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return self.backend.connection.execute(self._get, (key,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.backend.connection.execute(self._keys)])
+
+    def __len__(self) -> int:
+        return self.backend.connection.execute(self._count).fetchone()[0]
+
+    def close(self) -> None:
+        """Provided for compatibility with shelves. The connection belongs to
+        the backend, so there is nothing to close."""
+
+
+class SQLiteMessages(MutableMapping):
+    """A dict-like view of a user's rows in the messages table. Iteration
+    yields message IDs in chronological order, using the (user_id, time)
+    index."""
+
+    GET = "SELECT id, origin, content, time FROM messages WHERE user_id = ? AND id = ?"
+    SET = "INSERT OR REPLACE INTO messages (user_id, id, time, origin, content) VALUES (?, ?, ?, ?, ?)"
+    DELETE = "DELETE FROM messages WHERE user_id = ? AND id = ?"
+    KEYS = "SELECT id FROM messages WHERE user_id = ? ORDER BY time, id"
+    COUNT = "SELECT COUNT(*) FROM messages WHERE user_id = ?"
+
+    def __init__(self, backend: SQLiteBackend, user_id: str):
+        self.backend = backend
+        self.user_id = user_id
+
+    def __getitem__(self, message_id: str) -> dict:
+        row = self.backend.connection.execute(self.GET, (self.user_id, message_id)).fetchone()
+        if row is None:
+            raise KeyError(message_id)
+        return {'id': row[0], 'origin': row[1], 'content': row[2], 'time': row[3]}
+
+    def __setitem__(self, message_id: str, data: dict) -> None:
+        self.backend.connection.execute(self.SET, (self.user_id, message_id, data['time'], data['origin'],
+                                                   data['content']))
+
+    def __delitem__(self, message_id: str) -> None:
+        if not self.backend.connection.execute(self.DELETE, (self.user_id, message_id)).rowcount:
+            raise KeyError(message_id)
+
+    def __contains__(self, message_id) -> bool:
+        return self.backend.connection.execute(self.GET, (self.user_id, message_id)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.backend.connection.execute(self.KEYS, (self.user_id,))])
+
+    def __len__(self) -> int:
+        return self.backend.connection.execute(self.COUNT, (self.user_id,)).fetchone()[0]
+
+    def close(self) -> None:
+        """Provided for compatibility with shelves. The connection belongs to
+        the backend, so there is nothing to close."""
+
+
+BACKENDS = {backend.name: backend for backend in (ShelveBackend, LogBackend, SQLiteBackend)}
+
+
+def get_backend(storage, data_folder: str) -> StorageBackend:
+    """Return the storage backend for the data folder. The storage may be
+    given as the name of a backend, or as a backend instance, which is
+    returned as-is."""
+    if isinstance(storage, StorageBackend):
+        return storage
+    if storage not in BACKENDS:
+        raise ValueError(storage)
+    return BACKENDS[storage](data_folder)
@@ -0,0 +1,155 @@
+"""
+The bot execution engine. A BotPool runs several independent aiml_bot.Bot
+instances, each in its own single-threaded executor, and pins every user ID
+to exactly one of them. Session state for a given user therefore always lives
+in the same bot, while messages from users pinned to different workers are
+answered in parallel.
+
+Workers can be run either as threads within the current process or as
+separate processes. Thread workers are cheap to start and can share a bot
+that was constructed by the caller; process workers sidestep the GIL, but
+require a picklable (module-level) bot factory.
+
+If response caching is enabled, each worker keeps its own ResponseCache in
+front of its bot; see the responses module.
+"""
+
+import threading
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import aiml_bot
+
+from .responses import ResponseCache
+
+
+# Each worker thread (or worker process) holds its own bot in this slot.
+_worker_state = threading.local()
+
+
+def default_bot_factory() -> aiml_bot.Bot:
+    """Construct a bot loaded with the standard AIML set."""
+    return aiml_bot.Bot(commands="load std aiml")
+
+
+def _initialize_worker(bot_factory, response_cache_size: int = None) -> None:
+    _worker_state.bot = bot_factory()
+    _worker_state.response_cache = ResponseCache(response_cache_size) if response_cache_size else None
+
+
+def _respond(user_id: str, content: str) -> (str, dict):
+    bot = _worker_state.bot
+    if _worker_state.response_cache is None:
+        response = bot.respond(content, user_id)
+    else:
+        response = _worker_state.response_cache.respond(bot, content, user_id)
+    return response, bot.get_session_data(user_id)
+
+
+def _get_response_cache_stats() -> dict:
+    response_cache = _worker_state.response_cache
+    if response_cache is None:
+        return None
+    stats = response_cache.stats.as_dict()
+    stats['size'] = len(response_cache)
+    return stats
+
+
+def _get_session_data(user_id: str) -> dict:
+    return _worker_state.bot.get_session_data(user_id)
+
+
+def _set_session_data(user_id: str, session_data: dict) -> None:
+    _worker_state.bot.set_session_data(session_data, user_id)
+
+
+def _delete_session(user_id: str) -> None:
+    _worker_state.bot.delete_session(user_id)
+
+
+class _SharedBotFactory:
+    """Bot factory which hands out a single, pre-constructed bot."""
+
+    def __init__(self, bot: aiml_bot.Bot):
+        self.bot = bot
+
+    def __call__(self) -> aiml_bot.Bot:
+        return self.bot
+
+
+class BotPool:
+    """A fixed-size pool of bot workers. Each user ID is consistently
+    assigned to the same worker, which processes that user's requests in the
+    order they were submitted. If response_cache_size is given, each worker
+    caches up to that many responses."""
+
+    def __init__(self, bot_factory=None, workers: int = 1, mode: str = 'thread', bot: aiml_bot.Bot = None,
+                 response_cache_size: int = None):
+        if workers < 1:
+            raise ValueError(workers)
+        if mode not in ('thread', 'process'):
+            raise ValueError(mode)
+        if bot is not None:
+            # A single bot instance can't be shared between workers, or copied
+            # into another process.
+            if bot_factory is not None or workers != 1 or mode != 'thread':
+                raise ValueError("A pre-constructed bot requires a single thread worker.")
+            bot_factory = _SharedBotFactory(bot)
+        elif bot_factory is None:
+            bot_factory = default_bot_factory
+
+        self.mode = mode
+        executor_type = ThreadPoolExecutor if mode == 'thread' else ProcessPoolExecutor
+        self.executors = [
+            executor_type(max_workers=1, initializer=_initialize_worker, initargs=(bot_factory, response_cache_size))
+            for _ in range(workers)
+        ]  # type: list
+
+    def __len__(self) -> int:
+        return len(self.executors)
+
+    def worker_index(self, user_id: str) -> int:
+        """Return the index of the worker the user is pinned to. The
+        assignment is stable across processes and restarts."""
+        return zlib.crc32(user_id.encode()) % len(self.executors)
+
+    def submit(self, user_id: str, function, *args) -> Future:
+        """Schedule a module-level function on the user's worker and return
+        the future for its result."""
+        return self.executors[self.worker_index(user_id)].submit(function, *args)
+
+    def respond(self, user_id: str, content: str) -> (str, dict):
+        """Return the bot's response to the content, along with the user's
+        updated session data."""
+        return self.submit(user_id, _respond, user_id, content).result()
+
+    def get_session_data(self, user_id: str) -> dict:
+        """Return a copy of the user's session data."""
+        return self.submit(user_id, _get_session_data, user_id).result()
+
+    def set_session_data(self, user_id: str, session_data: dict) -> None:
+        """Replace the user's session data."""
+        self.submit(user_id, _set_session_data, user_id, session_data).result()
+
+    def delete_session(self, user_id: str) -> None:
+        """Discard the user's session from the worker's bot."""
+        self.submit(user_id, _delete_session, user_id).result()
+
+    def get_response_cache_stats(self) -> dict:
+        """Return the response cache counters, summed over all workers, or
+        None if response caching is disabled."""
+        totals = None
+        for executor in self.executors:
+            stats = executor.submit(_get_response_cache_stats).result()
+            if stats is None:
+                continue
+            if totals is None:
+                totals = dict.fromkeys(stats, 0)
+            for key, value in stats.items():
+                totals[key] += value
+        return totals
+
+    def close(self) -> None:
+        """Wait for pending work to finish and shut down all workers."""
+        for executor in self.executors:
+            executor.shutdown()
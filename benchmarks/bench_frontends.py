@@ -0,0 +1,138 @@
+"""
+Compare the synchronous Flask front-end with the asyncio front-end.
+
+Both servers run the same application in this process, against a scratch
+data folder. While a number of idle connections are held open, each client
+creates a user and then alternates between posting a message and listing
+the user's messages, opening a new connection for each request. For each
+front-end, the throughput, the request latencies, and the peak number of
+threads in the process are reported.
+
+Usage:
+
+    python benchmarks/bench_frontends.py [--clients N] [--requests N] [--idle N]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+async def request(port: int, method: str, path: str, data=None) -> (int, bytes):
+    """Send a single request on a new connection and return the status and
+    the response body."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = b'' if data is None else json.dumps(data).encode('utf-8')
+    head = ('%s %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\nContent-Length: %d\r\n'
+            % (method, path, len(body)))
+    if data is not None:
+        head += 'Content-Type: application/json\r\n'
+    writer.write(head.encode('latin-1') + b'\r\n' + body)
+    response = await reader.read()
+    writer.close()
+    status_line, _, rest = response.partition(b'\r\n')
+    return int(status_line.split()[1]), rest.partition(b'\r\n\r\n')[2]
+
+
+async def run_client(port: int, user_id: str, requests: int, latencies: list) -> None:
+    """Create a user, then alternate between posting messages and listing
+    them."""
+    await request(port, 'POST', '/users/', {'id': user_id, 'name': user_id})
+    for index in range(requests):
+        start = time.perf_counter()
+        if index % 2:
+            status, _ = await request(port, 'GET', '/users/%s/messages/?limit=20' % user_id)
+        else:
+            status, _ = await request(port, 'POST', '/users/%s/messages/' % user_id,
+                                      {'content': 'Hello number %d' % index})
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            raise RuntimeError("Request failed with status %s" % status)
+
+
+async def run_load(port: int, name: str, clients: int, requests: int, idle: int) -> dict:
+    """Run the load against the server on the given port."""
+    idle_connections = [await asyncio.open_connection('127.0.0.1', port) for _ in range(idle)]
+    peak_threads = threading.active_count()
+    latencies = []
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(run_client(port, '%s_%d' % (name, index), requests, latencies))
+             for index in range(clients)]
+    while not all(task.done() for task in tasks):
+        peak_threads = max(peak_threads, threading.active_count())
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    for _, writer in idle_connections:
+        writer.close()
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'median': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * .99)],
+        'peak_threads': peak_threads,
+    }
+
+
+def start_flask_server(app):
+    """Start the Flask application in a threaded WSGI server, returning the
+    server."""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_asyncio_server(app, threads: int):
+    """Start the application with the asyncio front-end on its own event
+    loop thread, returning the server."""
+    from aiml_bot_api.asgi import ASGIApp, start_server
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(start_server(ASGIApp(app, threads=threads), '127.0.0.1', 0),
+                                            loop).result()
+
+
+def report(name: str, results: dict) -> None:
+    """Print the results for a front-end."""
+    print("%s: %d requests in %.2f s (%.1f requests/s), median %.1f ms, p99 %.1f ms, peak %d threads" % (
+        name, results['requests'], results['seconds'], results['throughput'], results['median'] * 1000,
+        results['p99'] * 1000, results['peak_threads']))
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(description="Compare the Flask and asyncio front-ends.")
+    parser.add_argument('--clients', type=int, default=50, help="The number of concurrent clients.")
+    parser.add_argument('--requests', type=int, default=20, help="The number of requests per client.")
+    parser.add_argument('--idle', type=int, default=200, help="The number of idle connections held open.")
+    parser.add_argument('--threads', type=int, default=32, help="Handler threads for the asyncio front-end.")
+    arguments = parser.parse_args(args)
+
+    os.environ['AIML_BOT_API_DATA_FOLDER'] = tempfile.mkdtemp(prefix='aiml_bot_api_bench_')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from aiml_bot_api import app
+
+    flask_server = start_flask_server(app)
+    results = asyncio.run(run_load(flask_server.server_port, 'flask', arguments.clients, arguments.requests,
+                                   arguments.idle))
+    report("Flask  ", results)
+    flask_server.shutdown()
+
+    asyncio_server = start_asyncio_server(app, arguments.threads)
+    results = asyncio.run(run_load(asyncio_server.sockets[0].getsockname()[1], 'asyncio', arguments.clients,
+                                   arguments.requests, arguments.idle))
+    report("asyncio", results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Stress the data manager's user and message locks under contention, comparing
+the hierarchical reader/writer LockSet with the previous implementation, in
+which locking the whole set took a single list-level lock and waited for
+every item lock to be released.
+
+Each implementation is driven with the locking pattern the data manager uses
+with it. A number of message threads repeatedly lock a random user and hold
+the lock while they sleep, standing in for a bot response; listing threads
+repeatedly lock the user set to list the users, as GET /users/ does; and a
+few threads add new users. For each kind of operation, the throughput and
+latency (including the time spent waiting for locks) are reported.
+
+Usage:
+
+    python benchmarks/bench_locks.py [--seconds N] [--message-threads N] [--list-threads N]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+
+class LegacyItemLock:
+    """A lock for a single item in a legacy lock set."""
+
+    def __init__(self, lock_set: 'LegacyLockSet', item):
+        self.lock_set = lock_set
+        self.item = item
+
+    def __enter__(self):
+        with self.lock_set.per_item_lock:
+            while self.item in self.lock_set.locked_items:
+                self.lock_set.item_unlocked.wait()
+            self.lock_set.locked_items.add(self.item)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.lock_set.per_item_lock:
+            self.lock_set.locked_items.remove(self.item)
+            self.lock_set.item_unlocked.notify_all()
+
+
+class LegacyLockSet:
+    """The previous lock set implementation, for comparison."""
+
+    def __init__(self):
+        self.list_lock = threading.Lock()
+        self.per_item_lock = threading.Lock()
+        self.item_unlocked = threading.Condition(self.per_item_lock)
+        self.locked_items = set()
+
+    def __getitem__(self, item):
+        return LegacyItemLock(self, item)
+
+    def __enter__(self):
+        self.list_lock.acquire()
+        with self.per_item_lock:
+            while self.locked_items:
+                self.item_unlocked.wait()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.list_lock.release()
+
+
+class LegacyPattern:
+    """How the data manager used the legacy lock sets."""
+
+    def __init__(self):
+        self.user_locks = LegacyLockSet()
+        self.message_locks = LegacyLockSet()
+
+    def add_message(self, user_id: str, hold: float) -> None:
+        with self.user_locks[user_id]:
+            with self.message_locks[user_id]:
+                pass
+            time.sleep(hold)
+            with self.message_locks[user_id]:
+                pass
+
+    def list_users(self, hold: float) -> None:
+        with self.user_locks:
+            time.sleep(hold)
+
+    def add_user(self, user_id: str, hold: float) -> None:
+        with self.user_locks, self.user_locks[user_id]:
+            time.sleep(hold)
+
+
+class HierarchicalPattern:
+    """How the data manager uses the hierarchical lock sets."""
+
+    def __init__(self):
+        from aiml_bot_api.data import LockSet
+        self.user_locks = LockSet('user')
+        self.message_locks = LockSet('message')
+
+    def add_message(self, user_id: str, hold: float) -> None:
+        with self.user_locks[user_id].shared(), self.message_locks[user_id]:
+            time.sleep(hold)
+
+    def list_users(self, hold: float) -> None:
+        with self.user_locks.shared():
+            time.sleep(hold)
+
+    def add_user(self, user_id: str, hold: float) -> None:
+        with self.user_locks[user_id]:
+            time.sleep(hold)
+
+
+def run(pattern, seconds: float, message_threads: int, list_threads: int, add_threads: int, users: int,
+        message_hold: float, list_hold: float) -> dict:
+    """Drive the locking pattern from several threads for the given number
+    of seconds, returning the latencies of each kind of operation."""
+    latencies = {'add_message': [], 'list_users': [], 'add_user': []}
+    deadline = time.perf_counter() + seconds
+
+    def message_loop():
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            pattern.add_message('user_%d' % rng.randrange(users), message_hold)
+            latencies['add_message'].append(time.perf_counter() - start)
+
+    def list_loop():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            pattern.list_users(list_hold)
+            latencies['list_users'].append(time.perf_counter() - start)
+
+    def add_loop(index: int):
+        count = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            pattern.add_user('new_%d_%d' % (index, count), list_hold)
+            latencies['add_user'].append(time.perf_counter() - start)
+            count += 1
+            time.sleep(list_hold * 10)
+
+    threads = [threading.Thread(target=message_loop) for _ in range(message_threads)]
+    threads += [threading.Thread(target=list_loop) for _ in range(list_threads)]
+    threads += [threading.Thread(target=add_loop, args=(index,)) for index in range(add_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def report(name: str, latencies: dict, seconds: float) -> None:
+    """Print the results for a lock implementation."""
+    print(name)
+    for operation, values in latencies.items():
+        if not values:
+            print("  %-12s no operations completed" % operation)
+            continue
+        values.sort()
+        print("  %-12s %8.1f ops/s, median %7.2f ms, p99 %7.2f ms, max %7.2f ms" % (
+            operation, len(values) / seconds, statistics.median(values) * 1000,
+            values[int(len(values) * .99)] * 1000, values[-1] * 1000))
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(description="Compare lock set implementations under contention.")
+    parser.add_argument('--seconds', type=float, default=3, help="How long to run each implementation.")
+    parser.add_argument('--message-threads', type=int, default=16, help="Threads adding messages.")
+    parser.add_argument('--list-threads', type=int, default=4, help="Threads listing users.")
+    parser.add_argument('--add-threads', type=int, default=2, help="Threads adding users.")
+    parser.add_argument('--users', type=int, default=100, help="The number of users messages are sent to.")
+    parser.add_argument('--message-hold', type=float, default=.005,
+                        help="Seconds each message holds its user's locks.")
+    parser.add_argument('--list-hold', type=float, default=.0005,
+                        help="Seconds each listing or user addition holds the locks.")
+    arguments = parser.parse_args(args)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for name, pattern in (("Legacy LockSet", LegacyPattern()), ("Hierarchical LockSet", HierarchicalPattern())):
+        latencies = run(pattern, arguments.seconds, arguments.message_threads, arguments.list_threads,
+                        arguments.add_threads, arguments.users, arguments.message_hold, arguments.list_hold)
+        report(name, latencies, arguments.seconds)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+A load-testing benchmark suite for the data manager and the HTTP API.
+
+The suite drives a DataManager directly, and the Flask application through
+its test client, each against a scratch data folder. For each target, it
+creates a number of users, gives each of them a conversation history of the
+requested depth (imported in bulk, and not timed), and then, from a pool of
+concurrent client threads, sends each user a number of messages and reads
+their messages back in the ways the API allows. The throughput and the
+p50/p95/p99 latencies of each operation are printed, and written to a JSON
+results file along with the parameters of the run and the current git
+commit, so that runs can be compared across commits:
+
+    python benchmarks/bench_suite.py --output before.json
+    git checkout other-branch
+    python benchmarks/bench_suite.py --output after.json --compare before.json
+
+Usage:
+
+    python benchmarks/bench_suite.py [--target {manager,http,all}] [--users N] [--messages N] [--history N]
+                                     [--concurrency N] [--workers N] [--storage NAME] [--output PATH]
+                                     [--compare PATH]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: list, percent: float) -> float:
+    """Return the given percentile of the sorted values, by nearest rank."""
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def measure(operation, jobs: list, concurrency: int) -> dict:
+    """Call the operation with each job's arguments from a pool of threads,
+    and return the throughput and latency statistics."""
+    latencies = []
+    lock = threading.Lock()
+
+    def call(args):
+        start = time.perf_counter()
+        operation(*args)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(call, args) for args in jobs]:
+            future.result()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        'count': len(latencies),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max': latencies[-1] if latencies else 0.0,
+    }
+    for percent in PERCENTILES:
+        result['p%d' % percent] = percentile(latencies, percent)
+    return result
+
+
+def make_history(depth: int) -> list:
+    """Return a conversation history of the given depth, as message data
+    for DataManager.import_messages()."""
+    history = []
+    for index in range(depth):
+        if index % 2:
+            history.append({'origin': 'server', 'content': 'Reply number %d to the benchmark.' % index})
+        else:
+            history.append({'origin': 'client', 'content': 'Benchmark message number %d, hello.' % index})
+    return history
+
+
+def seed_history(data_manager, user_ids: list, depth: int) -> None:
+    """Give each user a conversation history of the given depth."""
+    history = make_history(depth)
+    data_manager.import_messages((user_id, dict(message_data)) for user_id in user_ids for message_data in history)
+
+
+class ManagerTarget:
+    """Drives a DataManager directly."""
+
+    name = 'manager'
+
+    def __init__(self, data_folder: str, workers: int, storage: str):
+        from aiml_bot_api.data import DataManager
+        self.data_manager = DataManager(data_folder=data_folder, workers=workers, storage=storage)
+
+    def add_user(self, user_id: str) -> None:
+        self.data_manager.add_user(user_id, user_id)
+
+    def add_message(self, user_id: str, content: str) -> None:
+        self.data_manager.add_message(user_id, content)
+
+    def list_users(self) -> None:
+        self.data_manager.get_user_page(limit=20)
+
+    def list_messages(self, user_id: str) -> list:
+        return self.data_manager.get_message_page(user_id, limit=20)[0]
+
+    def get_message(self, user_id: str, message_id: str) -> None:
+        self.data_manager.get_message_data(user_id, message_id)
+
+    def search_messages(self, user_id: str, query: str) -> None:
+        self.data_manager.search_message_ids(user_id, query)
+
+    def recent_messages(self, user_id: str) -> None:
+        message_ids = self.data_manager.get_message_ids(user_id)[-20:]
+        self.data_manager.get_messages_bulk(user_id, message_ids)
+
+    def close(self) -> None:
+        self.data_manager.close()
+
+
+class HTTPTarget:
+    """Drives the Flask application through its test client, using both the
+    REST endpoints and the GraphQL schema."""
+
+    name = 'http'
+
+    SEND_MESSAGE = 'mutation { sendMessage(input: {user: {id: %s}, content: %s}) { message { id } error } }'
+    RECENT_MESSAGES = '{ users(id: %s) { messageConnection(first: 20) { edges { node { id content time } } } } }'
+
+    def __init__(self, data_folder: str):
+        # The application's data manager is created when the endpoints are
+        # first imported, so it can only be configured through the
+        # environment, and only for the first HTTP target in the process.
+        os.environ['AIML_BOT_API_DATA_FOLDER'] = data_folder
+        from aiml_bot_api import app
+        from aiml_bot_api.endpoints import data_manager
+        self.app = app
+        self.data_manager = data_manager
+        self.local = threading.local()
+
+    @property
+    def client(self):
+        """A test client for the calling thread."""
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def request(self, method: str, path: str, data=None):
+        """Make a request, and return the decoded JSON response."""
+        if data is None:
+            response = self.client.open(path, method=method)
+        else:
+            response = self.client.open(path, method=method, data=json.dumps(data), content_type='application/json')
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s failed with status %s" % (method, path, response.status_code))
+        return response.get_json()
+
+    def graphql(self, query: str) -> dict:
+        """Execute a GraphQL query, and return its data."""
+        result = self.request('POST', '/', {'query': query})
+        if result.get('errors'):
+            raise RuntimeError(result['errors'])
+        return result['data']
+
+    def add_user(self, user_id: str) -> None:
+        self.request('POST', '/users/', {'id': user_id, 'name': user_id})
+
+    def add_message(self, user_id: str, content: str) -> None:
+        self.request('POST', '/users/%s/messages/' % user_id, {'content': content})
+
+    def add_message_graphql(self, user_id: str, content: str) -> None:
+        self.graphql(self.SEND_MESSAGE % (json.dumps(user_id), json.dumps(content)))
+
+    def list_users(self) -> None:
+        self.request('GET', '/users/?limit=20')
+
+    def list_messages(self, user_id: str) -> list:
+        return self.request('GET', '/users/%s/messages/?limit=20' % user_id)['value']
+
+    def get_message(self, user_id: str, message_id: str) -> None:
+        self.request('GET', '/users/%s/messages/%s/' % (user_id, message_id))
+
+    def search_messages(self, user_id: str, query: str) -> None:
+        self.request('GET', '/users/%s/messages/?limit=20&search=%s' % (user_id, query))
+
+    def recent_messages(self, user_id: str) -> None:
+        self.graphql(self.RECENT_MESSAGES % json.dumps(user_id))
+
+    def close(self) -> None:
+        self.data_manager.close()
+
+
+def run_target(target, arguments) -> dict:
+    """Run the benchmark operations against the target, returning the
+    statistics for each operation, keyed by operation name."""
+    results = {}
+    concurrency = arguments.concurrency
+    user_ids = ['bench_%s_%d' % (target.name, index) for index in range(arguments.users)]
+
+    def record(operation: str, function, jobs: list) -> None:
+        results['%s.%s' % (target.name, operation)] = measure(function, jobs, concurrency)
+
+    record('add_user', target.add_user, [(user_id,) for user_id in user_ids])
+    seed_history(target.data_manager, user_ids, arguments.history)
+
+    messages = [(user_id, 'Hello, this is message %d.' % index)
+                for index in range(arguments.messages) for user_id in user_ids]
+    record('add_message', target.add_message, messages)
+    if hasattr(target, 'add_message_graphql'):
+        record('add_message_graphql', target.add_message_graphql, messages)
+
+    message_ids = {user_id: target.list_messages(user_id) for user_id in user_ids}
+    reads = [(user_id,) for _ in range(arguments.messages) for user_id in user_ids]
+    record('list_users', target.list_users, [() for _ in reads])
+    record('list_messages', target.list_messages, reads)
+    record('get_message', target.get_message,
+           [(user_id, message_ids[user_id][index % len(message_ids[user_id])])
+            for index in range(arguments.messages) for user_id in user_ids if message_ids[user_id]])
+    record('search_messages', target.search_messages, [(user_id, 'hello') for user_id, in reads])
+    record('recent_messages', target.recent_messages, reads)
+    return results
+
+
+def get_commit() -> str:
+    """Return the current git commit, or None if it can't be determined."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results: dict, baseline: dict = None) -> None:
+    """Print the results, with the change in throughput and p99 latency
+    relative to the baseline results, if given."""
+    print("%-32s %8s %10s %9s %9s %9s" % ('operation', 'count', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for operation, stats in results.items():
+        line = "%-32s %8d %10.1f %9.2f %9.2f %9.2f" % (
+            operation, stats['count'], stats['throughput'], stats['p50'] * 1000, stats['p95'] * 1000,
+            stats['p99'] * 1000)
+        if baseline and operation in baseline:
+            before = baseline[operation]
+            if before['throughput'] and before['p99']:
+                line += "   throughput %+6.1f%%, p99 %+6.1f%%" % (
+                    (stats['throughput'] / before['throughput'] - 1) * 100, (stats['p99'] / before['p99'] - 1) * 100)
+        print(line)
+
+
+def main(args: list = None) -> int:
+    """The command-line entry point."""
+    parser = argparse.ArgumentParser(description="Benchmark the data manager and the HTTP API.")
+    parser.add_argument('--target', choices=['manager', 'http', 'all'], default='all',
+                        help="What to drive: the data manager, the HTTP API, or both.")
+    parser.add_argument('--users', type=int, default=20, help="The number of users.")
+    parser.add_argument('--messages', type=int, default=10,
+                        help="The number of messages sent to, and of each kind of read made for, each user.")
+    parser.add_argument('--history', type=int, default=200,
+                        help="The number of messages each user has before the benchmark starts.")
+    parser.add_argument('--concurrency', type=int, default=8, help="The number of concurrent client threads.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="The number of bot workers for the data manager target.")
+    parser.add_argument('--storage', default='shelve', help="The storage backend for the data manager target.")
+    parser.add_argument('--output', default='benchmark_results.json', help="Where to write the results.")
+    parser.add_argument('--compare', help="A results file from an earlier run, to compare against.")
+    arguments = parser.parse_args(args)
+
+    sys.path.insert(0, ROOT)
+    scratch = tempfile.mkdtemp(prefix='aiml_bot_api_bench_')
+    targets = []
+    if arguments.target in ('manager', 'all'):
+        targets.append(lambda: ManagerTarget(os.path.join(scratch, 'manager'), arguments.workers,
+                                             arguments.storage))
+    if arguments.target in ('http', 'all'):
+        targets.append(lambda: HTTPTarget(os.path.join(scratch, 'http')))
+
+    results = {}
+    for make_target in targets:
+        target = make_target()
+        try:
+            results.update(run_target(target, arguments))
+        finally:
+            target.close()
+
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)['results']
+    report(results, baseline)
+
+    with open(arguments.output, 'w') as file:
+        json.dump({
+            'commit': get_commit(),
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {name: value for name, value in vars(arguments).items()
+                           if name not in ('output', 'compare')},
+            'results': results,
+        }, file, indent=2, sort_keys=True)
+    print("Results written to %s" % arguments.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
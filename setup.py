@@ -117,6 +117,11 @@ setup(
         'flask',
         'flask_graphql',
         'graphene',
-        'aiml_bot',
+        # The response cache hooks into the bot's internals, so only the
+        # versions it was written against are allowed.
+        'aiml_bot>=0.0.3,<0.1',
     ],
+    extras_require={
+        'fast_json': ['orjson'],
+    },
 )
@@ -0,0 +1,137 @@
+"""
+Tests for the asyncio front-end.
+"""
+
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from aiml_bot_api.asgi import ASGIApp, start_server
+
+from test_data import DataManagerTestCase
+
+
+def wsgi_app(environ, start_response):
+    """A WSGI application which answers every request with its path."""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ['PATH_INFO'].encode('utf-8')]
+
+
+async def request(app: ASGIApp, path: str, query: str = '') -> (int, bytes):
+    """Make a GET request of the ASGI application, and return the status
+    and body of the response."""
+    received = asyncio.Event()
+    messages = []
+
+    async def receive():
+        if not received.is_set():
+            received.set()
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Event().wait()  # The client never disconnects.
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode('latin-1'), 'headers': []}
+    await app(scope, receive, send)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class LongPollTests(DataManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_manager = self.open_data_manager('log')
+        self.data_manager.add_user('user', 'User')
+        self.app = ASGIApp(wsgi_app, threads=2, data_manager=self.data_manager)
+        self.addCleanup(self.app.executor.shutdown)
+
+    def test_poll_times_out_without_messages(self):
+        status, body = asyncio.run(request(self.app, '/users/user/messages/poll/', 'timeout=0.1'))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {'type': 'new_messages', 'value': [], 'next_cursor': None})
+
+    def test_waiting_polls_do_not_hold_threads(self):
+        async def scenario():
+            polls = [asyncio.ensure_future(request(self.app, '/users/user/messages/poll/', 'timeout=10'))
+                     for _ in range(4)]
+            await asyncio.sleep(0.2)
+            # More polls are waiting than there are threads, but other
+            # requests are still served.
+            self.assertEqual(await asyncio.wait_for(request(self.app, '/other/'), 2), (200, b'/other/'))
+            self.assertFalse(any(poll.done() for poll in polls))
+            await asyncio.get_running_loop().run_in_executor(None, self.data_manager.add_message, 'user', 'hi')
+            return await asyncio.wait_for(asyncio.gather(*polls), 2)
+
+        for status, body in asyncio.run(scenario()):
+            self.assertEqual(status, 200)
+            self.assertEqual([message['content'] for message in json.loads(body)['value']], ['hi', 'echo: hi'])
+
+    def test_invalid_polls_are_left_to_the_wsgi_application(self):
+        for path, query in [('/users/user/messages/poll/', 'limit=0'), ('/users/nobody/messages/poll/', '')]:
+            self.assertEqual(asyncio.run(request(self.app, path, query)), (200, path.encode('utf-8')))
+
+
+class ServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = ASGIApp(wsgi_app, threads=2)
+        self.addCleanup(self.app.executor.shutdown)
+
+    def exchange(self, data: bytes = b'') -> bytes:
+        """Send data to the built-in server, and return everything sent back
+        until the server closes the connection."""
+        async def scenario():
+            server = await start_server(self.app, '127.0.0.1', 0)
+            async with server:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                writer.write(data)
+                await writer.drain()
+                response = await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+                return response
+
+        return asyncio.run(scenario())
+
+    def test_keep_alive_requests_are_served_in_order(self):
+        response = self.exchange(b'GET /first/ HTTP/1.1\r\n\r\n'
+                                 b'POST /second/ HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody'
+                                 b'GET /third/ HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK'), 3)
+        self.assertTrue(response.endswith(b'/third/'))
+
+    def test_transfer_encodings_are_rejected(self):
+        chunked = b'POST /a/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        smuggled = b'GET /smuggled/ HTTP/1.1\r\n\r\n'
+        for request, status in [
+                (chunked + b'%x\r\n%s\r\n0\r\n\r\n' % (len(smuggled), smuggled), b'411'),
+                (b'POST /a/ HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n', b'501'),
+                (b'POST /a/ HTTP/1.1\r\nContent-Length: 0\r\nTransfer-Encoding: chunked\r\n\r\n' + smuggled,
+                 b'400')]:
+            response = self.exchange(request)
+            # The connection is closed after the error, without reading any
+            # of the body as another request.
+            self.assertTrue(response.startswith(b'HTTP/1.1 ' + status), response)
+            self.assertEqual(response.count(b'HTTP/1.1'), 1, response)
+
+    def test_conflicting_content_lengths_are_rejected(self):
+        response = self.exchange(b'POST /a/ HTTP/1.1\r\nContent-Length: 1\r\nContent-Length: 2\r\n\r\nab')
+        self.assertTrue(response.startswith(b'HTTP/1.1 400'), response)
+
+    def test_too_many_headers_are_rejected(self):
+        response = self.exchange(b'GET /a/ HTTP/1.1\r\n' + b'X-Header: value\r\n' * 1000 + b'\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 431'), response)
+
+    def test_idle_connections_are_closed(self):
+        with mock.patch('aiml_bot_api.asgi.IDLE_TIMEOUT', 0.1):
+            self.assertEqual(self.exchange(), b'')
+
+    def test_slow_requests_time_out(self):
+        with mock.patch('aiml_bot_api.asgi.REQUEST_TIMEOUT', 0.1):
+            response = self.exchange(b'GET /a/ HTTP/1.1\r\nHost: example.com\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 408'), response)
+
+
+if __name__ == '__main__':
+    unittest.main()
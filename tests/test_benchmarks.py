@@ -0,0 +1,65 @@
+"""
+Tests for the benchmark suite's statistics and report.
+"""
+
+import argparse
+import io
+import os
+import sys
+import unittest
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench_suite  # noqa: E402
+
+from test_data import DataManagerTestCase  # noqa: E402
+
+
+class StatisticsTests(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([bench_suite.percentile(values, percent) for percent in (1, 50, 95, 99, 100)],
+                         [1, 50, 95, 99, 100])
+        self.assertEqual(bench_suite.percentile([7], 99), 7)
+        self.assertEqual(bench_suite.percentile([1, 2], 1), 1)
+        self.assertEqual(bench_suite.percentile([], 50), 0.0)
+
+    def test_measure(self):
+        calls = []
+        result = bench_suite.measure(calls.append, [(number,) for number in range(50)], 4)
+        self.assertEqual(sorted(calls), list(range(50)))
+        self.assertEqual(result['count'], 50)
+        self.assertLessEqual(result['p50'], result['p95'])
+        self.assertLessEqual(result['p95'], result['p99'])
+        self.assertLessEqual(result['p99'], result['max'])
+        self.assertEqual(bench_suite.measure(calls.append, [], 4)['count'], 0)
+
+
+class RunTargetTests(DataManagerTestCase):
+
+    def test_every_operation_is_measured(self):
+        # Drive a data manager with an echoing bot, rather than the AIML bot.
+        target = bench_suite.ManagerTarget.__new__(bench_suite.ManagerTarget)
+        target.data_manager = self.open_data_manager('log')
+        arguments = argparse.Namespace(users=3, messages=2, history=4, concurrency=2)
+        results = bench_suite.run_target(target, arguments)
+        self.assertEqual(set(results), {'manager.' + operation for operation in (
+            'add_user', 'add_message', 'list_users', 'list_messages', 'get_message', 'search_messages',
+            'recent_messages')})
+        self.assertEqual(results['manager.add_user']['count'], 3)
+        self.assertEqual(results['manager.add_message']['count'], 6)
+        # Each user has their history, and each message sent and its response.
+        self.assertEqual(len(target.data_manager.get_message_ids('bench_manager_0')), 4 + 2 * 2)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            bench_suite.report(results, results)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 1 + len(results))
+        self.assertIn('throughput   +0.0%', lines[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Tests for the brain snapshot's staleness check.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from aiml_bot_api import brain
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_folder, True)
+        self.source_folder = os.path.join(self.data_folder, 'aiml')
+        os.makedirs(self.source_folder)
+        for name in 'std-a.aiml', 'std-b.aiml':
+            self.write_source(name, '<aiml></aiml>')
+        # Describe the test's sources instead of the standard AIML set.
+        get_manifest = brain.get_manifest
+        pattern = os.path.join(self.source_folder, 'std-*.aiml')
+        patcher = mock.patch.object(brain, 'get_manifest', lambda: get_manifest(pattern))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_source(self, name: str, content: str) -> None:
+        with open(os.path.join(self.source_folder, name), 'w') as source_file:
+            source_file.write(content)
+
+    def build(self, while_loading=None) -> None:
+        """Build a snapshot with a stand-in bot, calling while_loading, if
+        given, while the bot is being constructed."""
+        class Bot:
+            def __init__(self, commands):
+                if while_loading is not None:
+                    while_loading()
+
+            @staticmethod
+            def save_brain(path: str) -> None:
+                with open(path, 'wb') as snapshot_file:
+                    snapshot_file.write(b'brain')
+
+        with mock.patch('aiml_bot.Bot', Bot):
+            brain.build_snapshot(self.data_folder)
+
+    def test_snapshot_is_current_until_the_sources_change(self):
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+        self.build()
+        self.assertTrue(brain.snapshot_is_current(self.data_folder))
+        self.write_source('std-a.aiml', '<aiml><category/></aiml>')
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+        self.build()
+        self.assertTrue(brain.snapshot_is_current(self.data_folder))
+
+    def test_added_and_removed_sources_make_the_snapshot_stale(self):
+        self.build()
+        self.write_source('std-c.aiml', '<aiml></aiml>')
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+        self.build()
+        os.remove(os.path.join(self.source_folder, 'std-a.aiml'))
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+
+    def test_sources_changed_during_the_build_make_the_snapshot_stale(self):
+        self.build(while_loading=lambda: self.write_source('std-b.aiml', '<aiml><category/></aiml>'))
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+
+    def test_another_python_version_makes_the_snapshot_stale(self):
+        self.build()
+        manifest_path = os.path.join(self.data_folder, brain.MANIFEST_FILE_NAME)
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest['python'] = [2, 7]
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+
+    def test_missing_or_damaged_manifest_makes_the_snapshot_stale(self):
+        self.build()
+        manifest_path = os.path.join(self.data_folder, brain.MANIFEST_FILE_NAME)
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write('{"sources": ')
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+        os.remove(manifest_path)
+        self.assertFalse(brain.snapshot_is_current(self.data_folder))
+
+
+if __name__ == '__main__':
+    unittest.main()
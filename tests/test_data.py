@@ -0,0 +1,394 @@
+"""
+Tests for the data manager.
+"""
+
+import dbm.dumb
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from aiml_bot_api.data import DataManager
+from aiml_bot_api.ids import format_timestamp, get_id_timestamp, make_id
+from aiml_bot_api.retention import RetentionPolicy
+from aiml_bot_api.storage import get_backend
+
+
+class EchoBot:
+    """A stand-in for aiml_bot.Bot, which echoes each message back."""
+
+    def __init__(self):
+        self.sessions = {}
+
+    def respond(self, content: str, user_id: str) -> str:
+        return 'echo: ' + content
+
+    def get_session_data(self, user_id: str) -> dict:
+        return dict(self.sessions.get(user_id, {}))
+
+    def set_session_data(self, session_data: dict, user_id: str) -> None:
+        self.sessions[user_id] = dict(session_data)
+
+    def delete_session(self, user_id: str) -> None:
+        self.sessions.pop(user_id, None)
+
+
+class DataManagerTestCase(unittest.TestCase):
+    """Base class for tests which need a data manager for each storage
+    backend, in a temporary data folder."""
+
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_folder, True)
+
+    def open_data_manager(self, storage: str, name: str = None) -> DataManager:
+        data_folder = os.path.join(self.data_folder, storage if name is None else name)
+        data_manager = DataManager(bot=EchoBot(), data_folder=data_folder, storage=storage)
+        self.addCleanup(data_manager.close)
+        return data_manager
+
+
+class InitializationTests(DataManagerTestCase):
+
+    def test_failed_initialization_leaves_nothing_to_close(self):
+        with mock.patch('sys.unraisablehook') as unraisablehook:
+            with self.assertRaises(ValueError):
+                DataManager(bot=EchoBot(), data_folder=self.data_folder, storage='nonexistent')
+            gc.collect()
+        unraisablehook.assert_not_called()
+
+
+class ConcurrentReadTests(DataManagerTestCase):
+    """Readers share a user's message lock, so every backend's message
+    stores must return the right messages to concurrent readers, including
+    while messages are being added."""
+
+    READERS = 8
+    READS = 300
+    WRITES = 50
+
+    def check_concurrent_reads(self, storage: str) -> None:
+        data_manager = self.open_data_manager(storage)
+        data_manager.add_user('user', 'User')
+        data_manager.import_messages(('user', {'content': 'message %d' % index}) for index in range(200))
+        message_ids = data_manager.get_message_ids('user')
+        self.assertEqual(len(message_ids), 200)
+        errors = []
+        start = threading.Barrier(self.READERS + 1)
+
+        def read() -> None:
+            start.wait()
+            for _ in range(self.READS):
+                message_id = random.choice(message_ids)
+                message_data = data_manager.get_message_data('user', message_id)
+                if message_data['id'] != message_id:
+                    errors.append((message_id, message_data['id']))
+                batch = random.sample(message_ids, 5)
+                for other_id, other_data in data_manager.get_messages_bulk('user', batch).items():
+                    if other_data['id'] != other_id:
+                        errors.append((other_id, other_data['id']))
+
+        def write() -> None:
+            start.wait()
+            for index in range(self.WRITES):
+                data_manager.add_message('user', 'new message %d' % index)
+
+        threads = [threading.Thread(target=read) for _ in range(self.READERS)] + [threading.Thread(target=write)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # Each new message was answered by the bot.
+        self.assertEqual(len(data_manager.get_message_ids('user')), 200 + 2 * self.WRITES)
+
+    def test_shelve(self):
+        self.check_concurrent_reads('shelve')
+
+    def test_log(self):
+        self.check_concurrent_reads('log')
+
+    def test_sqlite(self):
+        self.check_concurrent_reads('sqlite')
+
+
+class ConcurrentUserTests(DataManagerTestCase):
+    """Users are added and renamed under their own locks, so the users
+    store, which they share, must be safe to write from several threads at
+    once, even with a dbm module which isn't."""
+
+    THREADS = 8
+    USERS = 100
+    ROUNDS = 3
+
+    def add_users_concurrently(self, name: str) -> None:
+        data_manager = self.open_data_manager('shelve', name)
+        start = threading.Barrier(self.THREADS)
+
+        def add_users(thread: int) -> None:
+            start.wait()
+            for number in range(self.USERS):
+                user_id = 'user-%d-%d' % (thread, number)
+                data_manager.add_user(user_id, 'User')
+                data_manager.set_user_name(user_id, user_id * 100)
+                data_manager.get_user_data('user-%d-0' % thread)
+
+        threads = [threading.Thread(target=add_users, args=(thread,)) for thread in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        data_manager.close()
+        data_manager = self.open_data_manager('shelve', name)
+        user_ids = sorted('user-%d-%d' % (thread, number)
+                          for thread in range(self.THREADS) for number in range(self.USERS))
+        self.assertEqual(data_manager.get_user_ids(), user_ids)
+        users = data_manager.get_users_bulk(user_ids)
+        self.assertEqual({user_id: users[user_id]['name'] for user_id in user_ids},
+                         {user_id: user_id * 100 for user_id in user_ids})
+
+    def test_concurrent_add_user_with_dbm_dumb(self):
+        # Switch threads often, to make overlapping writes likely.
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        with mock.patch('dbm.open', dbm.dumb.open):
+            for number in range(self.ROUNDS):
+                self.add_users_concurrently('round-%d' % number)
+
+
+class AddMessagesTests(DataManagerTestCase):
+
+    def test_results_are_in_the_order_given(self):
+        data_manager = self.open_data_manager('log')
+        for user_id in 'user0', 'user1':
+            data_manager.add_user(user_id, user_id.title())
+        messages = [('user%d' % (number % 2), 'message %d' % number) for number in range(10)]
+        messages.insert(3, ('nobody', 'lost'))
+        results = data_manager.add_messages(messages)
+        self.assertEqual(len(results), len(messages))
+        self.assertIsNone(results[3])
+        self.assertNotIn('nobody', data_manager.users)
+        for (user_id, content), result in zip(messages, results):
+            if result is None:
+                continue
+            message_id, response_id = result
+            self.assertEqual(data_manager.get_message_data(user_id, message_id)['content'], content)
+            self.assertEqual(data_manager.get_message_data(user_id, response_id)['content'], 'echo: ' + content)
+        # Each user's messages were added, and answered, in the order given.
+        for user_id in 'user0', 'user1':
+            self.assertEqual(data_manager.get_message_ids(user_id),
+                             [message_id for (message_user_id, _), result in zip(messages, results)
+                              if message_user_id == user_id for message_id in result])
+
+    def test_no_messages(self):
+        self.assertEqual(self.open_data_manager('log').add_messages([]), [])
+
+
+class ImportTests(DataManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_manager = self.open_data_manager('log')
+        self.data_manager.add_user('user', 'User')
+
+    def reopen(self) -> DataManager:
+        self.data_manager.close()
+        self.data_manager = self.open_data_manager('log')
+        return self.data_manager
+
+    def test_malformed_ids_are_rejected(self):
+        client_id = make_id('client', 1500000000000000)
+        bad_messages = [
+            {'id': 'foo', 'content': 'not an ID'},
+            {'id': 'c' + 'x' * 22, 'content': 'not hexadecimal'},
+            {'id': client_id[:-1] + '\t', 'content': 'a tab in the ID'},
+            {'id': client_id, 'origin': 'server', 'content': 'the wrong origin'},
+            {'id': client_id, 'time': format_timestamp(1500000000000001), 'content': 'the wrong time'},
+        ]
+        summary = self.data_manager.import_messages(('user', message_data) for message_data in bad_messages)
+        self.assertEqual((summary['imported'], summary['rejected']), (0, len(bad_messages)))
+        self.assertEqual(self.reopen().get_message_ids('user'), [])
+
+    def test_well_formed_ids_are_kept(self):
+        client_id = make_id('client', 1500000000000000)
+        legacy_id = 's' + 'ab' * 32
+        messages = [
+            {'id': client_id, 'content': 'hello'},
+            {'id': legacy_id, 'origin': 'server', 'time': format_timestamp(1500000000000001), 'content': 'hi'},
+        ]
+        summary = self.data_manager.import_messages(('user', message_data) for message_data in messages)
+        self.assertEqual((summary['imported'], summary['rejected']), (2, 0))
+        data_manager = self.reopen()
+        self.assertEqual(data_manager.get_message_ids('user'), [client_id, legacy_id])
+        # A message without a time takes it from its ID.
+        self.assertEqual(data_manager.get_message_data('user', client_id)['time'],
+                         format_timestamp(get_id_timestamp(client_id)))
+        self.assertEqual(data_manager.find_message_ids('user', origin='server'), [legacy_id])
+
+    def test_import_fails_cleanly_once_importers_are_shut_down(self):
+        for importer in self.data_manager._importers:
+            importer.shutdown()
+        with self.assertRaises(RuntimeError):
+            self.data_manager.import_messages(('user', {'content': 'message %d' % index}) for index in range(10))
+
+
+class PaginationTests(DataManagerTestCase):
+
+    def test_user_pages(self):
+        data_manager = self.open_data_manager('log')
+        for user_id in 'carol', 'alice', 'bob':
+            data_manager.add_user(user_id, user_id.title())
+        self.assertEqual(data_manager.get_user_page(limit=2), (['alice', 'bob'], 'bob'))
+        self.assertEqual(data_manager.get_user_page('bob', 2), (['carol'], None))
+        # A cursor need not be an existing user.
+        self.assertEqual(data_manager.get_user_page('b'), (['bob', 'carol'], None))
+
+    def test_message_cursors_survive_the_removal_of_their_message(self):
+        data_manager = self.open_data_manager('log')
+        data_manager.add_user('user', 'User')
+        data_manager.import_messages(('user', {'content': 'message %d' % number}) for number in range(6))
+        message_ids = data_manager.get_message_ids('user')
+        page, cursor = data_manager.get_message_page('user', limit=3)
+        self.assertEqual((page, cursor), (message_ids[:3], message_ids[2]))
+        data_manager.archive_messages('user', 3)
+        self.assertEqual(data_manager.get_message_page('user', cursor, 3), (message_ids[3:], None))
+        with self.assertRaises(ValueError):
+            data_manager.get_message_page('user', 'not an ID')
+        with self.assertRaises(KeyError):
+            data_manager.get_message_page('nobody')
+
+
+class IterMessagesTests(DataManagerTestCase):
+
+    def check_time_range(self, storage: str) -> None:
+        data_manager = self.open_data_manager(storage)
+        self.addCleanup(data_manager.close)
+        data_manager.add_user('user', 'User')
+        # Messages 0.4 seconds apart, so some seconds hold several of them.
+        timestamps = [1500000000000000 + number * 400000 for number in range(20)]
+        message_ids = [make_id('client', timestamp) for timestamp in timestamps]
+        data_manager.import_messages(('user', {'id': message_id, 'content': 'hello'}) for message_id in message_ids)
+        times = [float(format_timestamp(timestamp)) for timestamp in timestamps]
+        for after, before, expected in [(None, None, message_ids), (times[3], times[15], message_ids[3:16]),
+                                        (times[3] + 0.1, None, message_ids[4:]), (None, times[0], message_ids[:1])]:
+            messages = data_manager.iter_messages('user', after, before, batch_size=4)
+            self.assertEqual([message_data['id'] for message_data in messages], expected)
+        with self.assertRaises(KeyError):
+            next(data_manager.iter_messages('nobody'))
+
+    def test_log(self):
+        self.check_time_range('log')
+
+    def test_sqlite(self):
+        self.check_time_range('sqlite')
+
+
+class RetentionTests(DataManagerTestCase):
+
+    DAY = 24 * 60 * 60
+
+    def add_messages(self, data_manager: DataManager, ages: list) -> list:
+        """Import a message for each of the given ages, in days, oldest
+        first, and return their IDs."""
+        now = time.time()
+        message_ids = [make_id('client', int((now - age * self.DAY) * 1000000)) for age in sorted(ages, reverse=True)]
+        data_manager.import_messages(('user', {'id': message_id, 'content': 'hello'}) for message_id in message_ids)
+        return message_ids
+
+    def open_user(self, storage: str) -> DataManager:
+        data_manager = self.open_data_manager(storage)
+        if 'user' not in data_manager.get_user_ids():
+            data_manager.add_user('user', 'User')
+        return data_manager
+
+    def test_age_policy(self):
+        data_manager = self.open_user('log')
+        message_ids = self.add_messages(data_manager, [10, 5, 0.5, 0])
+        summary = data_manager.apply_retention(RetentionPolicy(max_age=self.DAY))
+        self.assertEqual(summary, {'users': 1, 'archived': 2})
+        self.assertEqual(data_manager.get_message_ids('user'), message_ids[2:])
+        self.assertEqual(data_manager.get_archived_message_ids('user'), message_ids[:2])
+        self.assertEqual(data_manager.apply_retention(RetentionPolicy(max_age=self.DAY))['archived'], 0)
+
+    def test_count_policy(self):
+        data_manager = self.open_user('sqlite')
+        message_ids = self.add_messages(data_manager, range(10))
+        summary = data_manager.apply_retention(RetentionPolicy(max_messages=3, segment_size=4))
+        self.assertEqual(summary, {'users': 1, 'archived': 7})
+        self.assertEqual(data_manager.get_message_ids('user'), message_ids[7:])
+        self.assertEqual(data_manager.get_archived_message_ids('user'), message_ids[:7])
+        self.assertEqual(data_manager.get_message_data('user', message_ids[0])['id'], message_ids[0])
+
+    def test_archived_messages_are_compacted_out_of_the_store(self):
+        for storage in 'shelve', 'log':
+            data_manager = self.open_user(storage)
+            message_ids = self.add_messages(data_manager, range(10))
+            data_manager.apply_retention(RetentionPolicy(max_messages=4))
+            data_manager.close()
+            backend = get_backend(storage, os.path.join(self.data_folder, storage))
+            messages = backend.open_messages('user')
+            self.assertEqual(sorted(messages), sorted(message_ids[6:]))
+            messages.close()
+            backend.close()
+
+    def test_users_within_the_policy_are_not_loaded_after_a_restart(self):
+        data_manager = self.open_user('log')
+        message_ids = self.add_messages(data_manager, [10, 5, 0])
+        data_manager.close()
+        data_manager = self.open_user('log')
+        self.assertEqual(data_manager.apply_retention(RetentionPolicy(max_age=30 * self.DAY, max_messages=3)),
+                         {'users': 0, 'archived': 0})
+        self.assertEqual(data_manager.get_cache_stats()['misses'], 0)
+        # A user whose summary shows messages beyond the limits is loaded.
+        self.assertEqual(data_manager.apply_retention(RetentionPolicy(max_messages=2))['archived'], 1)
+        self.assertEqual(data_manager.get_message_ids('user'), message_ids[1:])
+
+    def test_users_without_a_summary_are_loaded(self):
+        data_manager = self.open_user('log')
+        message_ids = self.add_messages(data_manager, [10, 5, 0])
+        data_manager.close()
+        # The summary is dropped while the user is loaded, and is only
+        # written again when the user is evicted, which a crash prevents.
+        backend = get_backend('log', os.path.join(self.data_folder, 'log'))
+        message_stats = backend.open_message_stats()
+        self.assertEqual(message_stats['user'][1], 3)
+        del message_stats['user']
+        message_stats.close()
+        backend.close()
+        data_manager = self.open_user('log')
+        self.assertEqual(data_manager.apply_retention(RetentionPolicy(max_age=self.DAY))['archived'], 2)
+        self.assertEqual(data_manager.get_message_ids('user'), message_ids[2:])
+
+    def test_has_message(self):
+        data_manager = self.open_user('log')
+        message_ids = self.add_messages(data_manager, [10, 0])
+        data_manager.archive_messages('user', 1)
+        self.assertTrue(data_manager.has_message('user', message_ids[0]))
+        self.assertTrue(data_manager.has_message('user', message_ids[1]))
+        self.assertFalse(data_manager.has_message('user', make_id('client', 0)))
+        self.assertFalse(data_manager.has_message('nobody', message_ids[1]))
+
+    def test_rebuilt_index_leaves_out_archived_messages(self):
+        data_manager = self.open_data_manager('log')
+        data_manager.add_user('user', 'User')
+        data_manager.import_messages(('user', {'content': 'message %d' % index}) for index in range(10))
+        # Leave the archived messages in the store, as an interrupted
+        # compaction would.
+        data_manager.compact_messages = lambda user_id: False
+        self.assertEqual(data_manager.archive_messages('user', 4), 4)
+        live = data_manager.get_message_ids('user')
+        archived = data_manager.get_archived_message_ids('user')
+        data_manager.rebuild_index('user')
+        self.assertEqual(data_manager.get_message_ids('user'), live)
+        self.assertEqual(data_manager.get_message_page('user', search='message')[0], live)
+        self.assertEqual(data_manager.get_message_data('user', archived[0])['id'], archived[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Tests for response serialization, compression, and streaming.
+"""
+
+import gzip
+import json
+import unittest
+import zlib
+from unittest import mock
+
+from werkzeug.datastructures import Accept
+
+from aiml_bot_api import encoding
+
+from test_endpoints import EndpointTestCase
+
+
+def decompress(data: bytes, coding: str) -> bytes:
+    return gzip.decompress(data) if coding == 'gzip' else zlib.decompress(data)
+
+
+class EncodeJSONTests(unittest.TestCase):
+
+    def test_small_bodies_are_not_compressed(self):
+        result = {'type': 'test', 'value': 'short'}
+        for coding in None, 'gzip', 'deflate':
+            self.assertEqual(encoding.encode_json(result, coding), (b'{"type":"test","value":"short"}', None))
+
+    def test_large_bodies_are_compressed(self):
+        result = {'type': 'test', 'value': 'café ' * 1000}
+        self.assertEqual(encoding.encode_json(result), (encoding.dumps(result), None))
+        for coding in 'gzip', 'deflate':
+            body, applied = encoding.encode_json(result, coding)
+            self.assertEqual(applied, coding)
+            self.assertLess(len(body), encoding.MIN_COMPRESSED_SIZE)
+            self.assertEqual(json.loads(decompress(body, coding).decode('utf-8')), result)
+
+    def test_long_lists_are_streamed(self):
+        result = {'type': 'test', 'value': ['item %d' % number for number in range(20000)], 'next_cursor': None}
+        body, coding = encoding.encode_json(result)
+        self.assertIsNone(coding)
+        chunks = list(body)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), result)
+        for coding in 'gzip', 'deflate':
+            body, applied = encoding.encode_json(result, coding)
+            self.assertEqual(applied, coding)
+            self.assertEqual(json.loads(decompress(b''.join(body), coding).decode('utf-8')), result)
+
+    def test_streamed_chunks(self):
+        self.assertEqual(b''.join(encoding.iter_json_chunks({'value': []})), b'{"value":[]}')
+        self.assertEqual(b''.join(encoding.iter_json_chunks({'value': [1, 2], 'type': 'x'})),
+                         b'{"type":"x","value":[1,2]}')
+
+    def test_content_coding_preference(self):
+        for header, coding in [([], None), ([('identity', 1)], None), ([('gzip', 1)], 'gzip'),
+                               ([('deflate', 1)], 'deflate'), ([('gzip', 0.5), ('deflate', 1)], 'deflate'),
+                               ([('br', 1)], None), ([('*', 1)], 'gzip')]:
+            self.assertEqual(encoding.choose_content_coding(Accept(header)), coding, header)
+
+    def test_json_encoders_agree(self):
+        value = {'text': 'café \U0001f600 </script> "quoted"', 'numbers': [1, -2, 3.5], 'none': None}
+        expected = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        original = encoding.get_json_encoder()
+        self.addCleanup(encoding.set_json_encoder, original)
+        for name in encoding.JSON_ENCODERS:
+            try:
+                self.assertEqual(encoding.set_json_encoder(name), name)
+            except ValueError:
+                continue  # Not installed
+            self.assertEqual(json.loads(encoding.dumps(value)), value, name)
+            if name == 'json':
+                self.assertEqual(encoding.dumps(value), expected)
+        with self.assertRaises(ValueError):
+            encoding.set_json_encoder('nonexistent')
+
+
+class CompressedResponseTests(EndpointTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for number in range(30):
+            self.data_manager.add_user('user%02d' % number, 'User %d' % number)
+        self.data_manager.import_messages(('user00', {'content': 'message %d' % number}) for number in range(200))
+
+    def test_json_responses(self):
+        expected = self.get_json('/users/')
+        # Both whole and streamed bodies are compressed.
+        for streamed_items in encoding.MIN_STREAMED_ITEMS, 10:
+            with mock.patch.object(encoding, 'MIN_STREAMED_ITEMS', streamed_items), \
+                    mock.patch.object(encoding, 'MIN_COMPRESSED_SIZE', 100):
+                for coding in 'gzip', 'deflate':
+                    response = self.client.get('/users/', headers={'Accept-Encoding': coding})
+                    self.assertEqual(response.content_encoding, coding)
+                    self.assertIn('Accept-Encoding', response.vary)
+                    self.assertEqual(json.loads(decompress(response.data, coding).decode('utf-8')), expected)
+        response = self.client.get('/users/', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.content_encoding)  # Too small to be worth compressing
+
+    def test_ndjson_exports(self):
+        expected = self.client.get('/users/user00/messages/export/').data
+        self.assertEqual(len(expected.splitlines()), 200)
+        for coding in 'gzip', 'deflate':
+            response = self.client.get('/users/user00/messages/export/', headers={'Accept-Encoding': coding})
+            self.assertEqual(response.content_encoding, coding)
+            self.assertEqual(decompress(response.data, coding), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
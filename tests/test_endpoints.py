@@ -0,0 +1,226 @@
+"""
+Tests for the JSON endpoints, using Flask's test client.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Importing the endpoints starts the global data manager, so it is kept out
+# of the user's home folder. Each test replaces it with its own.
+_data_folder = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _data_folder, True)
+os.environ.setdefault('AIML_BOT_API_DATA_FOLDER', _data_folder)
+
+from aiml_bot_api import endpoints  # noqa: E402
+from aiml_bot_api.ids import format_timestamp, make_id  # noqa: E402
+
+from test_data import DataManagerTestCase  # noqa: E402
+
+
+class EndpointTestCase(DataManagerTestCase):
+    """Base class for tests of the endpoints, which are served from a data
+    manager with an echoing bot."""
+
+    storage = 'log'
+    patched_modules = [endpoints]
+
+    def setUp(self):
+        super().setUp()
+        self.data_manager = self.open_data_manager(self.storage)
+        for module in self.patched_modules:
+            patcher = mock.patch.object(module, 'data_manager', self.data_manager)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = endpoints.app.test_client()
+
+    def get_json(self, url: str, **kwargs) -> dict:
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data)
+
+    def post_json(self, url: str, data) -> dict:
+        return json.loads(self.client.post(url, data=json.dumps(data), content_type='application/json').data)
+
+
+class PaginationTests(EndpointTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for number in range(5):
+            self.data_manager.add_user('user%d' % number, 'User %d' % number)
+        for number in range(3):
+            self.data_manager.add_message('user0', 'hello %d' % number)
+        self.message_ids = self.data_manager.get_message_ids('user0')
+
+    def read_pages(self, url: str, limit: int) -> list:
+        """Follow the cursors of a paginated listing, and return its pages."""
+        pages = []
+        cursor = None
+        while True:
+            query = {'limit': limit} if cursor is None else {'limit': limit, 'cursor': cursor}
+            result = self.get_json(url, query_string=query)
+            pages.append(result['value'])
+            cursor = result['next_cursor']
+            if cursor is None:
+                return pages
+
+    def test_users_are_listed_a_page_at_a_time(self):
+        self.assertEqual(self.read_pages('/users/', 2), [['user0', 'user1'], ['user2', 'user3'], ['user4']])
+        self.assertEqual(self.get_json('/users/')['value'], ['user%d' % number for number in range(5)])
+
+    def test_messages_are_listed_a_page_at_a_time(self):
+        self.assertEqual(len(self.message_ids), 6)  # Each message and its response
+        pages = self.read_pages('/users/user0/messages/', 4)
+        self.assertEqual(pages, [self.message_ids[:4], self.message_ids[4:]])
+        # Only the bot's responses match the search.
+        result = self.get_json('/users/user0/messages/', query_string={'search': 'echo', 'limit': 2})
+        self.assertEqual(result['value'], self.message_ids[1:4:2])
+        result = self.get_json('/users/user0/messages/',
+                               query_string={'search': 'echo', 'cursor': result['next_cursor']})
+        self.assertEqual((result['value'], result['next_cursor']), ([self.message_ids[5]], None))
+
+    def test_invalid_page_arguments_are_rejected(self):
+        for query in {'limit': 0}, {'limit': 'x'}, {'cursor': 'not an ID'}:
+            response = self.client.get('/users/user0/messages/', query_string=query)
+            self.assertEqual(response.status_code, 400, query)
+        self.assertEqual(self.client.get('/users/', query_string={'limit': -1}).status_code, 400)
+
+
+class ConditionalGetTests(EndpointTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_manager.add_user('user0', 'User 0')
+
+    def test_listings_are_revalidated_by_etag(self):
+        for url, change in [('/users/', lambda: self.data_manager.add_user('user1', 'User 1')),
+                            ('/users/user0/', lambda: self.data_manager.set_user_name('user0', 'Zero')),
+                            ('/users/user0/messages/', lambda: self.data_manager.add_message('user0', 'hello'))]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertTrue(response.cache_control.no_cache)
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual((response.status_code, response.data), (304, b''), url)
+            self.assertEqual(response.headers['ETag'], etag)
+            change()
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200, url)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_listings_are_revalidated_by_modification_time(self):
+        with mock.patch.object(self.data_manager, 'get_users_version', return_value=('tag', 1500000000.5)):
+            response = self.client.get('/users/')
+            self.assertEqual(response.headers['Last-Modified'], 'Fri, 14 Jul 2017 02:40:00 GMT')
+            response = self.client.get('/users/', headers={'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get('/users/', headers={'If-Modified-Since': 'Fri, 14 Jul 2017 02:39:59 GMT'})
+            self.assertEqual(response.status_code, 200)
+            # If-None-Match takes precedence.
+            response = self.client.get('/users/', headers={'If-None-Match': '"other"',
+                                                           'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'})
+            self.assertEqual(response.status_code, 200)
+        # A change within the last second has no Last-Modified header, since
+        # another change in the same second couldn't be told apart.
+        self.assertNotIn('Last-Modified', self.client.get('/users/').headers)
+
+    def test_errors_are_not_tagged(self):
+        response = self.client.get('/users/nobody/')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_messages_are_immutable(self):
+        message_id = self.data_manager.add_message('user0', 'hello')[0]
+        url = '/users/user0/messages/%s/' % message_id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.cache_control.immutable)
+        etag = response.headers['ETag']
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.headers['ETag']), (304, etag))
+        # A tag for a message which no longer exists isn't confirmed.
+        self.data_manager.remove_user('user0')
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response.headers)
+
+
+class BatchMessagesTests(EndpointTestCase):
+
+    def test_results_are_in_the_order_given(self):
+        self.data_manager.add_user('user0', 'User 0')
+        result = self.post_json('/messages/batch/', {'messages': [
+            {'user_id': 'user0', 'content': ' first '},
+            {'user_id': 'nobody', 'content': 'lost'},
+            {'user_id': 'user0', 'content': 'second'},
+        ]})
+        self.assertEqual(result['type'], 'messages_received')
+        message_ids = self.data_manager.get_message_ids('user0')
+        self.assertEqual(result['value'], [
+            {'user_id': 'user0', 'id': message_ids[0], 'response_id': message_ids[1]},
+            {'user_id': 'nobody', 'error': 'User not found.'},
+            {'user_id': 'user0', 'id': message_ids[2], 'response_id': message_ids[3]},
+        ])
+        self.assertEqual(self.data_manager.get_message_data('user0', message_ids[0])['content'], 'first')
+
+    def test_malformed_batches_are_rejected_whole(self):
+        self.data_manager.add_user('user0', 'User 0')
+        for messages in (None, [None], [{'user_id': 'user0'}], [{'user_id': 'user0', 'content': 1}],
+                         [{'user_id': 'user0', 'content': 'hi'}, {'user_id': 'user0', 'content': '  '}]):
+            response = self.client.post('/messages/batch/', data=json.dumps({'messages': messages}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400, messages)
+        self.assertEqual(self.data_manager.get_message_ids('user0'), [])
+
+
+class ExportTests(EndpointTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Neighbouring messages a microsecond apart, in two different seconds.
+        timestamps = [1500000000999998, 1500000000999999, 1500000001000000, 1500000001000001, 1500000001500000]
+        self.messages = [{'id': make_id('client', timestamp), 'origin': 'client', 'content': 'hello %d' % number,
+                          'time': format_timestamp(timestamp)}
+                         for number, timestamp in enumerate(timestamps)]
+        for user_id in 'user0', 'user1':
+            self.data_manager.add_user(user_id, user_id.title())
+        self.data_manager.import_messages(('user0', message) for message in self.messages)
+
+    def get_ndjson(self, url: str, **kwargs) -> list:
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in response.data.splitlines()]
+
+    def test_bounds_are_inclusive_to_the_microsecond(self):
+        url = '/users/user0/messages/export/'
+        self.assertEqual(self.get_ndjson(url), self.messages)
+        for first, last in (0, 4), (1, 2), (2, 2), (1, 3), (3, 4):
+            query = {'after': self.messages[first]['time'], 'before': self.messages[last]['time']}
+            self.assertEqual(self.get_ndjson(url, query_string=query), self.messages[first:last + 1], query)
+        self.assertEqual(self.get_ndjson(url, query_string={'after': self.messages[3]['time']}), self.messages[3:])
+        self.assertEqual(self.get_ndjson(url, query_string={'before': self.messages[1]['time']}), self.messages[:2])
+        self.assertEqual(self.get_ndjson(url, query_string={'after': self.messages[4]['time'],
+                                                            'before': self.messages[0]['time']}), [])
+
+    def test_export_all_applies_the_bounds_to_each_user(self):
+        query = {'after': self.messages[1]['time'], 'before': self.messages[2]['time']}
+        self.assertEqual(self.get_ndjson('/export/', query_string=query),
+                         [{'type': 'user', 'value': {'id': 'user0', 'name': 'User0'}}] +
+                         [{'type': 'message', 'user_id': 'user0', 'value': message} for message in self.messages[1:3]] +
+                         [{'type': 'user', 'value': {'id': 'user1', 'name': 'User1'}}])
+
+    def test_invalid_bounds_and_unknown_users_are_rejected(self):
+        for query in {'after': 'yesterday'}, {'before': '2017'}:
+            self.assertEqual(self.client.get('/export/', query_string=query).status_code, 400, query)
+            self.assertEqual(self.client.get('/users/user0/messages/export/', query_string=query).status_code, 400)
+        self.assertEqual(self.client.get('/users/nobody/messages/export/').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
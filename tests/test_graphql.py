@@ -0,0 +1,94 @@
+"""
+Tests for the GraphQL schema's connections.
+"""
+
+import unittest
+
+from test_endpoints import EndpointTestCase
+
+try:
+    from aiml_bot_api import graphql
+except ImportError:  # Older releases of graphene's dependencies don't import on newer versions of Python.
+    graphql = None
+
+
+@unittest.skipIf(graphql is None, "graphene can't be imported")
+class ConnectionTests(EndpointTestCase):
+
+    patched_modules = EndpointTestCase.patched_modules + ([] if graphql is None else [graphql])
+
+    def setUp(self):
+        super().setUp()
+        for number in range(3):
+            self.data_manager.add_user('user%d' % number, 'User %d' % number)
+        for number in range(3):
+            self.data_manager.add_message('user0', 'hello %d' % number)
+        self.message_ids = self.data_manager.get_message_ids('user0')
+
+    def execute(self, query: str) -> dict:
+        result = graphql.schema.execute(query)
+        self.assertFalse(result.errors, result.errors)
+        return result.data
+
+    def test_user_connection(self):
+        data = self.execute('{ userConnection(first: 2) { edges { cursor node { id name } } '
+                            'pageInfo { hasNextPage hasPreviousPage endCursor } } }')['userConnection']
+        self.assertEqual([edge['cursor'] for edge in data['edges']], ['user0', 'user1'])
+        self.assertEqual(data['edges'][1]['node'], {'id': 'user1', 'name': 'User 1'})
+        self.assertEqual(data['pageInfo'], {'hasNextPage': True, 'hasPreviousPage': False, 'endCursor': 'user1'})
+        data = self.execute('{ userConnection(first: 2, after: "user1") { edges { cursor } '
+                            'pageInfo { hasNextPage hasPreviousPage endCursor } } }')['userConnection']
+        self.assertEqual([edge['cursor'] for edge in data['edges']], ['user2'])
+        self.assertEqual(data['pageInfo'], {'hasNextPage': False, 'hasPreviousPage': True, 'endCursor': 'user2'})
+
+    def test_message_connection(self):
+        cursor = None
+        pages = []
+        while True:
+            after = '' if cursor is None else ', after: "%s"' % cursor
+            data = self.execute('{ userConnection(first: 1) { edges { node { messageConnection(first: 4%s) { '
+                                'edges { cursor node { id content } } pageInfo { hasNextPage endCursor } } } } } }'
+                                % after)
+            connection = data['userConnection']['edges'][0]['node']['messageConnection']
+            pages.append([edge['node']['id'] for edge in connection['edges']])
+            self.assertEqual([edge['cursor'] for edge in connection['edges']], pages[-1])
+            if not connection['pageInfo']['hasNextPage']:
+                break
+            cursor = connection['pageInfo']['endCursor']
+        self.assertEqual(pages, [self.message_ids[:4], self.message_ids[4:]])
+
+    def test_negative_first_is_rejected(self):
+        result = graphql.schema.execute('{ userConnection(first: -1) { edges { cursor } } }')
+        self.assertTrue(result.errors)
+
+
+@unittest.skipIf(graphql is None, "graphene can't be imported")
+class SendMessagesTests(EndpointTestCase):
+
+    patched_modules = ConnectionTests.patched_modules
+
+    def test_results_are_in_the_order_given(self):
+        self.data_manager.add_user('user0', 'User 0')
+        result = graphql.schema.execute(
+            'mutation { sendMessages(input: [{user: {id: "user0"}, content: "first"}, {user: {id: "nobody"}, '
+            'content: "lost"}, {user: {id: "user0"}}, {user: {id: "user0"}, content: "second"}]) '
+            '{ results { message { id } response { id } error } error } }')
+        self.assertFalse(result.errors, result.errors)
+        message_ids = self.data_manager.get_message_ids('user0')
+        self.assertEqual(result.data['sendMessages'], {'error': None, 'results': [
+            {'message': {'id': message_ids[0]}, 'response': {'id': message_ids[1]}, 'error': None},
+            {'message': None, 'response': None, 'error': 'User not found.'},
+            {'message': None, 'response': None, 'error': 'No content specified.'},
+            {'message': {'id': message_ids[2]}, 'response': {'id': message_ids[3]}, 'error': None},
+        ]})
+
+    def test_null_inputs_are_rejected(self):
+        self.data_manager.add_user('user0', 'User 0')
+        result = graphql.schema.execute('mutation { sendMessages(input: [{user: {id: "user0"}, content: "hi"}, '
+                                        'null]) { results { error } } }')
+        self.assertTrue(result.errors)
+        self.assertEqual(self.data_manager.get_message_ids('user0'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
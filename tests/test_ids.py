@@ -0,0 +1,66 @@
+"""
+Tests for message ID generation and ordering.
+"""
+
+import unittest
+from unittest import mock
+
+from aiml_bot_api import ids
+
+
+class MessageIdGeneratorTests(unittest.TestCase):
+
+    def test_ids_within_the_same_microsecond_are_ordered(self):
+        generator = ids.MessageIdGenerator()
+        with mock.patch('time.time_ns', return_value=1500000000 * 10 ** 9):
+            generated = [generator.new_id(origin) for origin in ['client', 'server'] * 50]
+        message_ids = [message_id for message_id, _ in generated]
+        times = [message_time for _, message_time in generated]
+        self.assertEqual(len(set(message_ids)), len(message_ids))
+        keys = [ids.get_sort_key(message_id) for message_id in message_ids]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(set(times)), len(times))
+
+    def test_ids_are_ordered_when_the_clock_goes_backwards(self):
+        generator = ids.MessageIdGenerator()
+        with mock.patch('time.time_ns', side_effect=[2000 * 10 ** 9, 1000 * 10 ** 9, 1000 * 10 ** 9]):
+            message_ids = [generator.new_id('client')[0] for _ in range(3)]
+        timestamps = [ids.get_id_timestamp(message_id) for message_id in message_ids]
+        self.assertEqual(timestamps, [2000 * 10 ** 6, 2000 * 10 ** 6 + 1, 2000 * 10 ** 6 + 2])
+
+    def test_id_encodes_origin_and_time(self):
+        message_id, message_time = ids.MessageIdGenerator().new_id('server')
+        self.assertEqual(len(message_id), ids.ID_LENGTH)
+        self.assertTrue(ids.is_ordered_id(message_id))
+        self.assertEqual(ids.get_id_origin(message_id), 'server')
+        self.assertEqual(ids.format_timestamp(ids.get_id_timestamp(message_id)), message_time)
+        self.assertEqual(ids.parse_time(message_time), ids.get_id_timestamp(message_id))
+
+
+class SortKeyTests(unittest.TestCase):
+
+    def test_ids_sort_by_time_regardless_of_origin(self):
+        later_client = ids.make_id('client', 2000)
+        earlier_server = ids.make_id('server', 1000)
+        self.assertLess(ids.get_sort_key(earlier_server), ids.get_sort_key(later_client))
+
+    def test_legacy_ids_sort_by_message_time(self):
+        legacy_id = 'c' + 'ab' * 32
+        self.assertFalse(ids.is_ordered_id(legacy_id))
+        self.assertIsNone(ids.get_id_timestamp(legacy_id))
+        self.assertEqual(ids.get_id_origin(legacy_id), 'client')
+        message_time = ids.format_timestamp(1500)
+        earlier = ids.make_id('server', 1499)
+        later = ids.make_id('server', 1501)
+        keys = sorted([later, legacy_id, earlier], key=lambda message_id: ids.get_sort_key(message_id, message_time))
+        self.assertEqual(keys, [earlier, legacy_id, later])
+
+    def test_timestamps_round_trip(self):
+        for timestamp in 0, 1, 1500000000123456:
+            self.assertEqual(ids.parse_time(ids.format_timestamp(timestamp)), timestamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
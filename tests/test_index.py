@@ -0,0 +1,69 @@
+"""
+Tests for the in-memory message index's origin bitmaps and time ranges.
+"""
+
+import random
+import unittest
+
+from aiml_bot_api.ids import format_timestamp, make_id
+from aiml_bot_api.index import MessageIndex
+
+
+class SelectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0)
+        # Several messages share each second, to exercise inclusive bounds.
+        self.messages = []
+        for number in range(200):
+            timestamp = 1500000000000000 + self.random.randrange(50) * 1000000 + number
+            origin = self.random.choice(['client', 'server'])
+            self.messages.append((make_id(origin, timestamp), format_timestamp(timestamp), origin))
+
+    def expected(self, messages: list, origin: str = None, after: float = None, before: float = None) -> list:
+        return [message_id for message_id, message_time, message_origin in sorted(messages, key=lambda m: m[1])
+                if (origin is None or message_origin == origin) and
+                (after is None or float(message_time) >= after) and
+                (before is None or float(message_time) <= before)]
+
+    def check_selections(self, index: MessageIndex, messages: list) -> None:
+        times = sorted(float(message_time) for _, message_time, _ in messages)
+        bounds = [None, times[0], times[len(times) // 3], times[len(times) // 2] + 0.5, times[-1], times[-1] + 1]
+        for origin in None, 'client', 'server', 'other':
+            for after in bounds:
+                for before in bounds:
+                    self.assertEqual(index.select(origin, after, before),
+                                     self.expected(messages, origin, after, before), (origin, after, before))
+
+    def test_messages_added_out_of_order(self):
+        index = MessageIndex()
+        for message_id, message_time, origin in self.messages:
+            index.add(message_id, message_time, origin)
+        index.add(*self.messages[0])  # Adding a message twice has no effect
+        self.assertEqual(len(index), len(self.messages))
+        self.check_selections(index, self.messages)
+
+    def test_built_index(self):
+        store = {message_id: {'id': message_id, 'origin': origin, 'content': '', 'time': message_time}
+                 for message_id, message_time, origin in self.messages}
+        # Legacy IDs don't encode their time, which is read from the store.
+        legacy = ('s' + 'ab' * 32, format_timestamp(1500000000000000 + 25500000), 'server')
+        store[legacy[0]] = {'id': legacy[0], 'origin': legacy[2], 'content': '', 'time': legacy[1]}
+        excluded = self.messages[3][0]
+        index = MessageIndex.build(store, exclude={excluded})
+        messages = [message for message in self.messages if message[0] != excluded] + [legacy]
+        self.assertEqual(len(index), len(messages))
+        self.check_selections(index, messages)
+
+    def test_dropping_the_oldest_messages_shifts_the_bitmaps(self):
+        index = MessageIndex()
+        for message_id, message_time, origin in self.messages:
+            index.add(message_id, message_time, origin)
+        oldest = set(index.ids[:60])
+        index.drop_first(60)
+        messages = [message for message in self.messages if message[0] not in oldest]
+        self.check_selections(index, messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests for the hierarchical lock sets used by the data manager.
+"""
+
+import threading
+import unittest
+
+from aiml_bot_api.data import EXCLUSIVE, SHARED, LockSet
+
+
+# How long to wait for a lock which should be granted, and how long to wait
+# before deciding that one which shouldn't be granted is blocked, in seconds.
+GRANT_TIMEOUT = 5
+BLOCK_TIMEOUT = 0.2
+
+
+class Request:
+    """A request for a lock in a lock set, either on an item, or on the set
+    as a whole if the item is None, made on a thread of its own."""
+
+    def __init__(self, lock_set: LockSet, mode: str, item=None):
+        self.lock_set = lock_set
+        self.mode = mode
+        self.item = item
+        self.granted = threading.Event()
+        self.thread = threading.Thread(target=self._acquire, daemon=True)
+        self.thread.start()
+
+    def _acquire(self) -> None:
+        if self.item is None:
+            self.lock_set.acquire_set(self.mode)
+        else:
+            self.lock_set.acquire_item(self.item, self.mode)
+        self.granted.set()
+
+    def is_granted(self, timeout: float = GRANT_TIMEOUT) -> bool:
+        """Wait up to timeout seconds for the lock to be granted, and return
+        whether it was."""
+        return self.granted.wait(timeout)
+
+    def is_blocked(self) -> bool:
+        """Return whether the lock is still not granted after a while."""
+        return not self.granted.wait(BLOCK_TIMEOUT)
+
+    def release(self) -> None:
+        """Release the lock, once it has been granted."""
+        self.thread.join(GRANT_TIMEOUT)
+        if self.item is None:
+            self.lock_set.release_set(self.mode)
+        else:
+            self.lock_set.release_item(self.item, self.mode)
+
+
+class CompatibilityTests(unittest.TestCase):
+
+    def check(self, held: tuple, requested: tuple, compatible: bool) -> None:
+        """Check whether a lock is granted while another is held. Each lock
+        is given as a tuple (mode, item), where an item of None stands for
+        the set as a whole."""
+        lock_set = LockSet('test')
+        holder = Request(lock_set, *held)
+        self.assertTrue(holder.is_granted())
+        request = Request(lock_set, *requested)
+        if compatible:
+            self.assertTrue(request.is_granted(), (held, requested))
+            holder.release()
+        else:
+            self.assertTrue(request.is_blocked(), (held, requested))
+            holder.release()
+            self.assertTrue(request.is_granted(), (held, requested))
+        request.release()
+
+    def test_shared_item_locks_are_compatible(self):
+        self.check((SHARED, 'a'), (SHARED, 'a'), True)
+
+    def test_exclusive_item_locks_exclude_other_locks_on_the_item(self):
+        self.check((EXCLUSIVE, 'a'), (SHARED, 'a'), False)
+        self.check((SHARED, 'a'), (EXCLUSIVE, 'a'), False)
+        self.check((EXCLUSIVE, 'a'), (EXCLUSIVE, 'a'), False)
+
+    def test_locks_on_different_items_are_compatible(self):
+        self.check((EXCLUSIVE, 'a'), (EXCLUSIVE, 'b'), True)
+        self.check((EXCLUSIVE, 'a'), (SHARED, 'b'), True)
+
+    def test_shared_set_locks_only_exclude_exclusive_item_locks(self):
+        self.check((SHARED, None), (SHARED, None), True)
+        self.check((SHARED, None), (SHARED, 'a'), True)
+        self.check((SHARED, 'a'), (SHARED, None), True)
+        self.check((SHARED, None), (EXCLUSIVE, 'a'), False)
+        self.check((EXCLUSIVE, 'a'), (SHARED, None), False)
+
+    def test_exclusive_set_locks_exclude_every_other_lock(self):
+        for other in (SHARED, 'a'), (EXCLUSIVE, 'a'), (SHARED, None), (EXCLUSIVE, None):
+            self.check((EXCLUSIVE, None), other, False)
+            self.check(other, (EXCLUSIVE, None), False)
+
+
+class FairnessTests(unittest.TestCase):
+
+    def test_waiting_exclusive_item_lock_is_not_starved(self):
+        lock_set = LockSet('test')
+        reader = Request(lock_set, SHARED, 'a')
+        self.assertTrue(reader.is_granted())
+        writer = Request(lock_set, EXCLUSIVE, 'a')
+        self.assertTrue(writer.is_blocked())
+        # A later reader is compatible with the first, but waits its turn
+        # behind the writer.
+        later_reader = Request(lock_set, SHARED, 'a')
+        self.assertTrue(later_reader.is_blocked())
+        reader.release()
+        self.assertTrue(writer.is_granted())
+        self.assertTrue(later_reader.is_blocked())
+        writer.release()
+        self.assertTrue(later_reader.is_granted())
+        later_reader.release()
+
+    def test_waiting_exclusive_set_lock_is_not_starved(self):
+        lock_set = LockSet('test')
+        reader = Request(lock_set, SHARED, 'a')
+        self.assertTrue(reader.is_granted())
+        writer = Request(lock_set, EXCLUSIVE)
+        self.assertTrue(writer.is_blocked())
+        later_reader = Request(lock_set, SHARED, 'b')
+        self.assertTrue(later_reader.is_blocked())
+        reader.release()
+        self.assertTrue(writer.is_granted())
+        writer.release()
+        self.assertTrue(later_reader.is_granted())
+        later_reader.release()
+
+    def test_compatible_waiters_are_granted_together(self):
+        lock_set = LockSet('test')
+        writer = Request(lock_set, EXCLUSIVE, 'a')
+        self.assertTrue(writer.is_granted())
+        readers = [Request(lock_set, SHARED, 'a') for _ in range(3)]
+        self.assertTrue(all(reader.is_blocked() for reader in readers))
+        writer.release()
+        self.assertTrue(all(reader.is_granted() for reader in readers))
+        for reader in readers:
+            reader.release()
+
+    def test_released_locks_leave_no_state_behind(self):
+        lock_set = LockSet('test')
+        for mode in SHARED, EXCLUSIVE:
+            request = Request(lock_set, mode, 'a')
+            self.assertTrue(request.is_granted())
+            request.release()
+        self.assertEqual(lock_set._item_states, {})
+        self.assertTrue(lock_set._set_state.is_idle())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Tests for the append-only message log, in particular its recovery from
+crashes part way through a write.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from aiml_bot_api.message_log import RECORD_HEADER, MessageLog
+
+
+def make_message(number: int) -> dict:
+    message_id = 'm%03d' % number
+    return {'id': message_id, 'origin': 'client', 'content': 'message %d' % number, 'time': '%020d' % number}
+
+
+class MessageLogTests(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, True)
+        self.path = os.path.join(folder, 'user.log')
+        self.index_path = os.path.join(folder, 'user.idx')
+
+    def open_log(self) -> MessageLog:
+        message_log = MessageLog(self.path)
+        self.addCleanup(message_log.close)
+        return message_log
+
+    def write_messages(self, count: int) -> dict:
+        """Write some messages, overwriting one and deleting another, and
+        return the expected contents of the log."""
+        message_log = self.open_log()
+        expected = {}
+        for number in range(count):
+            message_data = make_message(number)
+            message_log[message_data['id']] = expected[message_data['id']] = message_data
+        message_log['m001'] = expected['m001'] = dict(make_message(1), content='edited')
+        del message_log['m002']
+        del expected['m002']
+        message_log.close()
+        return expected
+
+    def assert_contents(self, message_log: MessageLog, expected: dict) -> None:
+        self.assertEqual(dict(message_log.items()), expected)
+        self.assertEqual(list(message_log), [message_id for message_id in sorted(expected)])
+
+    def test_contents_survive_reopening(self):
+        expected = self.write_messages(10)
+        self.assert_contents(self.open_log(), expected)
+
+    def test_values_in_order_yields_latest_values_in_write_order(self):
+        expected = self.write_messages(5)
+        values = list(self.open_log().values_in_order())
+        self.assertEqual([value['id'] for value in values], ['m000', 'm003', 'm004', 'm001'])
+        self.assertEqual(values[-1], expected['m001'])
+
+    def test_truncated_record_is_dropped(self):
+        expected = self.write_messages(10)
+        size = os.path.getsize(self.path)
+        # A crash part way through appending a record leaves its header and
+        # part of its payload.
+        with open(self.path, 'ab') as log_file:
+            log_file.write(RECORD_HEADER.pack(100) + b'\x80\x05partial')
+        message_log = self.open_log()
+        self.assert_contents(message_log, expected)
+        self.assertEqual(os.path.getsize(self.path), size)
+        # New records are appended where the partial one was, and can be
+        # read back after reopening.
+        message_log['m100'] = expected['m100'] = make_message(100)
+        message_log.close()
+        self.assert_contents(self.open_log(), expected)
+
+    def test_truncated_header_is_dropped(self):
+        expected = self.write_messages(10)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as log_file:
+            log_file.write(RECORD_HEADER.pack(100)[:2])
+        self.assert_contents(self.open_log(), expected)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_missing_index_is_rebuilt(self):
+        expected = self.write_messages(10)
+        with open(self.index_path) as index_file:
+            index = index_file.read()
+        os.remove(self.index_path)
+        self.assert_contents(self.open_log(), expected)
+        with open(self.index_path) as index_file:
+            self.assertEqual(index_file.read(), index)
+
+    def test_lagging_index_is_caught_up(self):
+        expected = self.write_messages(10)
+        with open(self.index_path) as index_file:
+            lines = index_file.readlines()
+        # The index was written up to the fourth entry, the last one only
+        # partially, before a crash.
+        with open(self.index_path, 'w') as index_file:
+            index_file.writelines(lines[:3])
+            index_file.write(lines[3][:3])
+        self.assert_contents(self.open_log(), expected)
+
+    def test_concurrent_reads(self):
+        self.write_messages(50)
+        message_log = self.open_log()
+        message_ids = list(message_log)
+        errors = []
+
+        def read() -> None:
+            for _ in range(20):
+                for message_id in message_ids:
+                    if message_log[message_id]['id'] != message_id:
+                        errors.append(message_id)
+
+        readers = [threading.Thread(target=read) for _ in range(8)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
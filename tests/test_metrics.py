@@ -0,0 +1,99 @@
+"""
+Tests for rendering metrics in the Prometheus text format.
+"""
+
+import json
+import unittest
+from unittest import mock
+
+from aiml_bot_api import metrics
+
+from test_endpoints import EndpointTestCase, endpoints
+
+
+class RenderTests(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', "A test.", ('path',), buckets=(1, 2))
+        histogram.observe(0.5, 'a"b\\c\nd')
+        histogram.observe(2, 'a"b\\c\nd')
+        histogram.observe(3, 'a"b\\c\nd')
+        histogram.observe(1.5, 'x')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds A test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{path="a\\"b\\\\c\\nd",le="1"} 1',
+            'test_seconds_bucket{path="a\\"b\\\\c\\nd",le="2"} 2',
+            'test_seconds_bucket{path="a\\"b\\\\c\\nd",le="+Inf"} 3',
+            'test_seconds_sum{path="a\\"b\\\\c\\nd"} 5.5',
+            'test_seconds_count{path="a\\"b\\\\c\\nd"} 3',
+            'test_seconds_bucket{path="x",le="1"} 0',
+            'test_seconds_bucket{path="x",le="2"} 1',
+            'test_seconds_bucket{path="x",le="+Inf"} 1',
+            'test_seconds_sum{path="x"} 1.5',
+            'test_seconds_count{path="x"} 1',
+        ])
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('b_seconds', "B.")
+        self.assertIs(registry.histogram('b_seconds', "B."), histogram)
+        histogram.observe(0.001)
+
+        def collector():
+            return [('a_total', 'counter', "A.", [({'kind': 'hit'}, 3), ({}, 4)])]
+
+        registry.add_collector(collector)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:2], ['# HELP b_seconds B.', '# TYPE b_seconds histogram'])
+        self.assertIn('b_seconds_count 1', lines)
+        self.assertEqual(lines[-4:], ['# HELP a_total A.', '# TYPE a_total counter', 'a_total{kind="hit"} 3',
+                                      'a_total 4'])
+        registry.remove_collector(collector)
+        registry.remove_collector(collector)  # Removing it twice has no effect
+        self.assertNotIn('a_total 4', registry.render().splitlines())
+
+
+class GraphQLOperationLabelTests(EndpointTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in ('MAX_GRAPHQL_OPERATION_NAMES', 2), ('_graphql_operation_names', set()):
+            patcher = mock.patch.object(endpoints, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_operation(self, query: str, operation_name: str = None) -> str:
+        data = {'query': query}
+        if operation_name is not None:
+            data['operationName'] = operation_name
+        with endpoints.app.test_request_context('/', method='POST', data=json.dumps(data),
+                                                content_type='application/json'):
+            return endpoints.get_graphql_operation()
+
+    def test_names_are_capped(self):
+        self.assertEqual(self.get_operation('query First { users { id } }'), 'query First')
+        self.assertEqual(self.get_operation('mutation Second { addUser }'), 'mutation Second')
+        self.assertEqual(self.get_operation('query Third { users { id } }'), 'query (other)')
+        self.assertEqual(self.get_operation('{ users { id } }', 'Fourth'), 'query (other)')
+        # Names seen before the cap was reached keep their own labels.
+        self.assertEqual(self.get_operation('query First { users { id } }'), 'query First')
+        self.assertEqual(endpoints._graphql_operation_names, {'First', 'Second'})
+
+    def test_anonymous_operations_are_not_counted(self):
+        self.assertEqual(self.get_operation('{ users { id } }'), 'query (anonymous)')
+        self.assertEqual(self.get_operation('mutation { addUser }'), 'mutation (anonymous)')
+        self.assertEqual(endpoints._graphql_operation_names, set())
+
+    def test_metrics_endpoint(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with mock.patch.object(metrics.registry, 'enabled', True):
+            self.client.get('/users/')
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('aiml_bot_api_http_request_duration_seconds_count'
+                      '{endpoint="/users/",method="GET",status="200"}', response.get_data(as_text=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
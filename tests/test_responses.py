@@ -0,0 +1,123 @@
+"""
+Tests for the response cache, with a real bot and a small AIML set.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import aiml_bot
+
+from aiml_bot_api.responses import ResponseCache
+
+
+AIML = '''<?xml version="1.0" encoding="UTF-8"?>
+<aiml version="1.0">
+<category><pattern>HELLO</pattern><template>Hi there!</template></category>
+<category><pattern>HI</pattern><template><srai>HELLO</srai></template></category>
+<category><pattern>QUESTION</pattern><template>Do you like cats?</template></category>
+<category><pattern>YES</pattern><that>DO YOU LIKE CATS</that><template>Me too.</template></category>
+<category><pattern>YES</pattern><template>Yes what?</template></category>
+<category><pattern>WHO AM I</pattern><template>You are <get name="name"/>.</template></category>
+<category><pattern>MOOD</pattern><template><condition name="mood" value="happy">Great!</condition></template></category>
+<category><pattern>MY NAME IS *</pattern><template><set name="name"><star/></set> is a nice name.</template></category>
+<category><pattern>PICK</pattern><template><random><li>A</li><li>B</li></random></template></category>
+<category><pattern>WHAT DID YOU SAY</pattern><template>I said <that/></template></category>
+</aiml>
+'''
+
+HELLO_AGAIN = '''<?xml version="1.0" encoding="UTF-8"?>
+<aiml version="1.0">
+<category><pattern>HELLO</pattern><template>Hello again!</template></category>
+</aiml>
+'''
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        # The bot still times its loading with time.clock(), which newer
+        # versions of Python don't have.
+        clock = mock.patch('aiml_bot.bot.time.clock', time.perf_counter, create=True)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.bot = self.make_bot(AIML)
+        self.cache = ResponseCache()
+
+    def write_aiml(self, name: str, aiml: str) -> str:
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as aiml_file:
+            aiml_file.write(aiml)
+        return path
+
+    def make_bot(self, aiml: str) -> aiml_bot.Bot:
+        return aiml_bot.Bot(learn=self.write_aiml('test.aiml', aiml), verbose=False)
+
+    def respond(self, text: str, session_id: str) -> str:
+        """Return the cached response, checking it against the response of
+        an uncached bot in the same state."""
+        expected_bot = self.make_bot(AIML)
+        expected_bot.set_session_data(self.bot.get_session_data(session_id), session_id)
+        expected = expected_bot.respond(text, session_id)
+        response = self.cache.respond(self.bot, text, session_id)
+        self.assertEqual(response, expected)
+        self.assertEqual(self.bot.get_output_history(session_id)[-1], response)
+        return response
+
+    def test_repeated_input_is_reused(self):
+        self.assertEqual(self.respond('Hello', 'alice'), 'Hi there!')
+        self.assertEqual(self.respond('Hello', 'bob'), 'Hi there!')
+        self.assertEqual((self.cache.stats.misses, self.cache.stats.hits), (1, 1))
+        self.assertEqual(self.bot.get_input_history('bob'), ['Hello'])
+
+    def test_that_selects_the_template(self):
+        self.respond('question', 'alice')
+        self.assertEqual(self.respond('yes', 'alice'), 'Me too.')
+        self.assertEqual(self.respond('yes', 'bob'), 'Yes what?')
+        self.respond('question', 'bob')
+        self.assertEqual(self.respond('yes', 'bob'), 'Me too.')
+        self.assertEqual(self.respond('yes', 'carol'), 'Yes what?')
+        # Two variants of YES were cached, one for each that.
+        self.assertEqual(self.cache.stats.hits, 3)
+        self.assertEqual(len(self.cache), 3)
+
+    def test_predicates_read_by_get_are_checked(self):
+        for session_id, name in ('alice', 'Alice'), ('bob', 'Bob'), ('alice2', 'Alice'):
+            self.bot.set_predicate('name', name, session_id)
+            self.assertEqual(self.respond('who am I', session_id), 'You are %s.' % name)
+        self.assertEqual((self.cache.stats.misses, self.cache.stats.hits), (2, 1))
+
+    def test_predicates_read_by_condition_are_checked(self):
+        self.bot.set_predicate('mood', 'happy', 'alice')
+        self.assertEqual(self.respond('mood', 'alice'), 'Great!')
+        self.assertEqual(self.respond('mood', 'bob'), '')
+        self.bot.set_predicate('mood', 'happy', 'bob')
+        self.assertEqual(self.respond('mood', 'bob'), 'Great!')
+        self.assertEqual((self.cache.stats.misses, self.cache.stats.hits), (2, 1))
+
+    def test_srai_matches_are_checked(self):
+        self.assertEqual(self.respond('hi', 'alice'), 'Hi there!')
+        self.assertEqual(self.respond('hi', 'bob'), 'Hi there!')
+        self.assertEqual(self.cache.stats.hits, 1)
+        # The template HI redirects to has changed, so the cached response
+        # is no longer valid.
+        self.bot.learn(self.write_aiml('hello_again.aiml', HELLO_AGAIN))
+        self.assertEqual(self.cache.respond(self.bot, 'hi', 'carol'), 'Hello again!')
+        self.assertEqual(self.cache.stats.hits, 1)
+
+    def test_uncacheable_templates(self):
+        for text in 'my name is Alice', 'pick', 'what did you say', 'hello. hi.':
+            self.cache.respond(self.bot, text, 'alice')
+            self.cache.respond(self.bot, text, 'alice')
+        self.assertEqual(self.cache.stats.uncacheable, 8)
+        self.assertEqual(self.cache.stats.hits, 0)
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
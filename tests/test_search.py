@@ -0,0 +1,75 @@
+"""
+Tests for full-text search over message content.
+"""
+
+import unittest
+
+from aiml_bot_api.search import TokenIndex, parse_query
+
+from test_data import DataManagerTestCase
+
+
+MESSAGES = [
+    {'id': 'm1', 'content': 'Hello there, world!'},
+    {'id': 'm2', 'content': 'Help me with my homework'},
+    {'id': 'm3', 'content': 'HELLO again'},
+    {'id': 'm4', 'content': "I'm helpless"},
+    {'id': 'm5', 'content': 'hell'},
+]
+
+
+class TokenIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TokenIndex.build(MESSAGES)
+
+    def test_exact_terms_ignore_case(self):
+        self.assertEqual(self.index.search('hello'), {'m1', 'm3'})
+        self.assertEqual(self.index.search('HELL'), {'m5'})
+        self.assertEqual(self.index.search('hel'), set())
+
+    def test_prefix_terms(self):
+        self.assertEqual(self.index.search('hel*'), {'m1', 'm2', 'm3', 'm4', 'm5'})
+        self.assertEqual(self.index.search('hell*'), {'m1', 'm3', 'm5'})
+        self.assertEqual(self.index.search('helpl*'), {'m4'})
+        self.assertEqual(self.index.search('homework*'), {'m2'})
+        self.assertEqual(self.index.search('zz*'), set())
+        # The last word in the sorted list can be matched by prefix.
+        self.assertEqual(self.index.search('wor*'), {'m1'})
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.index.search('hel* again'), {'m3'})
+        self.assertEqual(self.index.search('hello homework'), set())
+        self.assertEqual(self.index.search(''), set())
+        self.assertEqual(self.index.search('*'), set())
+
+    def test_punctuation_splits_terms(self):
+        self.assertEqual(parse_query("i'm hel*"), [('i', False), ('m', False), ('hel', True)])
+        self.assertEqual(parse_query('there,wor*'), [('there', False), ('wor', True)])
+        self.assertEqual(self.index.search("I'm"), {'m4'})
+
+    def test_added_messages_are_found_by_prefix(self):
+        self.index.add('m6', 'Helium balloons')
+        self.index.add('m7', 'aardvark')
+        self.assertEqual(self.index.search('heli*'), {'m6'})
+        self.assertEqual(self.index.search('aa*'), {'m7'})
+        self.assertEqual(self.index.words, sorted(self.index.words))
+
+
+class SearchTests(DataManagerTestCase):
+
+    def test_search_includes_messages_added_after_the_index_was_built(self):
+        data_manager = self.open_data_manager('log')
+        data_manager.add_user('user', 'User')
+        data_manager.add_message('user', 'hello world')
+        # The bot echoes each message back.
+        self.assertEqual(data_manager.search_message_ids('user', 'hel*'), data_manager.get_message_ids('user'))
+        data_manager.add_message('user', 'help')
+        message_ids = data_manager.get_message_ids('user')
+        self.assertEqual(data_manager.search_message_ids('user', 'hel*'), message_ids)
+        self.assertEqual(data_manager.search_message_ids('user', 'echo hel*'), message_ids[1::2])
+        self.assertEqual(data_manager.search_message_ids('user', 'help'), message_ids[2:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Tests for the write-behind session store and its crash-recovery journal.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from aiml_bot_api.sessions import SessionStore, write_journal
+
+
+class MemoryStore(dict):
+    """An underlying session store which can be made to fail part way
+    through applying a batch, like a process that crashes."""
+
+    def __init__(self, *args, fail_after: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_after = fail_after
+        self.closed = False
+
+    def __setitem__(self, key, value):
+        if self.fail_after is not None:
+            if not self.fail_after:
+                raise OSError("Simulated crash")
+            self.fail_after -= 1
+        super().__setitem__(key, value)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class SessionStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, True)
+        self.journal_path = os.path.join(folder, 'sessions.journal')
+
+    def open(self, store: MemoryStore) -> SessionStore:
+        # The background thread never flushes on its own during a test.
+        sessions = SessionStore(store, self.journal_path, flush_interval=3600, max_dirty=1000)
+        self.addCleanup(sessions.close)
+        return sessions
+
+    def test_changes_are_visible_before_they_are_flushed(self):
+        store = MemoryStore({'a': {'n': 1}, 'b': {'n': 2}})
+        sessions = self.open(store)
+        sessions['a'] = {'n': 3}
+        sessions['c'] = {'n': 4}
+        del sessions['b']
+        self.assertEqual(sessions.dirty_count, 3)
+        self.assertEqual((sessions['a'], list(sessions), 'b' in sessions), ({'n': 3}, ['a', 'c'], False))
+        self.assertEqual(store, {'a': {'n': 1}, 'b': {'n': 2}})
+        sessions.flush()
+        self.assertEqual(store, {'a': {'n': 3}, 'c': {'n': 4}})
+        self.assertEqual(sessions.dirty_count, 0)
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_journal_is_replayed_after_a_crash(self):
+        store = MemoryStore({'a': {'n': 1}, 'b': {'n': 2}})
+        # The process crashed after journaling this batch, part way through
+        # applying it.
+        write_journal(self.journal_path, {'a': {'n': 3}, 'b': None, 'c': {'n': 4}})
+        store['a'] = {'n': 3}
+        sessions = self.open(store)
+        self.assertEqual(store, {'a': {'n': 3}, 'c': {'n': 4}})
+        self.assertEqual(sessions.dirty_count, 0)
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_incomplete_journal_is_discarded(self):
+        write_journal(self.journal_path, {'a': {'n': 3}})
+        with open(self.journal_path, 'r+b') as journal:
+            journal.truncate(os.path.getsize(self.journal_path) - 1)
+        store = MemoryStore({'a': {'n': 1}})
+        self.open(store)
+        self.assertEqual(store, {'a': {'n': 1}})
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_batch_interrupted_while_applied_is_recovered(self):
+        store = MemoryStore({'a': {'n': 1}})
+        sessions = SessionStore(store, self.journal_path, flush_interval=3600, max_dirty=1000)
+        # Stop the background thread, so it doesn't retry the failed batch,
+        # and the store is abandoned without flushing, as if the process died.
+        with sessions._lock:
+            sessions._closed = True
+            sessions._flush_requested.notify_all()
+        sessions._thread.join()
+        for name in 'abc':
+            sessions[name] = {'n': name}
+        store.fail_after = 1
+        with self.assertRaises(OSError):
+            sessions.flush()
+        # The failed batch stays dirty, and its journal stays on disk.
+        self.assertEqual(sessions.dirty_count, 3)
+        self.assertTrue(os.path.exists(self.journal_path))
+
+        store.fail_after = None
+        self.open(store)
+        self.assertEqual(store, {'a': {'n': 'a'}, 'b': {'n': 'b'}, 'c': {'n': 'c'}})
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_close_flushes_and_closes_the_store(self):
+        store = MemoryStore()
+        sessions = SessionStore(store, self.journal_path, flush_interval=3600, max_dirty=1000)
+        sessions['a'] = {'n': 1}
+        sessions.close()
+        self.assertEqual(store, {'a': {'n': 1}})
+        self.assertTrue(store.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
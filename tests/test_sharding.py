@@ -0,0 +1,158 @@
+"""
+Tests for moving users between shards.
+"""
+
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from aiml_bot_api.data import DataManager
+from aiml_bot_api.sharding import STATE_FILE, HashRing, ShardedDataManager, open_shards, read_state, rebalance
+
+from test_data import DataManagerTestCase, EchoBot
+
+
+class LocalShard:
+    """A stand-in for a shard process, with its data manager in this
+    process."""
+
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+
+    @classmethod
+    def start(cls, index: int, data_folder: str, options: dict = None) -> 'LocalShard':
+        """Start a shard in place of a shard process."""
+        return cls(DataManager(bot=EchoBot(), data_folder=data_folder, **(options or {})))
+
+    def close(self) -> None:
+        self.data_manager.close()
+
+
+class RebalanceTests(DataManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ring = HashRing(2)
+        self.shards = {index: LocalShard(self.open_data_manager('log', 'shard-%d' % index)) for index in range(2)}
+        # Put every user on shard 0, so the ones the ring assigns to shard
+        # 1 have to be moved.
+        self.source = self.shards[0].data_manager
+        self.user_ids = ['user-%d' % number for number in range(10)]
+        for user_id in self.user_ids:
+            self.source.add_user(user_id, user_id)
+            self.source.import_messages((user_id, {'content': 'message %d' % number}) for number in range(5))
+            self.source.archive_messages(user_id, 2)
+        self.moving = [user_id for user_id in self.user_ids if self.ring.shard_for(user_id) == 1]
+        self.assertTrue(self.moving)
+
+    def test_users_are_moved_with_their_messages(self):
+        self.assertEqual(rebalance(self.data_folder, self.shards, self.ring), len(self.moving))
+        target = self.shards[1].data_manager
+        self.assertEqual(target.get_user_ids(), self.moving)
+        for user_id in self.moving:
+            self.assertEqual(len(target.get_message_ids(user_id)), 3)
+            self.assertEqual(len(target.get_archived_message_ids(user_id)), 2)
+        self.assertEqual(self.source.get_user_ids(), sorted(set(self.user_ids) - set(self.moving)))
+        self.assertTrue(os.path.isfile(os.path.join(self.data_folder, 'shards.json')))
+
+    def test_users_are_kept_if_their_messages_are_rejected(self):
+        target = self.shards[1].data_manager
+        with mock.patch.object(target, '_validate_imported_message', return_value=False):
+            with self.assertRaises(RuntimeError):
+                rebalance(self.data_folder, self.shards, self.ring)
+        user_id = self.moving[0]
+        self.assertEqual(len(self.source.get_message_ids(user_id)), 3)
+        self.assertEqual(len(self.source.get_archived_message_ids(user_id)), 2)
+
+
+class MigrationTests(DataManagerTestCase):
+
+    def open_shards(self) -> dict:
+        with mock.patch('aiml_bot_api.sharding.Shard', LocalShard.start):
+            shards = open_shards(self.data_folder, HashRing(2), {'storage': 'log'})
+        for shard in shards.values():
+            self.addCleanup(shard.close)
+        return shards
+
+    def test_unsharded_users_are_moved_into_the_shards(self):
+        unsharded = self.open_data_manager('log', '')
+        user_ids = ['user-%d' % number for number in range(10)]
+        for user_id in user_ids:
+            unsharded.add_user(user_id, user_id)
+            unsharded.import_messages((user_id, {'content': 'message %d' % number}) for number in range(5))
+            unsharded.archive_messages(user_id, 2)
+        unsharded.close()
+
+        shards = self.open_shards()
+        ring = HashRing(2)
+        for index, shard in shards.items():
+            shard_user_ids = [user_id for user_id in user_ids if ring.shard_for(user_id) == index]
+            self.assertEqual(shard.data_manager.get_user_ids(), shard_user_ids)
+            for user_id in shard_user_ids:
+                self.assertEqual(len(shard.data_manager.get_message_ids(user_id)), 3)
+                self.assertEqual(len(shard.data_manager.get_archived_message_ids(user_id)), 2)
+        self.assertEqual(read_state(self.data_folder), {'shards': 2, 'replicas': ring.replicas})
+        for shard in shards.values():
+            shard.close()
+        self.assertEqual(self.open_data_manager('log', '').get_user_ids(), [])
+
+    def test_new_data_folder_is_not_migrated(self):
+        with mock.patch('aiml_bot_api.sharding.migrate_unsharded') as migrate_unsharded:
+            self.open_shards()
+        migrate_unsharded.assert_not_called()
+        self.assertTrue(os.path.isfile(os.path.join(self.data_folder, STATE_FILE)))
+
+
+class WatcherTests(DataManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patches = [mock.patch('aiml_bot_api.sharding.Shard', LocalShard.start),
+                   mock.patch('aiml_bot_api.sharding.WATCH_TIMEOUT', 0.05)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.data_manager = ShardedDataManager(self.data_folder, shards=2, storage='log')
+        self.addCleanup(self.data_manager.close)
+        self.data_manager.add_user('user', 'User')
+
+    def test_listener_added_as_the_watcher_exits_is_notified(self):
+        for number in range(20):
+            removed = threading.Event()
+            self.data_manager.add_message_listener('user', removed.set)
+            self.data_manager.remove_message_listener('user', removed.set)
+            # Add the next listener at various points in the watcher's
+            # wait, including as it decides to exit.
+            time.sleep(number * 0.005)
+            notified = threading.Event()
+            self.data_manager.add_message_listener('user', notified.set)
+            self.data_manager.add_message('user', 'message %d' % number)
+            self.assertTrue(notified.wait(5), number)
+            self.data_manager.remove_message_listener('user', notified.set)
+
+    def test_watcher_keeps_watching_after_an_error(self):
+        shard = self.data_manager.get_shard('user')
+        wait_for_messages = shard.wait_for_messages
+        errors = [RuntimeError("The shard went away.")]
+
+        def flaky_wait_for_messages(*args):
+            if errors:
+                raise errors.pop()
+            return wait_for_messages(*args)
+
+        notified = threading.Event()
+        with mock.patch.object(shard, 'wait_for_messages', side_effect=flaky_wait_for_messages):
+            self.data_manager.add_message_listener('user', notified.set)
+            # The listeners are woken when the error happens, so they can
+            # check for themselves.
+            self.assertTrue(notified.wait(5))
+            notified.clear()
+            time.sleep(0.1)  # Until the watcher is waiting again
+            self.data_manager.add_message('user', 'hello')
+            self.assertTrue(notified.wait(5))
+        self.data_manager.remove_message_listener('user', notified.set)
+
+if __name__ == '__main__':
+    unittest.main()
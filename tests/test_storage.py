@@ -0,0 +1,53 @@
+"""
+Tests for the storage backends.
+"""
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+from aiml_bot_api.storage import SQLiteBackend
+
+
+class SQLiteBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_folder, True)
+        self.backend = SQLiteBackend(self.data_folder)
+        self.addCleanup(self.backend.close)
+
+    def test_thread_connections_are_closed_when_threads_exit(self):
+        messages = self.backend.open_messages('user')
+        messages['m1'] = {'id': 'm1', 'origin': 'client', 'content': 'hello', 'time': '20200101000000.000000'}
+        results = []
+        for _ in range(20):
+            reader = threading.Thread(target=lambda: results.append(messages['m1']['content']))
+            reader.start()
+            reader.join()
+        self.assertEqual(results, ['hello'] * 20)
+        self.assertEqual(len(self.backend._connections), 1)  # Only the main thread's
+
+    def test_messages_are_indexed_by_time(self):
+        self.backend.connection.execute("DROP INDEX messages_by_time")
+        backend = SQLiteBackend(self.data_folder)  # Databases without the index get it when opened
+        self.addCleanup(backend.close)
+        plan = backend.connection.execute("EXPLAIN QUERY PLAN " + SQLiteBackend.TIME_RANGE,
+                                  ('user', '', '~', '', '', -1)).fetchall()
+        self.assertIn('messages_by_time', str(plan))
+
+    def test_read_messages_by_time(self):
+        messages = self.backend.open_messages('user')
+        times = ['20200101000000.000000', '20200101000000.500000', '20200101000001.000000', '20200101000002.000000']
+        for number, message_time in reversed(list(enumerate(times))):
+            messages['m%d' % number] = {'id': 'm%d' % number, 'origin': 'client', 'content': '', 'time': message_time}
+        self.backend.open_messages('other')['m9'] = {'id': 'm9', 'origin': 'client', 'content': '', 'time': times[1]}
+        self.assertEqual(list(messages), ['m0', 'm1', 'm2', 'm3'])
+        read = self.backend.read_messages_by_time
+        self.assertEqual([data['id'] for data in read('user')], ['m0', 'm1', 'm2', 'm3'])
+        self.assertEqual([data['id'] for data in read('user', '20200101000000.5', '20200101000002')], ['m1', 'm2'])
+        self.assertEqual([data['id'] for data in read('user', after=(times[1], 'm1'), limit=1)], ['m2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Tests for the bot worker pool.
+"""
+
+import os
+import threading
+import unittest
+import zlib
+
+from aiml_bot_api.workers import BotPool, _respond
+
+from test_data import EchoBot
+
+
+class CountingBot(EchoBot):
+    """An EchoBot which answers with the bot's number and process ID, and
+    records the messages it answered in each user's session."""
+
+    count = 0
+    count_lock = threading.Lock()
+
+    def __init__(self):
+        super().__init__()
+        with CountingBot.count_lock:
+            self.number = CountingBot.count
+            CountingBot.count += 1
+
+    def respond(self, content: str, user_id: str) -> str:
+        session = self.sessions.setdefault(user_id, {'messages': []})
+        session['messages'].append(content)
+        return '%d %d' % (self.number, os.getpid())
+
+
+class BotPoolTests(unittest.TestCase):
+
+    def open_pool(self, workers: int, mode: str = 'thread') -> BotPool:
+        pool = BotPool(CountingBot, workers, mode)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_users_are_pinned_to_stable_workers(self):
+        pool = self.open_pool(4)
+        user_ids = ['user%d' % number for number in range(100)]
+        for user_id in user_ids:
+            self.assertEqual(pool.worker_index(user_id), zlib.crc32(user_id.encode()) % 4)
+        self.assertEqual({pool.worker_index(user_id) for user_id in user_ids}, {0, 1, 2, 3})
+        bots = {}
+        for _ in range(3):
+            for user_id in user_ids:
+                response, _ = pool.respond(user_id, 'hello')
+                bots.setdefault(user_id, set()).add(response)
+        # Each user is always answered by the same bot, and users on the
+        # same worker share it.
+        self.assertTrue(all(len(responses) == 1 for responses in bots.values()))
+        by_worker = {}
+        for user_id, responses in bots.items():
+            by_worker.setdefault(pool.worker_index(user_id), set()).update(responses)
+        self.assertEqual(len(set.union(*by_worker.values())), 4)
+        self.assertTrue(all(len(responses) == 1 for responses in by_worker.values()))
+
+    def test_requests_are_answered_in_submission_order(self):
+        pool = self.open_pool(2)
+
+        def send(user_id: str) -> None:
+            for number in range(50):
+                pool.submit(user_id, _respond, user_id, str(number))
+
+        senders = [threading.Thread(target=send, args=('user%d' % number,)) for number in range(4)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        for number in range(4):
+            session_data = pool.get_session_data('user%d' % number)
+            self.assertEqual(session_data['messages'], [str(message) for message in range(50)])
+
+    def test_sessions_stay_with_their_worker(self):
+        pool = self.open_pool(3)
+        pool.set_session_data('alice', {'messages': ['earlier']})
+        _, session_data = pool.respond('alice', 'hello')
+        self.assertEqual(session_data, {'messages': ['earlier', 'hello']})
+        pool.delete_session('alice')
+        self.assertEqual(pool.get_session_data('alice'), {})
+
+    def test_process_workers(self):
+        pool = self.open_pool(2, 'process')
+        pids = {pool.respond('user%d' % number, 'hello')[0].split()[1] for number in range(10)}
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertEqual(pool.get_session_data('user0'), {'messages': ['hello']})
+
+    def test_a_shared_bot_needs_a_single_thread_worker(self):
+        with self.assertRaises(ValueError):
+            BotPool(bot=EchoBot(), workers=2)
+        with self.assertRaises(ValueError):
+            BotPool(bot=EchoBot(), mode='process')
+
+
+if __name__ == '__main__':
+    unittest.main()